@@ -0,0 +1,662 @@
+import asyncio
+import inspect
+import threading
+import time
+import traceback
+
+import helper
+import alexa_audio
+import alexa_communication
+import alexa_device
+import http2_connection
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+# Seconds until the connection is reestablished again after reconnecting failed, doubled after each failure
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+
+
+class AsyncAlexaConnection(alexa_communication.AlexaConnectionBase):
+    """ asyncio version of AlexaConnection. Everything runs on one event loop, so no threads are used for the
+        downchannel, the ping or the responses. Requests are sent with coroutines (e.g. await send_event), and the
+        downchannel directives are read with an async iterator (async for message in directives()).
+
+        The API specific events (e.g. send_event_speech_started) are shared with AlexaConnection, and return an
+        awaitable that results in the stream_id.
+    """
+    def __init__(self, config, context_handle, process_response_handle=None, boundary='this-is-my-boundary',
+                 url='avs-alexa-na.amazon.com', port=443, secure=True, token_manager=None, audio_encoder=None):
+        """ Initialize the AsyncAlexaConnection. The connection is not opened until open is called. See
+            AlexaConnection for the arguments.
+
+        :param config: a configuration dictionary containing the Client_ID, Client_Secret,
+                       and refresh_token.
+        :param context_handle: this is a pointer to the function that can supply the
+                               device's context (a list of dictionaries, or a JSON binary string). See AVS
+                               context docs for more info.
+        :param process_response_handle: (optional) function (or coroutine function) that processes each message
+                                        received as a response, used by get_and_process_response
+        :param boundary: (optional) the boundary used to separate header and context in
+                         each message
+        :param url: (optional) host name of the AVS endpoint (e.g. a local stand-in server)
+        :param port: (optional) port of the AVS endpoint
+        :param secure: (optional) flag that indicates if TLS should be used
+        :param token_manager: (optional) alexa_token.TokenManager that supplies the tokens. If not specified, one is
+                              created (and started) for the config, and stopped when the connection is closed.
+        :param audio_encoder: (optional) function (e.g. an encoder class from alexa_encoder) that creates the encoder
+                              of each Recognize event's audio, by default the audio is sent as is
+                              (alexa_encoder.PCMEncoder)
+        """
+        alexa_communication.AlexaConnectionBase.__init__(self, config, context_handle, boundary, token_manager,
+                                                         audio_encoder=audio_encoder)
+
+        self.url = url
+        self.port = port
+        self.secure = secure
+        self.process_response_handle = process_response_handle
+
+        self.connection = None
+        self.downstream_response = None
+        self.downstream_boundary = None
+        self.ping_task = None
+        self.reconnect_lock = None
+        self.is_closed = False
+
+    async def open(self):
+        """ Opens the connection with AVS, opens the downchannel and sends the required SynchronizeState event.
+            This is also used to reestablish the connection.
+        """
+        if self.reconnect_lock is None:
+            self.reconnect_lock = asyncio.Lock()
+
+        connection = http2_connection.AsyncHTTP2Connection(self.url, port=self.port, secure=self.secure)
+        await connection.connect()
+        self.connection = connection
+
+        # First start downstream
+        await self.start_downstream()
+
+        # Send sync state message (required)
+        header = {'namespace': "System", 'name': "SynchronizeState"}
+        stream_id = await self.send_event(header)
+        response = await self.get_response(stream_id)
+        # Should be 204 response (no content)
+        if response.status != 204:
+            print(await response.read())
+            raise NameError("Bad status (%s)" % response.status)
+
+        if self.ping_task is None:
+            self.ping_task = asyncio.ensure_future(self.ping_loop())
+
+    async def start_downstream(self):
+        """ Opens the downchannel stream. The directives are read using directives.
+        """
+        stream_id = await self.send_request('GET', '/directives')
+        self.downstream_response = await self.get_response(stream_id)
+        if self.downstream_response.status != 200:
+            print(await self.downstream_response.read())
+            raise NameError("Bad status (%s)" % self.downstream_response.status)
+        self.downstream_boundary = alexa_communication.get_boundary_from_response(self.downstream_response)
+
+    async def directives(self):
+        """ Async generator, which returns each message received on the downchannel as soon as it is complete. If
+            the downchannel is closed by the server, the connection is reestablished (see reconnect_until_open) and
+            reading continues. Ends when the connection is closed.
+        """
+        while not self.is_closed:
+            connection = self.connection
+            parser = alexa_communication.MultipartParser(self.downstream_boundary)
+            async for chunk in self.downstream_response.read_chunked():
+                message = alexa_communication.new_message()
+                for message_header, message_content in parser.feed(chunk):
+                    alexa_communication.add_part_to_message(message, message_header, message_content)
+                if message['content'] or message['attachment']:
+                    yield message
+            if not self.is_closed:
+                print("Downchannel closed.")
+                await self.reconnect_until_open(connection)
+
+    async def reconnect(self, connection):
+        """ Reestablishes the connection, unless it was already reestablished since connection was in use (the
+            downchannel and the ping can both notice that the connection is broken).
+
+        :param connection: the AsyncHTTP2Connection that failed
+        """
+        async with self.reconnect_lock:
+            if self.is_closed or connection is not self.connection:
+                return
+            await connection.close()
+            await self.open()
+
+    async def reconnect_until_open(self, connection):
+        """ Reestablishes the connection (see reconnect). If that fails, it is tried again after a delay that
+            doubles with each attempt (up to MAX_RECONNECT_DELAY), until it succeeds or the connection is closed.
+
+        :param connection: the AsyncHTTP2Connection that failed
+        """
+        delay = RECONNECT_DELAY
+        while not self.is_closed:
+            try:
+                await self.reconnect(connection)
+                return
+            except Exception:
+                traceback.print_exc()
+            # The connection that was opened (if any) failed as well, unless it is reestablished by someone else
+            # in the meantime
+            connection = self.connection
+            print("Reconnecting in %d seconds." % delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    async def ping_loop(self):
+        """ Sends a ping request every 4 minutes, which is required to maintain a connection when the system is
+            idle. If ping fails, the connection is reestablished.
+        """
+        while not self.is_closed:
+            await asyncio.sleep(4*60)
+            connection = self.connection
+            try:
+                stream_id = await self.send_request('GET', '/ping', path_version=False)
+                response = await self.get_response(stream_id)
+                is_successful = response.status == 204
+            except (ConnectionError, KeyError):
+                is_successful = False
+            if not is_successful:
+                print("Ping not successful.")
+                await self.reconnect_until_open(connection)
+
+    async def close(self):
+        """ Closes the connection and stops the ping.
+        """
+        self.is_closed = True
+        if self.ping_task is not None:
+            self.ping_task.cancel()
+        if self.connection is not None:
+            await self.connection.close()
+        if self.owns_token_manager:
+            self.token_manager.stop()
+
+    async def get_current_token(self):
+        """ Gets a valid token. Only waits (in a worker thread, so the event loop keeps running) if the token
+            manager has no valid token.
+
+        :return: a valid token
+        """
+        token = self.token_manager.get_cached_token()
+        if token is None:
+            token = await asyncio.get_event_loop().run_in_executor(None, self.token_manager.get_token)
+        return token
+
+    async def get_request_headers(self):
+        """ Gets the HTTP/2 headers used for every request (authorization and content type).
+
+        :return: header dictionary
+        """
+        return {
+            'authorization': 'Bearer %s' % await self.get_current_token(),
+            'content-type': 'multipart/form-data; boundary=%s' % self.boundary
+        }
+
+    async def send_request(self, method, path, body=None, path_version=True):
+        """ Same as AlexaConnection.send_request.
+
+        :param method: string HTTP/2 method (e.g. 'GET')
+        :param path: string of the desired path, by default is added to /v20160207 to get the full path
+        :param body: (optional) message content to send (binary string, or a list of binary strings)
+        :param path_version: (optional, default=True) flag that indicates if the version should be added to the full
+                             path.
+        :return: stream_id for the request
+        """
+        headers = await self.get_request_headers()
+        if path_version:
+            path = '/v20160207' + path
+        return await self.connection.request(method, path, headers=headers, body=body)
+
+    async def start_request(self, method, path, body, path_version=True):
+        """ Same as AlexaConnection.start_request.
+
+        :param method: string HTTP/2 method (e.g. 'GET')
+        :param path: string of the desired path, by default is added to /v20160207 to get the full path
+        :param body: start of the message content
+        :param path_version: (optional, default=True) flag that indicates if the version should be added to the full
+                             path.
+        :return: stream_id for the request
+        """
+        headers = await self.get_request_headers()
+        if path_version:
+            path = '/v20160207' + path
+        return await self.connection.request(method, path, headers=headers, body=body, final=False)
+
+    async def send_request_data(self, stream_id, data, final=False):
+        """ Sends more of the body for a request started with start_request.
+
+        :param stream_id: stream_id for the request
+        :param data: binary string (or a list of binary strings) to send
+        :param final: (optional, default=False) flag that indicates if this is the end of the body
+        """
+        await self.connection.send(stream_id, data, final=final)
+
+    async def send_event(self, header, payload=None, audio=None):
+        """ Same as AlexaConnection.send_event.
+
+        :param header: message header dictionary
+        :param payload: message payload dictionary
+        :param audio: raw binary string attachment
+        :return: stream_id associated with the request
+        """
+        return await self.send_request('GET', '/events', body=self.get_event_body(header, payload, audio))
+
+    async def get_response(self, stream_id):
+        """ Waits for the response to a request.
+
+        :param stream_id: stream_id used to get the response
+        :return: the resulting response object (http2_connection.AsyncHTTP2Response)
+        """
+        return await self.connection.get_response(stream_id)
+
+    async def start_recognize_event(self, raw_audio, dialog_request_id=None):
+        """ Same as AlexaConnection.start_recognize_event.
+
+        :param raw_audio: raw binary string audio attachment
+        :param dialog_request_id: (optional) previously used dialog_request_id
+        :return: the stream_id associated with the request
+        """
+        encoder = self.audio_encoder()
+        header, payload = self.get_recognize_event(dialog_request_id, encoder.audio_format)
+        # Encoding the whole recording blocks, so it is done in a worker thread
+        loop = asyncio.get_event_loop()
+        audio = [await loop.run_in_executor(None, encoder.encode, raw_audio),
+                 await loop.run_in_executor(None, encoder.finish)]
+        stream_id = await self.send_event(header, payload=payload, audio=audio)
+        self.dialog_streams[stream_id] = header['dialogRequestId']
+        return stream_id
+
+    async def start_recognize_stream(self, dialog_request_id=None):
+        """ Same as AlexaConnection.start_recognize_stream.
+
+        :param dialog_request_id: (optional) previously used dialog_request_id
+        :return: the stream_id associated with the request
+        """
+        encoder = self.audio_encoder()
+        header, payload = self.get_recognize_event(dialog_request_id, encoder.audio_format)
+        body_start = self.get_event_metadata(header, payload=payload) + self.get_audio_part_header()
+        stream_id = await self.start_request('GET', '/events', body_start)
+        self.dialog_streams[stream_id] = header['dialogRequestId']
+        self.stream_encoders[stream_id] = encoder
+        return stream_id
+
+    async def send_recognize_audio(self, stream_id, raw_audio):
+        """ Sends the next chunk of audio for a Recognize event started with start_recognize_stream.
+
+        :param stream_id: stream_id returned by start_recognize_stream
+        :param raw_audio: raw binary string audio (PCM)
+        """
+        data = self.stream_encoders[stream_id].encode(raw_audio)
+        if data:
+            await self.send_request_data(stream_id, data)
+
+    async def finish_recognize_stream(self, stream_id):
+        """ Ends a Recognize event started with start_recognize_stream. The response is not read in this function.
+
+        :param stream_id: stream_id returned by start_recognize_stream
+        :return: the stream_id associated with the request
+        """
+        # Waiting for the encoder to finish blocks, so it is done in a worker thread
+        rest = await asyncio.get_event_loop().run_in_executor(None, self.stream_encoders.pop(stream_id).finish)
+        await self.send_request_data(stream_id, [rest, self.get_closing_boundary()], final=True)
+        return stream_id
+
+    async def response_messages(self, stream_id):
+        """ Async generator, which returns each message of the response to a request as soon as it is complete.
+            An attachment is returned in the same message as the directive before it (as a binary string, once it
+            has been received completely).
+
+        :param stream_id: stream_id used for the request
+        """
+        response = await self.get_response(stream_id)
+
+        # If no content response, but things are OK, just return
+        if response.status == 204:
+            return
+        if response.status != 200:
+            print(await response.read())
+            raise NameError("Bad status (%s)" % response.status)
+
+        # The attachment is only returned once it is complete, so handlers never block the event loop reading it
+        assembler = alexa_communication.MessageAssembler(alexa_communication.get_boundary_from_response(response),
+                                                         stream_attachments=False)
+        async for chunk in response.read_chunked():
+            for message in assembler.feed(chunk):
+                yield message
+        for message in assembler.finish():
+            yield message
+
+    async def get_and_process_response(self, stream_id):
+        """ For a specified stream_id, get AVS's response and process each message using process_response_handle
+            as soon as it has arrived.
+
+        :param stream_id: stream_id used for the request
+        """
+        self.dialog_streams.pop(stream_id, None)
+        async for message in self.response_messages(stream_id):
+            result = self.process_response_handle(message)
+            if inspect.isawaitable(result):
+                await result
+
+    def process_response_async(self, stream_id):
+        """ Same as get_and_process_response, except this returns right away and the response is processed by a
+            separate task.
+
+        :param stream_id: stream_id used for the request
+        :return: asyncio.Task, which is done once the response has been processed
+        """
+        task = asyncio.ensure_future(self.get_and_process_response(stream_id))
+        task.add_done_callback(alexa_communication.report_response_error)
+        return task
+
+    async def send_event_async(self, header, payload=None, audio=None):
+        """ Sends an event, and leaves its response to a separate task (see process_response_async).
+
+        :param header: message header dictionary
+        :param payload: message payload dictionary
+        :param audio: raw binary string attachment
+        :return: asyncio.Task, which is done once the response has been processed
+        """
+        return self.process_response_async(await self.send_event(header, payload=payload, audio=audio))
+
+
+class AsyncAlarmManager(alexa_device.AlarmManager):
+    """ AlarmManager for an AsyncAlexaDevice. Alerts are scheduled on the event loop (which also uses a heap) instead
+        of the AlertScheduler thread.
+    """
+    def set_alert(self, token, alert_type, scheduled_time):
+        """ Called when a new alarm is to be added (from SetAlert directive). Must be called from the event loop. An
+            existing alarm with the same token is rescheduled.
+
+        :param token: token for the alarm
+        :param alert_type: alert type from the API
+        :param scheduled_time: scheduled time (UTC time as ISO string)
+        :return: boolean indicating success or failure
+        """
+        try:
+            time_difference = helper.get_timestamp_from_iso(scheduled_time) - time.time()
+            timer_handle = asyncio.get_event_loop().call_later(
+                time_difference, lambda: asyncio.ensure_future(self.start_alert(token)))
+            with self.lock:
+                alert = self.alerts.get(token)
+                if alert is None:
+                    alert = self.alerts[token] = {'stop_event': threading.Event()}
+                else:
+                    alert['timer_handle'].cancel()
+                alert['type'] = alert_type
+                alert['scheduled_time'] = scheduled_time
+                alert['timer_handle'] = timer_handle
+            self.invalidate_context()
+            print("Alarm set successfully.")
+        except:
+            print("Error setting alarm")
+            return False
+        return True
+
+    async def delete_alert(self, token):
+        """ Called when an alarm is to be deleted (from DeleteAlert directive). An alert is only deleted once.
+
+        :param token: token for the alarm
+        :return: boolean indicating success or failure
+        """
+        with self.lock:
+            alert = self.alerts.pop(token, None)
+            is_active = token in self.active_alerts
+            self.active_alerts.discard(token)
+        if alert is None:
+            print("Error deleting alarm")
+            return False
+        self.invalidate_context()
+
+        alert['timer_handle'].cancel()
+        if is_active:
+            print("Stopping alarm")
+            alert['stop_event'].set()
+            stream_id = await self.alexa_device.alexa.send_event_alert_name('AlertStopped', token)
+            self.alexa_device.alexa.process_response_async(stream_id)
+        print("Alarm deleted")
+        return True
+
+    async def start_alert(self, token):
+        """ Called (as a task) when the alarm is started.
+
+        :param token: token for active alarm
+        """
+        stop_event = self.activate_alert(token)
+        if stop_event is None:
+            return
+        print("Alarm started!")
+        alexa = self.alexa_device.alexa
+
+        # Send alert started to alexa (the alarm starts without waiting for the response)
+        alexa.process_response_async(await alexa.send_event_alert_name('AlertStarted', token))
+        # Play in foreground for 30 seconds, unless stopped
+        await self.alexa_device.play_wav('files/alarm.wav', timeout=30, stop_event=stop_event, repeat=True)
+        alexa.process_response_async(await alexa.send_event_alert_name('AlertEnteredForeground', token))
+
+        # If alert still exists (would exist if alarm is not cancelled)
+        if not stop_event.is_set():
+            await self.delete_alert(token)
+
+    def close(self):
+        """ Cancels all alerts.
+        """
+        with self.lock:
+            for alert in self.alerts.values():
+                alert['timer_handle'].cancel()
+                alert['stop_event'].set()
+            self.alerts = {}
+            self.active_alerts = set()
+
+
+class AsyncAlexaDevice(alexa_device.DeviceContextMixin):
+    """ asyncio version of AlexaDevice. The device is driven by the event loop (run), so many devices can share
+        one loop. Audio is played and captured through the async audio hooks (play_mp3, play_wav and capture_audio),
+        which use AlexaAudio in a worker thread by default and can be overridden. The context is kept the same way
+        as AlexaDevice's (see alexa_device.DeviceContextMixin).
+    """
+    def __init__(self, alexa_config, audio=None, **connection_kwargs):
+        """ Initialize the AsyncAlexaDevice using the config dictionary. The connection is not opened until run is
+            called.
+
+        :param alexa_config: config dictionary specific to the device
+        :param audio: (optional) audio used by the audio hooks, e.g. a session of an AlexaAudio shared with other
+                      devices (see AlexaAudio.create_session) or an alexa_audio.HeadlessAudio. If not specified,
+                      the device uses its own session of the AlexaAudio shared by the process
+                      (alexa_audio.get_shared_audio).
+        :param connection_kwargs: any other keyword arguments for AsyncAlexaConnection
+        """
+        self.config = alexa_config
+        if audio is None:
+            audio = alexa_audio.get_shared_audio().create_session()
+        self.alexa_audio_instance = audio
+        self.alarm_manager = AsyncAlarmManager(self.alexa_audio_instance)
+        self.alarm_manager.set_alexa_device(self)
+        self.context_store = alexa_device.create_context_store(self.alarm_manager)
+        self.alexa = AsyncAlexaConnection(self.config, context_handle=self.get_context,
+                                          process_response_handle=self.process_response, **connection_kwargs)
+
+    async def run(self):
+        """ Opens the connection and processes the downchannel directives until the device is closed.
+        """
+        await self.alexa.open()
+        await self.process_directives()
+
+    async def process_directives(self):
+        """ Processes the downchannel directives until the device is closed. The connection must be open.
+        """
+        async for message in self.alexa.directives():
+            try:
+                await self.process_response(message)
+            except:
+                traceback.print_exc()
+        print("Closing device.")
+
+    async def close(self):
+        """ Closes the AsyncAlexaDevice (run returns).
+        """
+        self.alarm_manager.close()
+        await self.alexa.close()
+
+    async def play_mp3(self, raw_audio):
+        """ Audio hook that plays a Speak attachment.
+
+        :param raw_audio: MP3 binary string
+        """
+        await asyncio.get_event_loop().run_in_executor(None, self.alexa_audio_instance.play_mp3, raw_audio)
+
+    async def play_wav(self, file, timeout=None, stop_event=None, repeat=False):
+        """ Audio hook that plays a wav file (e.g. an alarm). See AlexaAudio.play_wav for the arguments.
+        """
+        await asyncio.get_event_loop().run_in_executor(None, self.alexa_audio_instance.play_wav, file, timeout,
+                                                       stop_event, repeat)
+
+    async def capture_audio(self, timeout=None):
+        """ Audio hook, an async generator that returns each chunk of speech (16 kHz mono L16) while the user is
+            talking. Ends when the user stops talking, or if the user did not speak before the timeout.
+
+        :param timeout: (optional) timeout in seconds, when to give up if the user did not speak
+        """
+        loop = asyncio.get_event_loop()
+        chunks = asyncio.Queue()
+
+        def capture():
+            try:
+                self.alexa_audio_instance.stream_audio(
+                    lambda raw_audio: loop.call_soon_threadsafe(chunks.put_nowait, raw_audio), timeout)
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+        capture_future = loop.run_in_executor(None, capture)
+        while True:
+            raw_audio = await chunks.get()
+            if raw_audio is None:
+                break
+            yield raw_audio
+        await capture_future
+
+    async def user_initiate_audio(self):
+        """ Captures the user's speech, sends it to AVS and processes the response.
+        """
+        stream_id = await self.stream_recognize()
+        if stream_id is None:
+            return
+        await self.alexa.get_and_process_response(stream_id)
+
+    async def stream_recognize(self, timeout=None, dialog_request_id=None):
+        """ Same as AlexaDevice.stream_recognize, using the capture_audio hook.
+
+        :param timeout: (optional) timeout in seconds, when to give up if the user did not speak
+        :param dialog_request_id: (optional) previously used dialog_request_id
+        :return: the stream_id associated with the request, or None if the user did not speak
+        """
+        stream_id = None
+        async for raw_audio in self.capture_audio(timeout):
+            # Start the event with the first chunk of audio
+            if stream_id is None:
+                stream_id = await self.alexa.start_recognize_stream(dialog_request_id=dialog_request_id)
+            await self.alexa.send_recognize_audio(stream_id, raw_audio)
+        if stream_id is None:
+            return None
+        return await self.alexa.finish_recognize_stream(stream_id)
+
+    async def process_response(self, message):
+        """ Called when a message is received from Alexa (either on the downchannel or as a response). Same as
+            AlexaDevice.process_response.
+
+        :param message: message received from Alexa
+        """
+        print("%d messages received" % len(message['content']))
+
+        if 'content' not in message:
+            raise KeyError("Content is not available.")
+        if len(message['attachment']) > 1:
+            raise IndexError("Too many attachments (%d)" % len(message['attachment']))
+
+        if message['attachment']:
+            attachment = message['attachment'][0]
+        else:
+            attachment = None
+
+        for content in message['content']:
+            namespace = content['directive']['header']['namespace']
+            if namespace == 'SpeechSynthesizer':
+                await self.process_directive_speech_synthesizer(content, attachment)
+            elif namespace == 'SpeechRecognizer':
+                await self.process_directive_speech_recognizer(content, attachment)
+            elif namespace == 'Alerts':
+                await self.process_directive_alerts(content, attachment)
+            else:
+                raise NameError("Namespace not recognized (%s)." % namespace)
+
+    async def process_directive_speech_synthesizer(self, content, attachment):
+        """ Process a directive that belongs to the SpeechSynthesizer namespace.
+
+        :param content: content dictionary (contains header and payload)
+        :param attachment: attachment included with the content
+        """
+        header = content['directive']['header']
+        payload = content['directive']['payload']
+        name = header['name']
+
+        if name == 'Speak':
+            token = payload['token']
+            # Playback does not wait for the responses to SpeechStarted and SpeechFinished
+            self.alexa.process_response_async(await self.alexa.send_event_speech_started(token))
+            await self.play_mp3(attachment)
+            self.alexa.process_response_async(await self.alexa.send_event_speech_finished(token))
+        else:
+            raise NameError("Name not recognized (%s)." % name)
+
+    async def process_directive_speech_recognizer(self, content, attachment):
+        """ Process a directive that belongs to the SpeechRecognizer namespace.
+
+        :param content: content dictionary (contains header and payload)
+        :param attachment: attachment included with the content
+        """
+        header = content['directive']['header']
+        payload = content['directive']['payload']
+        name = header['name']
+
+        if name == 'ExpectSpeech':
+            dialog_request_id = header['dialogRequestId']
+            timeout = payload['timeoutInMilliseconds']/1000
+
+            stream_id = await self.stream_recognize(timeout, dialog_request_id=dialog_request_id)
+            # If stream_id is none, the user did not respond or speak
+            if stream_id is None:
+                print("Speech timeout.")
+                self.alexa.process_response_async(await self.alexa.send_event_expect_speech_timed_out())
+                return
+            await self.alexa.get_and_process_response(stream_id)
+        elif name == 'StopCapture':
+            pass
+        else:
+            raise NameError("Name not recognized (%s)." % name)
+
+    async def process_directive_alerts(self, content, attachment):
+        """ Process a directive that belongs to the Alert namespace.
+
+        :param content: content dictionary (contains header and payload)
+        :param attachment: attachment included with the content
+        """
+        header = content['directive']['header']
+        payload = content['directive']['payload']
+        name = header['name']
+        token = payload['token']
+
+        if name == 'SetAlert':
+            is_set = self.alarm_manager.set_alert(token, payload['type'], payload['scheduledTime'])
+            event_name = 'SetAlertSucceeded' if is_set else 'SetAlertFailed'
+            self.alexa.process_response_async(await self.alexa.send_event_alert_name(event_name, token))
+        elif name == 'DeleteAlert':
+            is_deleted = await self.alarm_manager.delete_alert(token)
+            event_name = 'DeleteAlertSucceeded' if is_deleted else 'DeleteAlertFailed'
+            self.alexa.process_response_async(await self.alexa.send_event_alert_name(event_name, token))
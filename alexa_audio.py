@@ -1,122 +1,810 @@
 
 import pyaudio
 import wave
-import subprocess
-import speech_recognition
-import time
+import collections
+import copy
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+
+import numpy
+
+import alexa_capture
+import alexa_decoder
+import alexa_mixer
+import alexa_timeline
+import alexa_vad
 
 __author__ = "NJC"
 __license__ = "MIT"
 
+# Format of the PCM produced when decoding MP3 responses
+MP3_DECODE_RATE = 24000
+MP3_DECODE_CHANNELS = 1
+# Gain of the other sounds (e.g. an alarm) while a Speak reply is playing
+TTS_DUCKING_GAIN = 0.3
+# Sample rate of the audio sent to AVS (16 bit, mono)
+AVS_RATE = 16000
+
+
+class WavAssetCache:
+    """ Keeps decoded WAV assets (e.g. files/alarm.wav) in memory, so a file is only read once and every AlexaAudio
+        object (and every alarm that is playing) shares the same frames. The frames can be memory-mapped from the file
+        instead of being read, in which case the operating system pages them in (and shares them between processes).
+        The samples played are only the mapped frames themselves if the file already has the format they are played
+        in (16 bit, the mixer's rate and channels), otherwise they are a converted copy that is kept with the asset.
+    """
+    def __init__(self, use_mmap=False):
+        """ Initialize the WavAssetCache (empty).
+
+        :param use_mmap: (optional) flag that indicates if the frames should be memory-mapped instead of read
+        """
+        self.use_mmap = use_mmap
+        self.lock = threading.Lock()
+        # Loaded assets (path: asset dictionary)
+        self.assets = {}
+
+    def get(self, file):
+        """ Gets a WAV asset, which is loaded the first time.
+
+        :param file: path to wave file
+        :return: asset dictionary (frames as a memoryview, sample_width, channels and rate)
+        """
+        with self.lock:
+            asset = self.assets.get(file)
+            if asset is None:
+                asset = self.assets[file] = self.load(file)
+            return asset
+
+    def get_samples(self, file, rate, channels):
+        """ Gets the frames of a WAV asset as 16-bit samples in a specific format (e.g. the mixer's). The asset is
+            loaded the first time, and converted the first time it is used in a format. Both are done with the lock
+            acquired, and the converted samples are kept with the asset, so every caller shares them.
+
+        :param file: path to wave file
+        :param rate: sample rate
+        :param channels: number of channels
+        :return: numpy int16 array of interleaved samples (read-only)
+        """
+        with self.lock:
+            asset = self.assets.get(file)
+            if asset is None:
+                asset = self.assets[file] = self.load(file)
+            samples = asset['samples'].get((rate, channels))
+            if samples is None:
+                samples = asset['samples'][(rate, channels)] = get_asset_samples(asset, rate, channels)
+            return samples
+
+    def load(self, file):
+        """ Reads (or memory-maps) the frames of a wave file.
+
+        :param file: path to wave file
+        :return: asset dictionary (frames as a memoryview, sample_width, channels and rate, and the samples
+                 converted so far)
+        """
+        with wave.open(file, 'rb') as wf:
+            asset = {
+                'sample_width': wf.getsampwidth(),
+                'channels': wf.getnchannels(),
+                'rate': wf.getframerate(),
+                'samples': {}
+            }
+            frame_count = wf.getnframes()
+            if not self.use_mmap:
+                asset['frames'] = memoryview(wf.readframes(frame_count))
+                return asset
+
+        frame_size = asset['sample_width'] * asset['channels']
+        with open(file, 'rb') as f:
+            file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = get_wav_data_offset(file_map)
+        asset['frames'] = memoryview(file_map)[offset:offset + frame_count * frame_size]
+        return asset
+
+    def clear(self):
+        """ Removes every asset from the cache (assets that are being played are not affected).
+        """
+        with self.lock:
+            self.assets = {}
+
+
+def get_wav_data_offset(data):
+    """ Finds where the frames of a wave file start (the content of its data chunk).
+
+    :param data: the whole wave file (binary string, or any bytes-like object)
+    :return: offset of the frames in bytes
+    """
+    # Skip the RIFF header, then every chunk until the data chunk
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = bytes(data[offset:offset + 4])
+        chunk_size = struct.unpack('<I', data[offset + 4:offset + 8])[0]
+        if chunk_id == b'data':
+            return offset + 8
+        # Chunks are padded to an even size
+        offset += 8 + chunk_size + (chunk_size & 1)
+    raise KeyError("Wave file has no data chunk.")
+
+
+# Assets shared by every AlexaAudio object
+wav_assets = WavAssetCache()
+
+
+def get_pcm_samples(frames, sample_width):
+    """ Gets the samples of PCM frames of any sample width, in the 16-bit range.
+
+    :param frames: binary string (or any bytes-like object) of whole frames
+    :param sample_width: bytes per sample (1 is unsigned, 2 to 4 are signed)
+    :return: numpy float32 array of interleaved samples
+    """
+    if sample_width == 1:
+        return (numpy.frombuffer(frames, dtype=numpy.uint8).astype(numpy.float32) - 128) * 256
+    if sample_width == 2:
+        return numpy.frombuffer(frames, dtype=numpy.int16).astype(numpy.float32)
+    if sample_width == 3:
+        # Little-endian 24-bit samples are placed in the top bytes of 32-bit samples, keeping the sign
+        packed = numpy.frombuffer(frames, dtype=numpy.uint8).reshape(-1, 3)
+        padded = numpy.zeros((len(packed), 4), dtype=numpy.uint8)
+        padded[:, 1:] = packed
+        return padded.view('<i4').reshape(-1).astype(numpy.float32) / 65536
+    if sample_width == 4:
+        return numpy.frombuffer(frames, dtype='<i4').astype(numpy.float32) / 65536
+    raise KeyError("Unsupported sample width (%d)." % sample_width)
+
+
+def get_asset_samples(asset, rate, channels):
+    """ Converts the frames of a WAV asset to 16-bit samples in a specific format (see WavAssetCache.get_samples). If
+        the asset already has the format, the samples are the frames themselves and nothing is copied.
+
+    :param asset: asset dictionary (see WavAssetCache)
+    :param rate: sample rate
+    :param channels: number of channels
+    :return: numpy int16 array of interleaved samples
+    """
+    if asset['sample_width'] == 2:
+        samples = numpy.frombuffer(asset['frames'], dtype=numpy.int16)
+        if (asset['rate'], asset['channels']) == (rate, channels):
+            return samples
+    else:
+        # The low bytes are dropped (8-bit WAV samples are unsigned)
+        samples = numpy.floor(get_pcm_samples(asset['frames'], asset['sample_width'])).astype(numpy.int16)
+    return alexa_mixer.convert_samples(samples, asset['rate'], asset['channels'], rate, channels)
+
+
+def new_mp3_hash():
+    """ Creates the hash that identifies an MP3 in the DecodedAudioCache. Update it with the MP3 data (all at once, or
+        chunk by chunk while it is received). The decoded format is part of the hash, so decoded audio kept on disk is
+        not reused if the format changes.
+
+    :return: hashlib hash object
+    """
+    return hashlib.sha256(b'%d-%d:' % (MP3_DECODE_RATE, MP3_DECODE_CHANNELS))
+
+
+class DecodedAudioCache:
+    """ Keeps the decoded PCM of MP3 responses, keyed by a hash of the MP3 data (see new_mp3_hash). Many Speak replies
+        are byte-identical (e.g. alert confirmations, or "Sorry, I didn't get that"), and those are only decoded once.
+        The least recently used entries are evicted once the decoded audio takes more than max_bytes. Entries can also
+        be written to a directory, where they are kept (across restarts) until that directory takes more than
+        max_disk_bytes. Entries found on disk are loaded back into memory.
+    """
+    def __init__(self, max_bytes=16 * 1024 * 1024, disk_path=None, max_disk_bytes=None):
+        """ Initialize the DecodedAudioCache (empty, apart from what is already on disk).
+
+        :param max_bytes: (optional) maximum number of bytes of decoded audio kept in memory (0 keeps nothing)
+        :param disk_path: (optional) directory the decoded audio is also written to (not used if not specified)
+        :param max_disk_bytes: (optional) maximum number of bytes of decoded audio kept in disk_path (no limit if not
+                               specified)
+        """
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self.max_disk_bytes = max_disk_bytes
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+
+        self.lock = threading.Lock()
+        # Decoded audio in memory, least recently used first (key: binary string)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # Statistics
+        self.hit_count = 0
+        self.disk_hit_count = 0
+        self.miss_count = 0
+        self.eviction_count = 0
+
+    def get_disk_file(self, key):
+        """ Gets the path of an entry on disk.
+
+        :param key: hex digest of the MP3's hash
+        :return: path of the file
+        """
+        return os.path.join(self.disk_path, key + '.pcm')
+
+    def get(self, key):
+        """ Gets the decoded audio of an MP3, from memory or from disk.
+
+        :param key: hex digest of the MP3's hash
+        :return: binary string of the decoded audio, or None if it is not in the cache
+        """
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hit_count += 1
+                return data
+
+        if self.disk_path is not None:
+            try:
+                with open(self.get_disk_file(key), 'rb') as file:
+                    data = file.read()
+                # Used recently (the oldest files are evicted first)
+                os.utime(self.get_disk_file(key))
+            except OSError:
+                data = None
+        with self.lock:
+            if data is None:
+                self.miss_count += 1
+                return None
+            self.disk_hit_count += 1
+            self.add_entry(key, data)
+        return data
+
+    def put(self, key, data):
+        """ Adds the decoded audio of an MP3 (to memory, and to disk if a disk path was specified).
+
+        :param key: hex digest of the MP3's hash
+        :param data: binary string of the decoded audio
+        """
+        with self.lock:
+            self.add_entry(key, data)
+        if self.disk_path is not None:
+            # Write to a temporary file first, so a partly written file is never read
+            temp_file = self.get_disk_file(key) + '.%d.tmp' % threading.get_ident()
+            try:
+                with open(temp_file, 'wb') as file:
+                    file.write(data)
+                os.replace(temp_file, self.get_disk_file(key))
+            except OSError as error:
+                print("Decoded audio not written to disk (%s)." % error)
+                return
+            if self.max_disk_bytes is not None:
+                self.evict_disk()
+
+    def add_entry(self, key, data):
+        """ Adds decoded audio to memory, and evicts the least recently used entries if needed. The lock must be held
+            by the caller.
+
+        :param key: hex digest of the MP3's hash
+        :param data: binary string of the decoded audio
+        """
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        # Audio that could never fit is not kept in memory
+        if len(data) > self.max_bytes:
+            return
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.eviction_count += 1
+
+    def evict_disk(self):
+        """ Deletes the least recently used files until the entries on disk take at most max_disk_bytes.
+        """
+        files = []
+        for entry in os.scandir(self.disk_path):
+            if entry.name.endswith('.pcm'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        disk_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if disk_size <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            disk_size -= size
+
+    def get_stats(self):
+        """ Gets the cache statistics.
+
+        :return: dictionary with the number of hits (in memory and on disk), misses, evictions, entries and bytes in
+                 memory, and the hit rate (None before the first lookup)
+        """
+        with self.lock:
+            lookups = self.hit_count + self.disk_hit_count + self.miss_count
+            return {
+                'hit_count': self.hit_count,
+                'disk_hit_count': self.disk_hit_count,
+                'miss_count': self.miss_count,
+                'eviction_count': self.eviction_count,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hit_rate': (self.hit_count + self.disk_hit_count) / lookups if lookups else None
+            }
+
+    def clear(self):
+        """ Removes every entry from memory (the entries on disk are kept).
+        """
+        with self.lock:
+            self.entries = collections.OrderedDict()
+            self.size = 0
+
+
+# Decoded MP3 responses shared by every AlexaAudio object (that does not specify its own cache)
+decoded_tts = DecodedAudioCache()
+
+
+class AudioConverter:
+    """ Converts captured audio of any rate, sample width and number of channels to the format AVS expects (16 kHz,
+        16 bit, mono), one chunk at a time. Channels are averaged, and the rate is converted with a polyphase
+        windowed-sinc filter (vectorized with numpy). The filter keeps its state between chunks, so the result does not
+        depend on how the audio is split into chunks.
+    """
+    def __init__(self, rate, channels=1, sample_width=2, to_rate=AVS_RATE, taps_per_phase=32):
+        """ Initialize the AudioConverter and design its filter.
+
+        :param rate: sample rate of the captured audio
+        :param channels: (optional) number of channels of the captured audio
+        :param sample_width: (optional) bytes per sample of the captured audio (1 is unsigned, 2 to 4 are signed)
+        :param to_rate: (optional) sample rate to convert to
+        :param taps_per_phase: (optional) filter length, in samples of the lower of the two rates (more taps reject
+                               more aliasing, but are slower). When downsampling, each phase is longer by the
+                               decimation ratio.
+        """
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.to_rate = to_rate
+        self.remainder = b''
+
+        # Upsample by up, filter, and downsample by down (only the output samples are computed)
+        divisor = math.gcd(rate, to_rate)
+        self.up = to_rate // divisor
+        self.down = rate // divisor
+        # The filter must span taps_per_phase samples of the lower rate, so it is sized to the larger of the two
+        # ratios (each phase uses every up-th tap)
+        self.phase_length = -(-taps_per_phase * max(self.up, self.down) // self.up)
+        tap_count = self.phase_length * self.up
+        # Cutoff just below the lower of the two Nyquist frequencies (in cycles per upsampled sample)
+        cutoff = 0.475 / max(self.up, self.down)
+        n = numpy.arange(tap_count) - (tap_count - 1) / 2
+        taps = 2 * cutoff * numpy.sinc(2 * cutoff * n) * numpy.blackman(tap_count) * self.up
+        # Phase p uses taps p, p + up, p + 2 * up, ... (one row per phase)
+        self.phases = taps.reshape(self.phase_length, self.up).T.astype(numpy.float32)
+
+        # Last input samples of the previous chunk (the filter's history), and the number of samples in and out
+        self.history = numpy.zeros(self.phase_length - 1, dtype=numpy.float32)
+        self.input_count = 0
+        self.output_count = 0
+
+    def get_samples(self, frames):
+        """ Converts frames of the captured format to mono samples.
+
+        :param frames: binary string of whole frames
+        :return: numpy float32 array of mono samples (in the 16-bit range)
+        """
+        samples = get_pcm_samples(frames, self.sample_width)
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels).mean(axis=1)
+        return samples
+
+    def resample(self, samples):
+        """ Resamples the next mono samples.
+
+        :param samples: numpy float32 array
+        :return: numpy float32 array of the output samples that could be computed
+        """
+        if self.up == 1 and self.down == 1:
+            return samples
+        signal = numpy.concatenate((self.history, samples))
+        # Index of the first sample of signal, counted from the start of the audio
+        signal_start = self.input_count - len(self.history)
+        self.input_count += len(samples)
+        self.history = signal[len(signal) - (self.phase_length - 1):]
+
+        # Output sample j is at upsampled position j * down, which needs input samples up to (j * down) // up
+        output_end = (self.input_count * self.up - 1) // self.down + 1
+        positions = numpy.arange(self.output_count, output_end, dtype=numpy.int64) * self.down
+        self.output_count = max(self.output_count, output_end)
+        if len(positions) == 0:
+            return numpy.zeros(0, dtype=numpy.float32)
+        newest = positions // self.up - signal_start
+        # Row j holds input samples newest[j], newest[j] - 1, ... (one per tap of the phase)
+        windows = signal[newest[:, numpy.newaxis] - numpy.arange(self.phase_length)]
+        return numpy.einsum('ij,ij->i', windows, self.phases[positions % self.up])
+
+    def convert(self, raw_audio):
+        """ Converts the next chunk of captured audio. Audio that does not fill a whole frame is kept for the next
+            call.
+
+        :param raw_audio: raw binary audio string in the captured format
+        :return: raw binary audio string (PCM, 16 bit, mono, at to_rate)
+        """
+        data = self.remainder + raw_audio
+        frame_bytes = self.sample_width * self.channels
+        frames_length = len(data) - len(data) % frame_bytes
+        self.remainder = data[frames_length:]
+        output = self.resample(self.get_samples(data[:frames_length]))
+        return numpy.clip(numpy.round(output), -32768, 32767).astype(numpy.int16).tobytes()
+
+    def flush(self):
+        """ Gets the end of the audio that is still held back by the filter (call once the capture is complete).
+
+        :return: raw binary audio string (PCM, 16 bit, mono, at to_rate)
+        """
+        if self.up == 1 and self.down == 1:
+            return b''
+        output = self.resample(numpy.zeros(self.phase_length // 2, dtype=numpy.float32))
+        return numpy.clip(numpy.round(output), -32768, 32767).astype(numpy.int16).tobytes()
+
+
+def hash_chunks(chunks, mp3_hash):
+    """ Passes on chunks of data, and adds each one to a hash as it goes by.
+
+    :param chunks: iterable of binary strings (e.g. an AttachmentStream)
+    :param mp3_hash: hashlib hash object (see new_mp3_hash)
+    :return: generator of the same chunks
+    """
+    for chunk in chunks:
+        mp3_hash.update(chunk)
+        yield chunk
+
 
 class AlexaAudio:
     """ This object handles all audio playback and recording required by the Alexa enabled device. Audio playback
         and recording both use the PyAudio package.
 
     """
-    def __init__(self):
+    def __init__(self, timeline=None, pre_roll=0.5, vad=None, capture_rate=AVS_RATE, capture_channels=1,
+                 capture_sample_width=2, tts_cache=None, decoder=None):
         """ AlexaAudio initialization function.
+
+        :param timeline: (optional) alexa_timeline.TimelineRecorder that records the capture and playback stages of
+                         each dialog (disabled if not specified)
+        :param pre_roll: (optional) seconds of audio from before speech was detected that are included in each
+                         capture
+        :param vad: (optional) alexa_vad.VoiceActivityDetector (or any object with reset, process and is_speaking)
+                    that detects when the user starts and stops speaking (created with the defaults if not specified)
+        :param capture_rate: (optional) sample rate the microphone captures at (e.g. 44100 or 48000)
+        :param capture_channels: (optional) number of channels the microphone captures
+        :param capture_sample_width: (optional) bytes per sample the microphone captures (e.g. 3 for 24 bit)
+        :param tts_cache: (optional) DecodedAudioCache of the decoded MP3 responses (the cache shared by every
+                          AlexaAudio object, decoded_tts, if not specified)
+        :param decoder: (optional) MP3 decoder backend (see alexa_decoder), which is started here and closed by the
+                        caller. By default the backend shared by every AlexaAudio object is used (see
+                        alexa_decoder.get_shared_decoder).
         """
         # Initialize pyaudio
         self.pyaudio_instance = pyaudio.PyAudio()
+        self.timeline = timeline if timeline is not None else alexa_timeline.TimelineRecorder()
+        # Every sound is played through one output stream, which is opened the first time a sound is played
+        self.mixer = alexa_mixer.AudioMixer(self.pyaudio_instance, rate=MP3_DECODE_RATE, channels=MP3_DECODE_CHANNELS)
+        self.mixer.set_ducking('tts', TTS_DUCKING_GAIN)
+        self.tts_cache = tts_cache if tts_cache is not None else decoded_tts
+        if decoder is None:
+            decoder = alexa_decoder.get_shared_decoder(rate=MP3_DECODE_RATE, channels=MP3_DECODE_CHANNELS)
+        else:
+            # Warm up the decoder before the first response arrives
+            decoder.start()
+        self.decoder = decoder
+        # The microphone is kept open once capturing starts, and its audio is converted to the format AVS expects
+        converter = None
+        if (capture_rate, capture_channels, capture_sample_width) != (AVS_RATE, 1, 2):
+            converter = AudioConverter(capture_rate, capture_channels, capture_sample_width)
+        self.capture = alexa_capture.CaptureEngine(self.pyaudio_instance, rate=AVS_RATE, device_rate=capture_rate,
+                                                   device_channels=capture_channels,
+                                                   device_sample_width=capture_sample_width, converter=converter)
+        self.pre_roll = pre_roll
+        self.vad = vad if vad is not None else alexa_vad.VoiceActivityDetector(rate=self.capture.rate)
 
     def close(self):
-        """ Called when the AlexaAudio object is no longer needed. This closes the PyAudio instance.
+        """ Called when the AlexaAudio object is no longer needed. This closes the microphone, the mixer and the PyAudio
+            instance.
         """
-        # Terminate the pyaudio instance
+        # Close the microphone and output stream, and terminate the pyaudio instance (the decoder is shared, or
+        # closed by whoever passed it)
+        self.capture.close()
+        self.mixer.close()
         self.pyaudio_instance.terminate()
 
+    def create_session(self, vad=None):
+        """ Creates the part of the AlexaAudio that is used by a single device, so that several devices can share
+            one AlexaAudio (see AudioSession).
+
+        :param vad: (optional) voice activity detector of the session (a copy of the AlexaAudio's own, if not
+                    specified)
+        :return: AudioSession object
+        """
+        return AudioSession(self, vad)
+
+    def start_capture(self):
+        """ Opens the microphone, which then stays open (see CaptureEngine). Capturing audio starts the capture engine
+            automatically, but starting it in advance means there is audio from before the first capture as well.
+        """
+        self.capture.start()
+
     def get_audio(self, timeout=None):
-        """ Get audio from the microphone. The SpeechRecognition package is used to automatically stop listening
-            when the user stops speaking. A timeout can also be specified. If the timeout is reached, the function
-            returns None.
+        """ Get audio from the microphone. Listening stops automatically when the user stops speaking (see
+            stream_audio). A timeout can also be specified. If the timeout is reached, the function returns None.
 
             This function can also be used for debugging purposes to read an example audio file.
 
         :param timeout: timeout in seconds, when to give up if the user did not speak.
-        :return: the raw binary audio string (PCM)
-        """
-        # Create a speech recognizer
-        r = speech_recognition.Recognizer()
-        # Open the microphone (and release is when done using "with")
-        with speech_recognition.Microphone() as source:
-            if timeout is None:
-                # Prompt user to say something
-                print("You can start talking now...")
-                # TODO add sounds to prompt the user to do something, rather than text
-                # Record audio until the user stops talking
-                audio = r.listen(source)
-            else:
-                print("Start talking now, you have %d seconds" % timeout)
-                # TODO add sounds to prompt the user to do something, rather than text
-                try:
-                    audio = r.listen(source, timeout=timeout)
-                except speech_recognition.WaitTimeoutError:
-                    return None
-        # Convert audio to raw_data (PCM)
-        raw_audio = audio.get_raw_data()
+        :return: the raw binary audio string (PCM, 16 kHz, 16 bit, mono)
+        """
+        # Record audio until the user stops talking
+        chunks = []
+        if not self.stream_audio(chunks.append, timeout):
+            return None
+        raw_audio = b''.join(chunks)
 
         # Rather than recording, read a pre-recorded example (for testing)
         # with open('files/example_get_time.pcm', 'rb') as f:
         #     raw_audio = f.read()
         return raw_audio
 
-    def play_mp3(self, raw_audio):
+    def stream_audio(self, audio_handle, timeout=None, vad=None):
+        """ Get audio from the microphone, and hand it over while the user is still talking. Once the user starts
+            speaking, audio_handle is called with each chunk of audio as soon as it is captured (the first call
+            includes the pre-roll, the audio from just before speech was detected, even if it was captured before
+            this function was called). Returns when the user stops speaking, as detected by the voice activity
+            detector (see VoiceActivityDetector).
+
+        :param audio_handle: function that is called with each raw binary audio string (PCM, 16 kHz, 16 bit, mono)
+        :param timeout: timeout in seconds, when to give up if the user did not speak.
+        :param vad: (optional) voice activity detector used instead of the AlexaAudio's own (see AudioSession)
+        :return: True if speech was captured, False if the timeout was reached
+        """
+        if vad is None:
+            vad = self.vad
+        # The microphone is kept open, capture starts from the current position (each caller reads from its own)
+        self.capture.start()
+        vad.reset()
+        chunk_bytes = self.capture.chunk * self.capture.sample_width
+        seconds_per_buffer = self.capture.chunk / self.capture.rate
+        position = self.capture.get_position()
+        # The dialogRequestId is not known yet, the marks are added to the next dialog
+        self.timeline.mark('capture_start')
+
+        if timeout is None:
+            # Prompt user to say something
+            print("You can start talking now...")
+        else:
+            print("Start talking now, you have %d seconds" % timeout)
+        # TODO add sounds to prompt the user to do something, rather than text
+
+        # Wait for speech to start
+        elapsed_time = 0
+        while not vad.is_speaking:
+            elapsed_time += seconds_per_buffer
+            if timeout is not None and elapsed_time > timeout:
+                return False
+            vad.process(self.capture.read(position, position + chunk_bytes))
+            position += chunk_bytes
+
+        self.timeline.mark('speech_detected')
+        # Hand over the pre-roll (kept by the capture engine) so the start of the first word is not lost
+        pre_roll_bytes = int(self.pre_roll * self.capture.rate) * self.capture.sample_width
+        audio_handle(self.capture.read(position - chunk_bytes - pre_roll_bytes, position))
+
+        # Hand over audio until the user stops talking
+        while vad.is_speaking:
+            buffer = self.capture.read(position, position + chunk_bytes)
+            position += chunk_bytes
+            audio_handle(buffer)
+            vad.process(buffer)
+        self.timeline.mark('capture_end')
+        return True
+
+    def play_mp3(self, raw_audio, dialog_request_id=None):
         """ Play an MP3 file. Alexa uses the MP3 format for all audio responses. PyAudio does not support this, so
-            the MP3 file must first be converted to a wave file before playing.
+            the MP3 data is passed to the decoder backend (see alexa_decoder), and the decoded PCM
+            is added to the mixer as soon as it comes out of the decoder (on the 'tts' channel). No intermediate files
+            are used, so multiple responses can be played at the same time. Returns when the audio has been played.
 
-            This function assumes ffmpeg is located in the current working directory (ffmpeg/bin/ffmpeg).
+            The decoded audio is kept in a DecodedAudioCache (keyed by a hash of the MP3), so a response that was
+            played before is not decoded again. Only complete MP3 data can be looked up. An attachment that is still
+            being received is hashed and decoded chunk by chunk as it arrives, and added to the cache once it ends.
 
-        :param raw_audio: the raw audio as a binary string
+            Without the miniaudio package, the default decoder assumes ffmpeg is located in the current working
+            directory (ffmpeg/bin/ffmpeg).
+
+        :param raw_audio: the raw audio as a binary string, or an iterable of binary strings (e.g. an
+                          AttachmentStream that is still being received)
+        :param dialog_request_id: (optional) dialogRequestId of the Speak directive, used to record the decode and
+                                  playback stages of the dialog's timeline
         """
-        # Save MP3 data to a file
-        with open("files/response.mp3", 'wb') as f:
-            f.write(raw_audio)
+        # An attachment that has already been received completely can be looked up before it is decoded
+        if not isinstance(raw_audio, bytes) and getattr(raw_audio, 'is_complete', False):
+            raw_audio = raw_audio.read()
+        mp3_hash = new_mp3_hash()
+        if isinstance(raw_audio, bytes):
+            mp3_hash.update(raw_audio)
+            decoded_audio = self.tts_cache.get(mp3_hash.hexdigest())
+            if decoded_audio is not None:
+                self.play_decoded_mp3(decoded_audio, dialog_request_id)
+                return
+        else:
+            # Each chunk is hashed as it is passed on to the decoder, the hash is complete once the decoder is done
+            raw_audio = hash_chunks(raw_audio, mp3_hash)
+
+        # Decode to raw PCM (pyaudio doesn't work with MP3 files)
+        decoded_audio = self.decoder.decode(raw_audio, chunk_bytes=1024 * MP3_DECODE_CHANNELS * 2)
+
+        # Play each chunk as soon as it is decoded (the mixer's format is the decoder's format)
+        source = self.mixer.add_source('tts')
+        decoded_chunks = []
+        is_decoded = True
+        try:
+            for data in decoded_audio:
+                if not decoded_chunks and dialog_request_id is not None:
+                    self.timeline.mark('playback_start', dialog_request_id)
+                decoded_chunks.append(data)
+                # Only the last chunk can end with half a sample
+                self.mixer.write(source, numpy.frombuffer(data[:len(data) - len(data) % 2], dtype=numpy.int16))
+        except EOFError as error:
+            print("MP3 not decoded completely (%s)." % error)
+            is_decoded = False
+        if dialog_request_id is not None:
+            if not decoded_chunks:
+                self.timeline.mark('playback_start', dialog_request_id)
+            self.timeline.mark('decode_done', dialog_request_id)
 
-        # Convert mp3 response to wave (pyaudio doesn't work with MP3 files)
-        subprocess.call(['ffmpeg/bin/ffmpeg', '-y', '-i', 'files/response.mp3', 'files/response.wav'],
-                        stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        # When done, wait until the mixer has played everything
+        self.mixer.finish(source)
+        source['done'].wait()
+        if dialog_request_id is not None:
+            self.timeline.mark('playback_end', dialog_request_id)
+        # Only audio that was decoded completely is kept (the hash covers the whole MP3 once it has been decoded)
+        if is_decoded and decoded_chunks:
+            self.tts_cache.put(mp3_hash.hexdigest(), b''.join(decoded_chunks))
 
-        # Play a wave file directly
-        self.play_wav('files/response.wav')
+    def play_decoded_mp3(self, decoded_audio, dialog_request_id=None):
+        """ Play an MP3 response that has already been decoded (see DecodedAudioCache). Returns when the audio has been
+            played.
+
+        :param decoded_audio: binary string of the decoded audio (PCM in the mixer's format)
+        :param dialog_request_id: (optional) dialogRequestId of the Speak directive, used to record the playback
+                                  stages of the dialog's timeline
+        """
+        samples = numpy.frombuffer(decoded_audio, dtype=numpy.int16, count=len(decoded_audio) // 2)
+        source = self.mixer.add_source('tts', samples)
+        if dialog_request_id is not None:
+            self.timeline.mark('playback_start', dialog_request_id)
+            self.timeline.mark('decode_done', dialog_request_id)
+        source['done'].wait()
+        if dialog_request_id is not None:
+            self.timeline.mark('playback_end', dialog_request_id)
 
     def play_wav(self, file, timeout=None, stop_event=None, repeat=False):
-        """ Play a wave file using PyAudio. The file must be specified as a path.
+        """ Play a wave file through the mixer (on the 'alerts' channel). The file must be specified as a path. The
+            file is only read once, its frames are kept in memory (see WavAssetCache) and played from there. Returns
+            when the file has been played, or the playback was stopped.
 
         :param file: path to wave file
+        :param timeout: (optional) maximum playback time in seconds
+        :param stop_event: (optional) threading.Event that stops the playback when set
+        :param repeat: (optional) flag that indicates if the file should be played in a loop (until the timeout or
+                       the stop event)
         """
-        # Open wave wave
-        with wave.open(file, 'rb') as wf:
-            # Create pyaudio stream
-            stream = self.pyaudio_instance.open(
-                        format=self.pyaudio_instance.get_format_from_width(wf.getsampwidth()),
-                        channels=wf.getnchannels(),
-                        rate=wf.getframerate(),
-                        output=True)
-
-            # Set chunk size for playback
-            chunk = 1024
-
-            # Get start time
-            start_time = time.mktime(time.gmtime())
-
-            end = False
-            while not end:
-                # Read first chunk of data
-                data = wf.readframes(chunk)
-                # Continue until there is no data left
-                while len(data) > 0 and not end:
-                    if timeout is not None and time.mktime(time.gmtime())-start_time > timeout:
-                        end = True
-                    if stop_event is not None and stop_event.is_set():
-                        end = True
-                    stream.write(data)
-                    data = wf.readframes(chunk)
-                if not repeat:
-                    end = True
-                else:
-                    wf.rewind()
-
-        # When done, stop stream and close
-        stream.stop_stream()
-        stream.close()
+        samples = wav_assets.get_samples(file, self.mixer.rate, self.mixer.channels)
+        source = self.mixer.add_source('alerts', samples, loop=repeat, timeout=timeout, stop_event=stop_event)
+        source['done'].wait()
+
+
+class AudioSession:
+    """ A single device's part of an AlexaAudio that is shared by several devices (see AlexaAudio.create_session).
+        The PyAudio instance, the microphone, the mixer and the decoder are shared, but each session has its own
+        voice activity detector, so devices that capture at the same time do not reset or feed each other's
+        endpointing. (Each capture already reads the shared microphone from its own position.)
+    """
+    def __init__(self, audio, vad=None):
+        """ Initialize the AudioSession.
+
+        :param audio: shared AlexaAudio object
+        :param vad: (optional) voice activity detector of the session (a copy of the AlexaAudio's own, if not
+                    specified)
+        """
+        self.audio = audio
+        if vad is None:
+            # Same settings as the shared detector, with its own state
+            vad = copy.copy(audio.vad)
+            vad.reset()
+        self.vad = vad
+
+    def start_capture(self):
+        """ Same as AlexaAudio.start_capture (the microphone is shared).
+        """
+        self.audio.start_capture()
+
+    def stream_audio(self, audio_handle, timeout=None):
+        """ Same as AlexaAudio.stream_audio, with the session's voice activity detector.
+        """
+        return self.audio.stream_audio(audio_handle, timeout, vad=self.vad)
+
+    def play_mp3(self, raw_audio, dialog_request_id=None):
+        """ Same as AlexaAudio.play_mp3.
+        """
+        self.audio.play_mp3(raw_audio, dialog_request_id)
+
+    def play_wav(self, file, timeout=None, stop_event=None, repeat=False):
+        """ Same as AlexaAudio.play_wav.
+        """
+        self.audio.play_wav(file, timeout, stop_event, repeat)
+
+    def close(self):
+        """ Nothing to close, the shared AlexaAudio is closed by its owner.
+        """
+        pass
+
+
+class HeadlessAudio:
+    """ Replaces AlexaAudio for devices that run without a microphone or speaker (e.g. the sessions of a fleet). It
+        creates no PyAudio instance, mixer or decoder. Nothing is played (playback returns right away), and no speech
+        is ever captured.
+    """
+    def create_session(self, vad=None):
+        """ Nothing is kept per session, so every session is the HeadlessAudio itself.
+
+        :param vad: (optional) ignored
+        :return: HeadlessAudio object
+        """
+        return self
+
+    def start_capture(self):
+        """ There is no microphone.
+        """
+        pass
+
+    def stream_audio(self, audio_handle, timeout=None):
+        """ There is no microphone, so the user never speaks.
+
+        :param audio_handle: function that would be called with the audio (never called)
+        :param timeout: (optional) ignored
+        :return: False
+        """
+        return False
+
+    def play_mp3(self, raw_audio, dialog_request_id=None):
+        """ Nothing is played. An attachment that is still being received is read to the end, so it is released.
+
+        :param raw_audio: MP3 binary string, or an iterable of binary strings
+        :param dialog_request_id: (optional) ignored
+        """
+        if not isinstance(raw_audio, bytes):
+            for _ in raw_audio:
+                pass
+
+    def play_wav(self, file, timeout=None, stop_event=None, repeat=False):
+        """ Nothing is played.
+        """
+        pass
+
+    def close(self):
+        """ Nothing to close.
+        """
+        pass
+
+
+# AlexaAudio shared by every device in the process that does not have its own (see get_shared_audio)
+shared_audio = None
+shared_audio_lock = threading.Lock()
+
+
+def get_shared_audio():
+    """ Gets the AlexaAudio shared by every device in the process, which is created the first time. Each device
+        should use its own session of it (see AlexaAudio.create_session).
+
+    :return: AlexaAudio object
+    """
+    global shared_audio
+    with shared_audio_lock:
+        if shared_audio is None:
+            shared_audio = AlexaAudio()
+        return shared_audio
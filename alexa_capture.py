@@ -0,0 +1,128 @@
+import threading
+
+import pyaudio
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+class CaptureEngine:
+    """ Keeps the microphone open and writes everything it captures into a fixed-size ring buffer. Readers follow the
+        capture using positions (the number of bytes captured since the engine was started), and can read audio from
+        before they started (e.g. the pre-roll before speech was detected), as long as it is still in the buffer.
+        Capturing therefore starts instantly, without opening the device again.
+
+        If the microphone does not capture 16 bit mono audio at the engine's rate, a converter (e.g.
+        alexa_audio.AudioConverter) converts the audio before it is written to the ring buffer.
+    """
+    def __init__(self, pyaudio_instance, rate=16000, chunk=1024, buffer_seconds=10, device_rate=None,
+                 device_channels=1, device_sample_width=2, converter=None):
+        """ Initialize the CaptureEngine. The microphone is not opened until start is called.
+
+        :param pyaudio_instance: pyaudio.PyAudio object
+        :param rate: (optional) sample rate of the ring buffer (16 bit, mono)
+        :param chunk: (optional) number of frames read at a time
+        :param buffer_seconds: (optional) seconds of audio kept in the ring buffer
+        :param device_rate: (optional) sample rate the microphone is opened with (the engine's rate if not
+                            specified)
+        :param device_channels: (optional) number of channels the microphone is opened with
+        :param device_sample_width: (optional) bytes per sample the microphone is opened with
+        :param converter: (optional) object with a convert function, which converts the captured audio to 16 bit
+                          mono at the engine's rate (required if the microphone captures another format)
+        """
+        self.pyaudio_instance = pyaudio_instance
+        self.rate = rate
+        self.chunk = chunk
+        self.sample_width = 2
+        self.device_rate = device_rate if device_rate is not None else rate
+        self.device_channels = device_channels
+        self.device_sample_width = device_sample_width
+        self.converter = converter
+
+        self.condition = threading.Condition()
+        self.buffer = bytearray(int(buffer_seconds * rate) * self.sample_width)
+        # Number of bytes captured so far (the position of the next byte)
+        self.write_position = 0
+        self.stream = None
+        self.is_closed = False
+
+    def start(self):
+        """ Opens the microphone, if it is not open yet.
+        """
+        with self.condition:
+            if self.stream is not None:
+                return
+            self.is_closed = False
+            self.stream = self.pyaudio_instance.open(
+                format=self.pyaudio_instance.get_format_from_width(self.device_sample_width),
+                channels=self.device_channels, rate=self.device_rate, input=True,
+                frames_per_buffer=int(self.chunk * self.device_rate / self.rate),
+                stream_callback=self.stream_callback)
+
+    def stream_callback(self, in_data, frame_count, time_info, status):
+        """ Called by PyAudio with each chunk of captured audio.
+        """
+        if self.converter is not None:
+            in_data = self.converter.convert(in_data)
+        self.write(in_data)
+        return None, pyaudio.paContinue
+
+    def write(self, data):
+        """ Adds captured audio to the ring buffer, overwriting the oldest audio.
+
+        :param data: raw binary audio string (PCM)
+        """
+        capacity = len(self.buffer)
+        with self.condition:
+            position = self.write_position
+            self.write_position += len(data)
+            # Only the end of the data is kept if it does not fit
+            if len(data) > capacity:
+                position += len(data) - capacity
+                data = data[len(data) - capacity:]
+            offset = position % capacity
+            first_length = min(len(data), capacity - offset)
+            self.buffer[offset:offset + first_length] = data[:first_length]
+            self.buffer[:len(data) - first_length] = data[first_length:]
+            self.condition.notify_all()
+
+    def get_position(self):
+        """ Gets the current position of the capture.
+
+        :return: number of bytes captured so far
+        """
+        with self.condition:
+            return self.write_position
+
+    def read(self, start, end):
+        """ Reads audio from the ring buffer. Waits until the audio up to end has been captured. If start is no longer
+            in the buffer (or before the first byte), the audio is read from the oldest byte that is.
+
+        :param start: position of the first byte
+        :param end: position after the last byte
+        :return: raw binary audio string (PCM)
+        """
+        capacity = len(self.buffer)
+        with self.condition:
+            while self.write_position < end:
+                if self.is_closed:
+                    raise EOFError("Capture engine is closed.")
+                self.condition.wait()
+            start = max(start, self.write_position - capacity, 0)
+            if start >= end:
+                return b''
+            offset = start % capacity
+            first_length = min(end - start, capacity - offset)
+            return bytes(self.buffer[offset:offset + first_length]) + bytes(self.buffer[:end - start - first_length])
+
+    def close(self):
+        """ Closes the microphone. Any reader waiting for audio is woken up.
+        """
+        with self.condition:
+            stream = self.stream
+            self.stream = None
+            self.is_closed = True
+            self.condition.notify_all()
+        if stream is not None:
+            stream.stop_stream()
+            stream.close()
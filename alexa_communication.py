@@ -1,10 +1,18 @@
 
 import time
 import calendar
+import collections
+import concurrent.futures
+import itertools
 import json
-import requests
+import queue
 import threading
-from hyper import HTTP20Connection
+import traceback
+
+import alexa_encoder
+import alexa_timeline
+import alexa_token
+import http2_connection
 
 __author__ = "NJC"
 __license__ = "MIT"
@@ -58,7 +66,7 @@ def parse_response(response):
         function. The stream should not be closed until this function call is
         completed.
 
-    :param response: the hyper.HTTP20Response object
+    :param response: the http2_connection.HTTP2Response object
     :return: message dictionary, which contains 'content' and 'attachment' lists
     """
     boundary = get_boundary_from_response(response)
@@ -69,6 +77,54 @@ def parse_response(response):
     # Returned the resulting message after parsing data
     return parse_data(data, boundary)
 
+def read_response_messages(response, messages, mark=None):
+    """ Reads and parses the response while it is being received, and puts a message dictionary in the messages
+        queue for each directive as soon as it is available. An attachment is put in the same message as the
+        directive before it, as an AttachmentStream, as soon as its header has been received. None is put in the
+        queue when the response is complete (an exception is put in the queue first, if anything went wrong).
+
+    :param response: the http2_connection.HTTP2Response object
+    :param messages: queue.Queue that receives the message dictionaries
+    :param mark: (optional) function that records a stage of the dialog's timeline (first_response_byte and
+                 parse_done)
+    """
+    assembler = None
+    try:
+        assembler = MessageAssembler(get_boundary_from_response(response))
+        is_first_chunk = True
+        for chunk in response.read_chunked(decode_content=False):
+            if is_first_chunk and mark is not None:
+                mark('first_response_byte')
+            is_first_chunk = False
+            for message in assembler.feed(chunk):
+                messages.put(message)
+        for message in assembler.finish():
+            messages.put(message)
+        if mark is not None:
+            mark('parse_done')
+    except Exception as e:
+        messages.put(e)
+    finally:
+        # Never leave a reader of the attachment waiting
+        if assembler is not None:
+            assembler.close()
+        messages.put(None)
+
+
+def report_response_error(future):
+    """ Done callback for the futures returned by AlexaConnection.process_response_async. Nobody may be waiting on
+        the future, so any error is printed rather than lost.
+
+    :param future: concurrent.futures.Future that is done
+    """
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        print("Error processing response:")
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+
 def split_message(data, boundary):
     """ Split the message into it separate parts based on the boundary.
 
@@ -84,6 +140,69 @@ def split_message(data, boundary):
     return message_parts
 
 
+def new_message():
+    """ Creates an empty message dictionary, which is filled in as message parts are parsed.
+
+    :return: message dictionary, which contains empty 'content' and 'attachment' lists
+    """
+    return {'content': [], 'attachment': []}
+
+
+def split_part(part):
+    """ Splits a single message part into its header and content. Only the first blank line separates the two, so
+        binary content is allowed to contain blank lines.
+
+    :param part: raw message part (everything between two boundaries)
+    :return: (header, content) header is stripped of white space, content has only the trailing line break removed
+    """
+    message_header, separator, message_content = part.partition(b'\r\n\r\n')
+    # If there is no blank line, there is no way to tell the header from the content
+    if not separator:
+        raise NameError("Sub-message is missing a header (%d bytes)" % len(part))
+    # The line break before the next boundary belongs to the boundary, not the content
+    if message_content.endswith(b'\r\n'):
+        message_content = message_content[:-2]
+    return message_header.strip(), message_content
+
+
+def get_content_type(message_header):
+    """ Finds the content type in the header of a message part.
+
+    :param message_header: header of the message part
+    :return: binary string of the content type
+    """
+    # Find start and stop of content-type
+    content_type_start = message_header.find(b'Content-Type: ')+14
+    content_type_end = message_header[content_type_start:].find(b'\r\n')
+    # If no end index was found, just go to the end
+    if content_type_end == -1:
+        content_type = message_header[content_type_start:]
+    else:
+        content_type = message_header[content_type_start:content_type_start+content_type_end]
+    return content_type
+
+
+def add_part_to_message(message, message_header, message_content):
+    """ Adds a single parsed message part to the message dictionary. JSON parts are added to 'content' and octet
+        stream parts are added to 'attachment'.
+
+    :param message: message dictionary, which contains 'content' and 'attachment' lists
+    :param message_header: header of the message part
+    :param message_content: content of the message part
+    """
+    content_type = get_content_type(message_header)
+
+    # Check the content type, should be json or octet
+    if content_type == b'application/json; charset=UTF-8' or content_type == b'application/json':
+        # If JSON, add to content
+        message['content'].append(json.loads(message_content.decode()))
+    elif content_type == b'application/octet-stream':
+        # If octet stream, add to attachment
+        message['attachment'].append(message_content)
+    else:
+        raise NameError("Content type not recognized (%s)" % content_type.decode())
+
+
 def parse_data(data, boundary):
     """ The function parses tha actual data that was read form the response. All
         that is needed in addition to the data, is the boundary specified in the
@@ -97,82 +216,565 @@ def parse_data(data, boundary):
     message_parts = split_message(data, boundary)
 
     # Initialize message dictionary
-    message = dict()
-    # Set content and attachment keys to empty lists
-    message['content'] = []
-    message['attachment'] = []
+    message = new_message()
     # For each message part
     for part in message_parts:
-        # Split based on blank line, this separates header and content
-        message_chunk = part.split(b'\r\n\r\n')
-        # If there are more than 2 chunks, throw an error (not sure if this is 100% correct)
-        if len(message_chunk) != 2:
-            raise NameError("Too many parts to the sub-message! (%s)" % len(message_chunk))
-        # The first part is the header, the second is content. Strip both of white spaces.
-        message_header = message_chunk[0].strip()
-        message_content = message_chunk[1].strip()
-
-        # Find start and stop of content-type
-        content_type_start = message_header.find(b'Content-Type: ')+14
-        content_type_end = message_header[content_type_start:].find(b'\r\n')
-        # If no end index was found, just go to the end
-        if content_type_end == -1:
-            content_type = message_header[content_type_start:]
-        else:
-            content_type = message_header[content_type_start:content_type_start+content_type_end]
-
-        # Check the content type, should be json or octet
-        if content_type == b'application/json; charset=UTF-8' or content_type == b'application/json':
-            # If JSON, add to content
-            message['content'].append(json.loads(message_content.decode()))
-        elif content_type == b'application/octet-stream':
-            # If octet stream, add to attachment
-            message['attachment'].append(message_content)
-        else:
-            raise NameError("Content type not recognized (%s)" % content_type.decode())
+        # Only the first blank line separates header and content, so binary attachments are kept intact
+        message_header, message_content = split_part(part)
+        add_part_to_message(message, message_header, message_content)
 
     return message
 
 
-class AlexaConnection:
+class StreamingMultipartParser:
+    """ Incremental parser for multipart message bodies, which returns attachment (octet stream) parts while they
+        are still being received. All other parts are returned once they are complete. Data that has already been
+        searched for the boundary is never searched again, and only the unfinished part is kept.
+
+        The feed function returns a list of events (tuples), in the order they happened:
+
+            ('part', header, content)   a complete part that is not an attachment
+            ('attachment', header)      the header of an attachment part was received
+            ('data', content)           more content of the current attachment part
+            ('end',)                    the current attachment part is complete
+    """
+    def __init__(self, boundary):
+        """ Initialize the parser with the boundary used in the message (as found by get_boundary_from_response).
+
+        :param boundary: boundary used in message
+        """
+        self.delimiter = b'--' + boundary
+        # Unparsed data, always starts at the beginning of the current part (or its content, once the header has
+        # been parsed)
+        self.buffer = bytearray()
+        self.search_index = 0
+        self.in_part = False
+        # Header of the current part (None until the whole header has been received)
+        self.header = None
+        self.is_attachment = False
+        self.check_closing = False
+        self.is_finished = False
+
+    def feed(self, data):
+        """ Adds newly received data to the parser and returns the events caused by it.
+
+        :param data: binary string of newly received data
+        :return: list of event tuples (see StreamingMultipartParser)
+        """
+        events = []
+        if self.is_finished:
+            return events
+        self.buffer += data
+
+        delimiter_length = len(self.delimiter)
+        while True:
+            # The two bytes after a delimiter tell the closing delimiter apart from a normal one
+            if self.check_closing:
+                if len(self.buffer) < 2:
+                    break
+                if self.buffer[:2] == b'--':
+                    self.is_finished = True
+                    self.buffer = bytearray()
+                    break
+                self.check_closing = False
+
+            # Parse the header as soon as it is complete
+            if self.in_part and self.header is None:
+                header_end = self.buffer.find(b'\r\n\r\n')
+                if header_end != -1 and self.buffer.find(self.delimiter, 0, header_end) == -1:
+                    self.header = bytes(self.buffer[:header_end]).strip()
+                    del self.buffer[:header_end+4]
+                    self.search_index = 0
+                    self.is_attachment = get_content_type(self.header) == b'application/octet-stream'
+                    if self.is_attachment:
+                        events.append(('attachment', self.header))
+
+            index = self.buffer.find(self.delimiter, self.search_index)
+            if index == -1:
+                # Hand over attachment content, except what could still be the line break and delimiter
+                if self.is_attachment and len(self.buffer) > delimiter_length + 2:
+                    content_end = len(self.buffer) - delimiter_length - 2
+                    events.append(('data', bytes(self.buffer[:content_end])))
+                    del self.buffer[:content_end]
+                    self.search_index = 0
+                # If there is no delimiter, only the last few bytes can still be the start of one
+                self.search_index = max(self.search_index, len(self.buffer) - delimiter_length + 1)
+                break
+
+            if self.in_part:
+                content = bytes(self.buffer[:index])
+                if self.header is None:
+                    events.append(('part',) + split_part(content))
+                else:
+                    # The line break before the delimiter belongs to the delimiter, not the content
+                    if content.endswith(b'\r\n'):
+                        content = content[:-2]
+                    if self.is_attachment:
+                        if content:
+                            events.append(('data', content))
+                        events.append(('end',))
+                    else:
+                        events.append(('part', self.header, content))
+            self.in_part = True
+            self.header = None
+            self.is_attachment = False
+
+            # Drop the parsed data, so the next part starts at the beginning of the buffer
+            del self.buffer[:index+delimiter_length]
+            self.search_index = 0
+            self.check_closing = True
+        return events
+
+
+class MultipartParser:
+    """ Incremental parser for multipart message bodies. Data is fed in as it arrives (in chunks of any size), and
+        each part is returned exactly once, as soon as the boundary that ends it has been received. This is a
+        StreamingMultipartParser whose attachment content is collected until the attachment is complete.
+    """
+    def __init__(self, boundary):
+        """ Initialize the parser with the boundary used in the message (as found by get_boundary_from_response).
+
+        :param boundary: boundary used in message
+        """
+        self.parser = StreamingMultipartParser(boundary)
+        # Header and content received so far of the current attachment part
+        self.attachment_header = None
+        self.attachment_content = []
+
+    @property
+    def is_finished(self):
+        """ True once the closing delimiter (--boundary--) has been received.
+        """
+        return self.parser.is_finished
+
+    def feed(self, data):
+        """ Adds newly received data to the parser and returns any parts that were completed by it.
+
+        :param data: binary string of newly received data
+        :return: list of (header, content) tuples, one for each completed part (see split_part)
+        """
+        parts = []
+        for event in self.parser.feed(data):
+            if event[0] == 'part':
+                parts.append((event[1], event[2]))
+            elif event[0] == 'attachment':
+                self.attachment_header = event[1]
+                self.attachment_content = []
+            elif event[0] == 'data':
+                self.attachment_content.append(event[1])
+            elif event[0] == 'end':
+                parts.append((self.attachment_header, b''.join(self.attachment_content)))
+                self.attachment_header = None
+                self.attachment_content = []
+        return parts
+
+
+class MessageAssembler:
+    """ Assembles the parts of a response into message dictionaries, while the response is being received (using a
+        StreamingMultipartParser). Each directive starts a new message, and an attachment is added to the message of
+        the directive before it. A directive's message is complete once the next part starts (or the response ends).
+
+        If stream_attachments is True, a message with an attachment is complete as soon as the attachment's header
+        has been received, and the attachment is an AttachmentStream that is still being received. Otherwise the
+        message is complete once the whole attachment has been received, and the attachment is a binary string.
+    """
+    def __init__(self, boundary, stream_attachments=True):
+        """ Initialize the MessageAssembler.
+
+        :param boundary: boundary used in message (as found by get_boundary_from_response)
+        :param stream_attachments: (optional) flag that indicates if attachments are returned while they are being
+                                   received
+        """
+        self.parser = StreamingMultipartParser(boundary)
+        self.stream_attachments = stream_attachments
+        # Directive waiting to see if the next part is its attachment
+        self.message = None
+        # Message whose attachment is being received, and the attachment (AttachmentStream, or list of chunks)
+        self.attachment_message = None
+        self.attachment = None
+
+    def feed(self, data):
+        """ Adds newly received data, and returns the messages that were completed by it.
+
+        :param data: binary string of newly received data
+        :return: list of message dictionaries, which contain 'content' and 'attachment' lists
+        """
+        messages = []
+        for event in self.parser.feed(data):
+            if event[0] == 'part':
+                if self.message is not None:
+                    messages.append(self.message)
+                self.message = new_message()
+                add_part_to_message(self.message, event[1], event[2])
+            elif event[0] == 'attachment':
+                message = self.message if self.message is not None else new_message()
+                self.message = None
+                if self.stream_attachments:
+                    self.attachment = AttachmentStream()
+                    message['attachment'].append(self.attachment)
+                    messages.append(message)
+                else:
+                    self.attachment = []
+                    self.attachment_message = message
+            elif event[0] == 'data':
+                if self.stream_attachments:
+                    self.attachment.write(event[1])
+                else:
+                    self.attachment.append(event[1])
+            elif event[0] == 'end':
+                if self.stream_attachments:
+                    self.attachment.close()
+                else:
+                    self.attachment_message['attachment'].append(b''.join(self.attachment))
+                    messages.append(self.attachment_message)
+                    self.attachment_message = None
+                self.attachment = None
+        return messages
+
+    def finish(self):
+        """ Called once the whole response has been received.
+
+        :return: list of the messages that were still waiting (the last directive, if it had no attachment)
+        """
+        messages = []
+        if self.message is not None:
+            messages.append(self.message)
+            self.message = None
+        return messages
+
+    def close(self):
+        """ Closes an attachment that is still being received (e.g. the response failed), so its reader does not
+            wait forever.
+        """
+        if self.stream_attachments and self.attachment is not None:
+            self.attachment.close()
+        self.attachment = None
+
+
+class AttachmentStream:
+    """ An attachment that is still being received. The data can be read while it arrives by iterating over the
+        object (each iteration returns the next chunk of data, and blocks until it is available), or all at once
+        using read.
+    """
+    def __init__(self):
+        """ Initialize an empty attachment.
+        """
+        self.chunks = collections.deque()
+        self.condition = threading.Condition()
+        self.is_complete = False
+
+    def write(self, data):
+        """ Adds newly received data to the attachment. Called by the thread reading the response.
+
+        :param data: binary string of newly received data
+        """
+        with self.condition:
+            self.chunks.append(data)
+            self.condition.notify_all()
+
+    def close(self):
+        """ Marks the attachment as complete (no more data will be written).
+        """
+        with self.condition:
+            self.is_complete = True
+            self.condition.notify_all()
+
+    def __iter__(self):
+        """ Returns each chunk of data as soon as it is received, until the attachment is complete.
+        """
+        while True:
+            with self.condition:
+                while not self.chunks and not self.is_complete:
+                    self.condition.wait()
+                if not self.chunks:
+                    return
+                data = self.chunks.popleft()
+            yield data
+
+    def read(self):
+        """ Waits until the attachment is complete and returns all of the data that has not been read yet.
+
+        :return: binary string of the attachment
+        """
+        return b''.join(self)
+
+
+class AlexaConnectionBase:
+    """ The parts of a connection to the alexa voice services that do not depend on how the requests are sent
+        (unique IDs, event bodies and the API specific events). Used by AlexaConnection and
+        alexa_async.AsyncAlexaConnection.
+    """
+    def __init__(self, config, context_handle, boundary='this-is-my-boundary', token_manager=None, timeline=None,
+                 audio_encoder=None):
+        """ Initialize the fields shared by all connections. See AlexaConnection for the arguments.
+
+        :param config: a configuration dictionary containing the Client_ID, Client_Secret,
+                       and refresh_token.
+        :param context_handle: this is a pointer to the function that can supply the
+                               device's context (a list of dictionaries, or a JSON binary string). See AVS
+                               context docs for more info.
+        :param boundary: (optional) the boundary used to separate header and context in
+                         each message
+        :param token_manager: (optional) alexa_token.TokenManager that supplies the tokens. If not specified, one is
+                              created (and started) for the config, and stopped when the connection is closed.
+        :param timeline: (optional) alexa_timeline.TimelineRecorder that records the stages of each dialog (disabled
+                         if not specified)
+        :param audio_encoder: (optional) function (e.g. an encoder class from alexa_encoder) that creates the encoder
+                              of each Recognize event's audio, by default the audio is sent as is
+                              (alexa_encoder.PCMEncoder)
+        """
+        # Authentication and device identification configuration variables
+        self.client_id = config['Client_ID']
+        self.client_secret = config['Client_Secret']
+        self.refresh_token = config['refresh_token']
+        # Tokens are refreshed in the background (so requests do not wait for the token endpoint)
+        self.owns_token_manager = token_manager is None
+        if token_manager is None:
+            token_manager = alexa_token.TokenManager(self.client_id, self.client_secret, self.refresh_token)
+            token_manager.start()
+        self.token_manager = token_manager
+
+        self.boundary = boundary
+        self.context_handle = context_handle
+        # Seconds since epoch time when connection was created (used for message and dialog ID)
+        self.start_time = calendar.timegm(time.gmtime())
+        # Events are sent from several threads, next() on a count is atomic so no two events get the same ID
+        self.message_counter = itertools.count()
+        self.dialog_counter = itertools.count()
+
+        self.timeline = timeline if timeline is not None else alexa_timeline.TimelineRecorder()
+        self.audio_encoder = audio_encoder if audio_encoder is not None else alexa_encoder.PCMEncoder
+        # Encoder of each Recognize event that is being streamed (stream_id: encoder)
+        self.stream_encoders = {}
+        # dialogRequestId of each Recognize request whose response has not been read yet (stream_id: dialog_id)
+        self.dialog_streams = {}
+
+    def get_unique_message_id(self):
+        """ Gets a unique message_id for each message sent to the server. This is built from the connection's
+            start time and the current message count. The format is as follows:
+
+                njc_message_id-{start_time}-{message_count}
+
+            where start_time is when the connection was opened (seconds since epoch) and message_count is the
+            current message count for the instance.
+
+        :return: a unique message_id
+        """
+        # Take the next message count, to keep track of number of message_ids requested
+        message_id = "njc_message_id-%d-%d" % (
+            self.start_time, next(self.message_counter))
+        return message_id
+
+    def get_unique_dialog_id(self):
+        """ Gets a unique dialog_id for each message sent to the server. This is built from the connection's
+            start time and the current dialog count. The format is as follows:
+
+                njc_dialog_id-{start_time}-{message_count}
+
+            where start_time is when the connection was opened (seconds since epoch) and dialog_count is the
+            current message count for the instance.
+
+        :return: a unique dialog_id
+        """
+        message_id = "njc_dialog_id-%d-%d" % (
+            self.start_time, next(self.dialog_counter))
+        return message_id
+
+    def get_event_metadata(self, header, payload=None):
+        """ Creates the metadata (JSON) part of an event's body, including the boundary that ends it. Adds a unique
+            message_id to the header.
+
+        :param header: message header dictionary
+        :param payload: message payload dictionary
+        :return: binary string of the metadata part
+        """
+        if payload is None:
+            payload = {}
+        # Add message ID to header
+        header['messageId'] = self.get_unique_message_id()
+        event = {
+            "header": header,
+            "payload": payload
+        }
+        # The context is spliced in as is if it is already serialized (see alexa_context.ContextStore)
+        context = self.context_handle()
+        if not isinstance(context, bytes):
+            context = json.dumps(context).encode()
+
+        # Header used to indicate that the content is JSON
+        start_json = '--%s\nContent-Disposition: form-data; name="metadata"\n' \
+                     'Content-Type: application/json; charset=UTF-8\n\n' % self.boundary
+        return b''.join([start_json.encode(), b'{"context": ', context, b', "event": ', json.dumps(event).encode(),
+                         b'}--', self.boundary.encode()])
+
+    def get_audio_part_header(self):
+        """ Gets the start of the audio (attachment) part of an event's body. The audio follows directly after.
+
+        :return: binary string of the audio part header
+        """
+        start_audio = '--%s\nContent-Disposition: form-data; name="audio"\n' \
+                      'Content-Type: application/octet-stream\n\n' % self.boundary
+        return ("\n" + start_audio).encode()
+
+    def get_closing_boundary(self):
+        """ Gets the boundary that ends an event's body.
+
+        :return: binary string of the closing boundary
+        """
+        return ("--" + self.boundary + "--").encode()
+
+    def get_event_body(self, header, payload=None, audio=None):
+        """ Gets the body of an event as a list of buffers (metadata, audio part header, audio and closing boundary),
+            so the audio is handed to the HTTP/2 connection without being copied into one binary string.
+
+        :param header: message header dictionary
+        :param payload: message payload dictionary
+        :param audio: raw binary string (or any bytes-like object) attachment, or a list of them (sent one after the
+                      other)
+        :return: list of binary strings
+        """
+        body = [self.get_event_metadata(header, payload)]
+        if audio is not None:
+            body.append(self.get_audio_part_header())
+            body += audio if isinstance(audio, list) else [audio]
+        body.append(self.get_closing_boundary())
+        return body
+
+    def get_recognize_event(self, dialog_request_id=None, audio_format="AUDIO_L16_RATE_16000_CHANNELS_1"):
+        """ Gets the header and payload of a SpeechRecognizer.Recognize event.
+
+        :param dialog_request_id: (optional) previously used dialog_request_id, a new one is generated if not
+                                  specified
+        :param audio_format: (optional) format of the audio (the encoder's audio_format)
+        :return: (header, payload) dictionaries
+        """
+        # If dialog_request_id is not specified, generate a new unique one
+        if dialog_request_id is None:
+            dialog_request_id = self.get_unique_dialog_id()
+        self.timeline.start(dialog_request_id)
+
+        # Set required payload and header
+        payload = {
+            "profile": "CLOSE_TALK",
+            "format": audio_format
+        }
+        header = {
+            'namespace': 'SpeechRecognizer',
+            'name': 'Recognize',
+            'dialogRequestId': dialog_request_id
+        }
+        return header, payload
+
+    def send_event_speech_started(self, token):
+        """ API specific function that sends the SpeechSynthesizer.SpeechStarted event. The response is not read
+        in this function.
+
+        :param token: token for the current Speak directive
+        :return: the stream_id associated with the request
+        """
+        header = {
+            'namespace': "SpeechSynthesizer",
+            'name': "SpeechStarted"
+        }
+        payload = {'token': token}
+        stream_id = self.send_event(header, payload=payload)
+        return stream_id
+
+    def send_event_speech_finished(self, token):
+        """ API specific function that sends the SpeechSynthesizer.SpeechFinished event. The response is not read
+        in this function.
+
+        :param token: token for the current Speak directive
+        :return: the stream_id associated with the request
+        """
+        header = {
+            'namespace': "SpeechSynthesizer",
+            'name': "SpeechFinished"
+        }
+        payload = {'token': token}
+        stream_id = self.send_event(header, payload=payload)
+        return stream_id
+
+    def send_event_expect_speech_timed_out(self):
+        """ API specific function that sends the SpeechRecognizer.ExpectSpeechTimedOut event. The response is not
+            read in this function.
+
+        :return: the stream_id associated with the request
+        """
+        header = {
+            'namespace': 'SpeechRecognizer',
+            'name': 'ExpectSpeechTimedOut'
+        }
+        stream_id = self.send_event(header)
+        return stream_id
+
+    def send_event_alert_name(self, name, token):
+        """ API specific function that sends a event within the Alerts namespace. The response is not read in
+            this function.
+
+        :param name: name of event within the Alerts namesapce
+        :param token: token for alert
+        :return: the stream_id associated with the request
+        """
+        header = {
+            'namespace': 'Alerts',
+            'name': name
+        }
+        payload = {'token': token}
+        stream_id = self.send_event(header, payload=payload)
+        return stream_id
+
+
+class AlexaConnection(AlexaConnectionBase):
     """ This object manages the connection to the alexa voice services. Any communication
         related functions should be added to this object.
     """
-    def __init__(self, config, context_handle, process_response_handle, boundary='this-is-my-boundary'):
+    def __init__(self, config, context_handle, process_response_handle, boundary='this-is-my-boundary',
+                 url='avs-alexa-na.amazon.com', port=443, secure=True, blocking_downstream=True, token_manager=None,
+                 response_workers=4, timeline=None, audio_encoder=None):
         """ Initialize the AlexaConnection. Requires configuration values and a context
             function handle. Boundary is an optional argument.
 
         :param config: a configuration dictionary containing the Client_ID, Client_Secret,
                        and refresh_token.
         :param context_handle: this is a pointer to the function that can supply the
-                               device's context. See AVS context docs for more info.
+                               device's context (a list of dictionaries, or a JSON binary string). See AVS
+                               context docs for more info.
         :param boundary: (optional) the boundary used to separate header and context in
                          each message
+        :param url: (optional) host name of the AVS endpoint (e.g. a local stand-in server)
+        :param port: (optional) port of the AVS endpoint
+        :param secure: (optional) flag that indicates if TLS should be used
+        :param blocking_downstream: (optional, default=True) flag that indicates if the downchannel thread should
+                                    wait on the stream and process each directive as soon as it arrives, rather
+                                    than checking for new data every 0.5 seconds
+        :param token_manager: (optional) alexa_token.TokenManager that supplies the tokens. If not specified, one is
+                              created (and started) for the config, and stopped when the connection is closed.
+        :param response_workers: (optional) number of background threads that wait for and process the responses
+                                 of events sent with send_event_async (the number of such events in flight)
+        :param timeline: (optional) alexa_timeline.TimelineRecorder that records the stages of each dialog (disabled
+                         if not specified)
+        :param audio_encoder: (optional) function (e.g. an encoder class from alexa_encoder) that creates the encoder
+                              of each Recognize event's audio, by default the audio is sent as is
+                              (alexa_encoder.PCMEncoder)
 
             Related links:
                 https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/context
 
         """
-        # Authentication and device identification configuration variables
-        self.latest_token = None
-        self.latest_token_time = None
-        self.client_id = config['Client_ID']
-        self.client_secret = config['Client_Secret']
-        self.refresh_token = config['refresh_token']
+        AlexaConnectionBase.__init__(self, config, context_handle, boundary, token_manager, timeline, audio_encoder)
 
         # Fields used to generate the actual request
-        self.url = 'avs-alexa-na.amazon.com'
-        self.boundary = boundary
-        self.context_handle = context_handle
-        # Seconds since epoch time when connection was created (used for message and dialog ID)
-        self.start_time = calendar.timegm(time.gmtime())
-        self.message_counter = 0
-        self.dialog_counter = 0
+        self.url = url
+        self.port = port
+        self.secure = secure
 
-        # Thread related variables
-        self.lock = threading.Lock()
+        # Thread related variables (the HTTP/2 connection is thread-safe, so no lock is needed to use it)
         self.thread_stop_event = threading.Event()
         self.process_response_handle = process_response_handle
+        self.blocking_downstream = blocking_downstream
+        # Responses to events sent with send_event_async are processed by these workers
+        self.response_executor = concurrent.futures.ThreadPoolExecutor(max_workers=response_workers)
 
         # Calls the function to initialize the alexa connection
         self.init_connection()
@@ -185,7 +787,7 @@ class AlexaConnection:
 
         """
         # Open connection
-        self.connection = HTTP20Connection(self.url, port=443, secure=True, force_proto="h2", enable_push=True)
+        self.connection = http2_connection.HTTP2Connection(self.url, port=self.port, secure=self.secure)
 
         # First start downstream
         self.start_downstream()
@@ -204,23 +806,16 @@ class AlexaConnection:
         ping_thread = threading.Thread(target=self.ping_thread)
         ping_thread.start()
 
-    def start_downstream(self, lock=False):
-        """ Starts the downstream channel thread. Lock should only be True if this function is
-            called from a thread object.
-
-        :param lock: boolean indicating if locking should be used
+    def start_downstream(self):
+        """ Starts the downstream channel thread.
         """
-        if lock:
-            self.lock.acquire()
         # Start by sending a "GET" /directives to open downchannel stream
         self.downstream_id = self.send_request('GET', '/directives')
-        downstream_response = self.get_response(self.downstream_id)
-        if downstream_response.status != 200:
-            print(downstream_response.read())
-            raise NameError("Bad status (%s)" % downstream_response.status)
-        self.downstream_boundary = get_boundary_from_response(downstream_response)
-        if lock:
-            self.lock.release()
+        self.downstream_response = self.get_response(self.downstream_id)
+        if self.downstream_response.status != 200:
+            print(self.downstream_response.read())
+            raise NameError("Bad status (%s)" % self.downstream_response.status)
+        self.downstream_boundary = get_boundary_from_response(self.downstream_response)
 
         downstream_thread = threading.Thread(target=self.downstream_thread)
         downstream_thread.start()
@@ -229,23 +824,44 @@ class AlexaConnection:
         """ Downstream channel thread, which continuously monitors the stream for new data. Data
             is automatically parsed when an entire message is recieved.
         """
-        actual_stream = self.connection.streams[self.downstream_id]
+        parser = MultipartParser(self.downstream_boundary)
+        if self.blocking_downstream:
+            self.read_downstream_blocking(parser)
+            return
 
         # Loop continuously waiting for stop event to be set
-        while not self.thread_stop_event.is_set():
-            # Only do stuff if there is data ready in the stream
-            if len(actual_stream.data) > 1:
-                # self.lock.acquire()
-                # Get data from the downstream
-                new_data, actual_stream.data = read_from_downstream(self.downstream_boundary, actual_stream.data)
-
-                if len(new_data) > 0:
-                    message = parse_data(new_data, self.downstream_boundary)
-                    # TODO somehow message ends up being empty
-                    self.process_response_handle(message)
+        while not self.thread_stop_event.is_set() and not self.downstream_response.is_complete:
+            message = new_message()
+            # Feed each new chunk of data to the parser exactly once
+            for chunk in self.downstream_response.read_available():
+                for message_header, message_content in parser.feed(chunk):
+                    add_part_to_message(message, message_header, message_content)
+
+            # Only process the message if a complete part was received
+            if message['content'] or message['attachment']:
+                self.process_response_handle(message)
             # Check for new data every 0.5 seconds
             time.sleep(0.5)
 
+    def read_downstream_blocking(self, parser):
+        """ Reads the downchannel stream by waiting until new data arrives. Each message is processed as soon as
+            the last byte of its part has been received. Returns when the stream or the connection is closed.
+
+        :param parser: MultipartParser used for the downchannel stream
+        """
+        for chunk in self.downstream_response.read_chunked():
+            message = new_message()
+            for message_header, message_content in parser.feed(chunk):
+                add_part_to_message(message, message_header, message_content)
+            if message['content'] or message['attachment']:
+                self.process_response_handle(message)
+        print("Closing downstream thread.")
+
+    def close_connection(self):
+        """ Closes the HTTP/2 connection, which also stops the downstream thread.
+        """
+        self.connection.close()
+
     def ping_thread(self):
         """ This functions runs as a thread, and will send a ping request every 4 minutes. This ping
             request is required to maintain a connection when the system is idle. If ping fails, the
@@ -260,9 +876,7 @@ class AlexaConnection:
             # If anything goes wrong, reset the connection
             except:
                 print("Ping not successful.")
-                self.lock.acquire()
-                self.connection.close()
-                self.lock.release()
+                self.close_connection()
                 # Reinitialize the connection
                 self.init_connection()
                 break
@@ -272,9 +886,7 @@ class AlexaConnection:
                 print(data.read())
                 print("Ping not successful.")
                 # Close connection
-                self.lock.acquire()
-                self.connection.close()
-                self.lock.release()
+                self.close_connection()
                 # Reinitialize the connection
                 self.init_connection()
                 break
@@ -290,72 +902,30 @@ class AlexaConnection:
         """ Closes the connection and stops the ping thread.
         """
         self.thread_stop_event.set()
-        self.lock.acquire()
-        self.connection.close()
-        self.lock.release()
-
-    def get_unique_message_id(self):
-        """ Gets a unique message_id for each message sent to the server. This is built from the connection's
-            start time and the current message count. The format is as follows:
-
-                njc_message_id-{start_time}-{message_count}
-
-            where start_time is when the connection was opened (seconds since epoch) and message_count is the
-            current message count for the instance.
-
-        :return: a unique message_id
-        """
-        message_id = "njc_message_id-%d-%d" % (
-            self.start_time, self.message_counter)
-        # Increment message counter, to keep track of number of message_ids requested
-        self.message_counter += 1
-        return message_id
-
-    def get_unique_dialog_id(self):
-        """ Gets a unique dialog_id for each message sent to the server. This is built from the connection's
-            start time and the current dialog count. The format is as follows:
-
-                njc_dialog_id-{start_time}-{message_count}
+        self.response_executor.shutdown(wait=False)
+        self.close_connection()
+        if self.owns_token_manager:
+            self.token_manager.stop()
 
-            where start_time is when the connection was opened (seconds since epoch) and dialog_count is the
-            current message count for the instance.
+    def get_current_token(self):
+        """ A token is required for authentication purposes on any request send to the AVS. The token manager uses the
+            refresh_token provided by the configuration file to keep an up to date communication token. This is
+            necessary since the token expires every 3600 seconds. The token is refreshed in the background before it
+            expires, so this only waits for a new token if there is no valid one.
 
-        :return: a unique dialog_id
+        :return: a valid token
         """
-        message_id = "njc_dialog_id-%d-%d" % (
-            self.start_time, self.dialog_counter)
-        self.dialog_counter += 1
-        return message_id
+        return self.token_manager.get_token()
 
-    def get_current_token(self):
-        """ A token is required for authentication purposes on any request send to the AVS. This function uses the
-            refresh_token provided by the configuration file to get an up to date communication token. This is
-            necessary since the token expires every 3600 seconds. A new token is requested every 3570 seconds.
+    def get_request_headers(self):
+        """ Gets the HTTP/2 headers used for every request (authorization and content type).
 
-        :return: a valid token
+        :return: header dictionary
         """
-        # Get current time
-        current_time = time.mktime(time.gmtime())
-        # If there is no latest token, or the latest token is more than 3570 seconds old
-        if (self.latest_token is None) or (current_time - self.latest_token_time) > 3570:
-            payload = {
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-                "refresh_token": self.refresh_token,
-                "grant_type": "refresh_token",
-            }
-            # Request new token
-            url = "https://api.amazon.com/auth/o2/token"
-            r = requests.post(url, data=payload)
-            resp = json.loads(r.text)
-            token = resp['access_token']
-            # Set new latest token and latest token time
-            self.latest_token = token
-            self.latest_token_time = current_time
-        # Otherwise, just use latest token
-        else:
-            token = self.latest_token
-        return token
+        return {
+            'authorization': 'Bearer %s' % self.get_current_token(),
+            'content-type': 'multipart/form-data; boundary=%s' % self.boundary
+        }
 
     def send_request(self, method, path, body=None, path_version=True):
         """ Makes sending a request easy for the end-user. Most of the deails are hidden away inside of this function.
@@ -365,29 +935,45 @@ class AlexaConnection:
 
         :param method: string HTTP/2 method (e.g. 'GET')
         :param path: string of the desired path, by default is added to /v20160207 to get the full path
-        :param body: (optional) message content to send
+        :param body: (optional) message content to send (binary string, or a list of binary strings)
         :param path_version: (optional, default=True) flag that indicates if the version should be added to the full
                              path.
         :return: stream_id for the request
         """
         # Get headers
-        headers = {
-            'authorization': 'Bearer %s' % self.get_current_token(),
-            'content-type': 'multipart/form-data; boundary=%s' % self.boundary
-        }
+        headers = self.get_request_headers()
         # If path_version is true, add version to path
         if path_version:
             path = '/v20160207' + path
 
         # Send actual request
-        self.lock.acquire()
-        if body is not None:
-            stream_id = self.connection.request(method, path, headers=headers, body=body)
-        else:
-            stream_id = self.connection.request(method, path, headers=headers)
-        self.lock.release()
+        return self.connection.request(method, path, headers=headers, body=body)
 
-        return stream_id
+    def start_request(self, method, path, body, path_version=True):
+        """ Same as send_request, except the request's stream is left open after the body is sent. The rest of the
+            body is sent using send_request_data.
+
+        :param method: string HTTP/2 method (e.g. 'GET')
+        :param path: string of the desired path, by default is added to /v20160207 to get the full path
+        :param body: start of the message content
+        :param path_version: (optional, default=True) flag that indicates if the version should be added to the full
+                             path.
+        :return: stream_id for the request
+        """
+        headers = self.get_request_headers()
+        if path_version:
+            path = '/v20160207' + path
+
+        return self.connection.request(method, path, headers=headers, body=body, final=False)
+
+    def send_request_data(self, stream_id, data, final=False):
+        """ Sends more of the body for a request started with start_request.
+
+        :param stream_id: stream_id for the request
+        :param data: binary string (or a list of binary strings) to send
+        :param final: (optional, default=False) flag that indicates if this is the end of the body
+        """
+        self.connection.send(stream_id, data, final=final)
 
     def send_event(self, header, payload=None, audio=None):
         """ Send an event allows for a higher level of abstraction compared to send_request. The AVS message header
@@ -396,86 +982,96 @@ class AlexaConnection:
 
         :param header: message header dictionary
         :param payload: message payload dictionary
-        :param audio: raw binary string attachment
+        :param audio: raw binary string attachment, or a list of buffers (see get_event_body)
         :return: stream_id associated with the request
         """
-        if payload is None:
-            payload = {}
-        # Add message ID to header
-        header['messageId'] = self.get_unique_message_id()
-        body_dict = {
-            "context": self.context_handle(),
-            "event": {
-                "header": header,
-                "payload": payload
-            }
-        }
-
-        # Headers used to indicate if the content is JSON or audio
-        start_json = '--%s\nContent-Disposition: form-data; name="metadata"\n' \
-                     'Content-Type: application/json; charset=UTF-8\n\n' % self.boundary
-        start_audio = '--%s\nContent-Disposition: form-data; name="audio"\n' \
-                      'Content-Type: application/octet-stream\n\n' % self.boundary
-
-        # Create body string, and add json data
-        body_string = (start_json + json.dumps(body_dict) + "--" + self.boundary).encode()
-        # If raw audio exists, add that as well to the body strring
-        if audio is not None:
-            body_string += ("\n" + start_audio).encode() + audio
-        # Add final boundary
-        body_string += ("--" + self.boundary + "--").encode()
+        # Create the body (json data, raw audio if it exists, and final boundary) without joining the parts
+        body = self.get_event_body(header, payload, audio)
 
         # Send request and return stream_id
-        return self.send_request('GET', '/events', body=body_string)
+        return self.send_request('GET', '/events', body=body)
 
     def get_response(self, stream_id):
-        """ Get a response from the HTTP/2 connection. Current version of hyper requires locking if threads are used.
-            Otherwise, this function would not be needed.
+        """ Get a response from the HTTP/2 connection. Only the calling thread waits for the response, requests and
+            responses on other streams are not blocked while waiting.
 
         :param stream_id: stream_id used to get the response
-        :return: the resulting response object (hyper.HTTP20Response)
+        :return: the resulting response object (http2_connection.HTTP2Response)
         """
-        self.lock.acquire()
-        result = self.connection.get_response(stream_id)
-        self.lock.release()
-        return result
+        return self.connection.get_response(stream_id)
 
     def start_recognize_event(self, raw_audio, dialog_request_id=None):
         """ Starts a SpeechRecognizer.Recognize event. Requires a raw_audio argument. The optional dialog_request_id
             can be used to indicate that the recognize event is related to a previous one.The response is not read in
             this function.
 
-        :param raw_audio: raw binary string audio attachment
+        :param raw_audio: raw binary string (or any bytes-like object) audio attachment (PCM, encoded by the
+                          connection's audio encoder)
         :param dialog_request_id: (optional) previously used dialog_request_id
         :return: the stream_id associated with the request
         """
-        # If dialog_request_id is not specified, generate a new unique one
-        if dialog_request_id is None:
-            dialog_request_id = self.get_unique_dialog_id()
-
-        # Set required payload and header
-        payload = {
-            "profile": "CLOSE_TALK",
-            "format": "AUDIO_L16_RATE_16000_CHANNELS_1"
-        }
-        header = {
-            'namespace': 'SpeechRecognizer',
-            'name': 'Recognize',
-            'dialogRequestId': dialog_request_id
-        }
+        encoder = self.audio_encoder()
+        header, payload = self.get_recognize_event(dialog_request_id, encoder.audio_format)
+        # The encoded audio and the rest of it are sent as separate buffers, so neither is copied
+        audio = [encoder.encode(raw_audio), encoder.finish()]
         # Send the event to alexa
-        stream_id = self.send_event(header, payload=payload, audio=raw_audio)
+        stream_id = self.send_event(header, payload=payload, audio=audio)
+        self.dialog_streams[stream_id] = header['dialogRequestId']
+        self.timeline.mark('request_sent', header['dialogRequestId'])
         # Return
         return stream_id
 
+    def start_recognize_stream(self, dialog_request_id=None):
+        """ Starts a SpeechRecognizer.Recognize event whose audio is sent while it is being captured. The metadata
+            and the start of the audio part are sent right away. Audio is then sent using send_recognize_audio, and
+            the event is ended using finish_recognize_stream. The response is not read in this function.
+
+        :param dialog_request_id: (optional) previously used dialog_request_id
+        :return: the stream_id associated with the request
+        """
+        # The audio is encoded while it streams
+        encoder = self.audio_encoder()
+        header, payload = self.get_recognize_event(dialog_request_id, encoder.audio_format)
+        body_start = self.get_event_metadata(header, payload=payload) + self.get_audio_part_header()
+        stream_id = self.start_request('GET', '/events', body_start)
+        self.dialog_streams[stream_id] = header['dialogRequestId']
+        self.stream_encoders[stream_id] = encoder
+        return stream_id
+
+    def send_recognize_audio(self, stream_id, raw_audio):
+        """ Sends the next chunk of audio for a Recognize event started with start_recognize_stream.
+
+        :param stream_id: stream_id returned by start_recognize_stream
+        :param raw_audio: raw binary string audio (PCM)
+        """
+        data = self.stream_encoders[stream_id].encode(raw_audio)
+        if data:
+            self.send_request_data(stream_id, data)
+
+    def finish_recognize_stream(self, stream_id):
+        """ Ends the audio of a Recognize event started with start_recognize_stream, which also ends the request.
+            The response is not read in this function.
+
+        :param stream_id: stream_id returned by start_recognize_stream
+        :return: the stream_id associated with the request
+        """
+        encoder = self.stream_encoders.pop(stream_id)
+        self.send_request_data(stream_id, [encoder.finish(), self.get_closing_boundary()], final=True)
+        self.timeline.mark('request_sent', self.dialog_streams.get(stream_id))
+        return stream_id
+
     def get_and_process_response(self, stream_id):
         """ For a specified stream_id, get AVS's response and process it. The request must have been sent before calling
             this function.
 
+            The response is parsed while it is being received. Each directive is processed as soon as it has
+            arrived, and its attachment (if any) is passed on as an AttachmentStream that is still being received.
+
         :param stream_id: stream_id used for the request
         """
         # Get the response
         response = self.get_response(stream_id)
+        dialog_request_id = self.dialog_streams.pop(stream_id, None)
 
         # If no content response, but things are OK, just return
         if response.status == 204:
@@ -486,65 +1082,43 @@ class AlexaConnection:
             print(response.read())
             raise NameError("Bad status (%s)" % response.status)
 
-        # Take the response, and parse it
-        message = parse_response(response)
-        self.process_response_handle(message)
-
-    def send_event_speech_started(self, token):
-        """ API specific function that sends the SpeechSynthesizer.SpeechStarted event. The response is not read
-        in this function.
-
-        :param token: token for the current Speak directive
-        :return: the stream_id associated with the request
-        """
-        header = {
-            'namespace': "SpeechSynthesizer",
-            'name': "SpeechStarted"
-        }
-        payload = {'token': token}
-        stream_id = self.send_event(header, payload=payload)
-        return stream_id
-
-    def send_event_speech_finished(self, token):
-        """ API specific function that sends the SpeechSynthesizer.SpeechFinished event. The response is not read
-        in this function.
-
-        :param token: token for the current Speak directive
-        :return: the stream_id associated with the request
-        """
-        header = {
-            'namespace': "SpeechSynthesizer",
-            'name': "SpeechFinished"
-        }
-        payload = {'token': token}
-        stream_id = self.send_event(header, payload=payload)
-        return stream_id
+        # Only the responses to Recognize events are part of a dialog's timeline
+        mark = None
+        if dialog_request_id is not None:
+            mark = lambda stage: self.timeline.mark(stage, dialog_request_id)
+
+        # Read and parse the response in a separate thread, and process each message as soon as it is ready
+        messages = queue.Queue()
+        reader_thread = threading.Thread(target=read_response_messages, args=(response, messages, mark))
+        reader_thread.start()
+        while True:
+            message = messages.get()
+            if message is None:
+                break
+            if isinstance(message, Exception):
+                raise message
+            self.process_response_handle(message)
+        reader_thread.join()
 
-    def send_event_expect_speech_timed_out(self):
-        """ API specific function that sends the SpeechRecognizer.ExpectSpeechTimedOut event. The response is not
-            read in this function.
+    def process_response_async(self, stream_id):
+        """ Same as get_and_process_response, except the response is waited for and processed by a background
+            worker. This returns right away, so the caller (e.g. audio playback) does not wait for the round trip.
+            Several responses can be in flight at the same time.
 
-        :return: the stream_id associated with the request
+        :param stream_id: stream_id used for the request
+        :return: concurrent.futures.Future, which is done once the response has been processed
         """
-        header = {
-            'namespace': 'SpeechRecognizer',
-            'name': 'ExpectSpeechTimedOut'
-        }
-        stream_id = self.send_event(header)
-        return stream_id
+        future = self.response_executor.submit(self.get_and_process_response, stream_id)
+        future.add_done_callback(report_response_error)
+        return future
 
-    def send_event_alert_name(self, name, token):
-        """ API specific function that sends a event within the Alerts namespace. The response is not read in
-            this function.
+    def send_event_async(self, header, payload=None, audio=None):
+        """ Sends an event right away (so events are sent in the order this is called), and leaves its response to
+            a background worker (see process_response_async).
 
-        :param name: name of event within the Alerts namesapce
-        :param token: token for alert
-        :return: the stream_id associated with the request
+        :param header: message header dictionary
+        :param payload: message payload dictionary
+        :param audio: raw binary string attachment
+        :return: concurrent.futures.Future, which is done once the response has been processed
         """
-        header = {
-            'namespace': 'Alerts',
-            'name': name
-        }
-        payload = {'token': token}
-        stream_id = self.send_event(header, payload=payload)
-        return stream_id
+        return self.process_response_async(self.send_event(header, payload=payload, audio=audio))
@@ -0,0 +1,116 @@
+import json
+import threading
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+def get_playback_state_context(token="audio_token", offset=0, player_activity="IDLE"):
+    """ Gets the AudioPlayer.PlaybackState context fragment.
+
+    :param token: (optional) token of the current audio stream
+    :param offset: (optional) offset of the current audio stream in milliseconds
+    :param player_activity: (optional) state of the audio player (e.g. IDLE, PLAYING, STOPPED)
+    :return: context fragment dictionary
+    """
+    return {
+        "header": {
+            "namespace": "AudioPlayer",
+            "name": "PlaybackState"
+        },
+        "payload": {
+            "token": token,
+            "offsetInMilliseconds": offset,
+            "playerActivity": player_activity
+        }
+    }
+
+
+def get_volume_state_context(volume=100, muted=False):
+    """ Gets the Speaker.VolumeState context fragment.
+
+    :param volume: (optional) volume from 0 to 100
+    :param muted: (optional) flag that indicates if the speaker is muted
+    :return: context fragment dictionary
+    """
+    return {
+        "header": {
+            "namespace": "Speaker",
+            "name": "VolumeState"
+        },
+        "payload": {
+            "volume": volume,
+            "muted": muted
+        }
+    }
+
+
+class ContextStore:
+    """ Keeps the device's context (one fragment per namespace) serialized as JSON, so it does not have to be rebuilt
+        and encoded for every event. A fragment is either set directly (set), or built by a function when it is needed
+        (register), after it has been invalidated (invalidate). The serialized context (get_serialized) is spliced
+        into the body of each event as is.
+
+    See https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/context for more
+    information.
+    """
+    def __init__(self):
+        """ Initialize the ContextStore (empty).
+        """
+        self.lock = threading.Lock()
+        # Serialized fragments (namespace: binary string, or None if it must be rebuilt), in the order they were added
+        self.fragments = {}
+        self.providers = {}
+        # The serialized context (JSON array of every fragment), None if any fragment changed
+        self.serialized = None
+
+    def set(self, fragment):
+        """ Sets (adds or replaces) the fragment of a namespace, e.g. when the volume changes.
+
+        :param fragment: context fragment dictionary (the namespace is taken from its header)
+        """
+        serialized = json.dumps(fragment).encode()
+        with self.lock:
+            self.fragments[fragment['header']['namespace']] = serialized
+            self.serialized = None
+
+    def register(self, namespace, provider):
+        """ Adds a namespace whose fragment is built by a function. The function is called the next time the
+            context is needed, and again every time the namespace has been invalidated.
+
+        :param namespace: namespace of the fragment
+        :param provider: function that returns the context fragment dictionary
+        """
+        with self.lock:
+            self.providers[namespace] = provider
+            self.fragments[namespace] = None
+            self.serialized = None
+
+    def invalidate(self, namespace):
+        """ Indicates that the state of a registered namespace has changed (e.g. an alert was added or deleted).
+
+        :param namespace: namespace of the fragment
+        """
+        with self.lock:
+            self.fragments[namespace] = None
+            self.serialized = None
+
+    def get_serialized(self):
+        """ Gets the context, serialized as a JSON array. Only the fragments that changed are rebuilt.
+
+        :return: binary string of the context
+        """
+        with self.lock:
+            if self.serialized is None:
+                for namespace, fragment in self.fragments.items():
+                    if fragment is None:
+                        self.fragments[namespace] = json.dumps(self.providers[namespace]()).encode()
+                self.serialized = b'[' + b', '.join(self.fragments.values()) + b']'
+            return self.serialized
+
+    def get_context(self):
+        """ Gets the context as a list of fragment dictionaries.
+
+        :return: list of context fragment dictionaries
+        """
+        return json.loads(self.get_serialized().decode())
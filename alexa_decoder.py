@@ -0,0 +1,355 @@
+import collections
+import subprocess
+import threading
+
+try:
+    import miniaudio
+except ImportError:
+    # The in-process decoder is optional, ffmpeg is used without it
+    miniaudio = None
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+# Bytes of MP3 data the in-process decoder is given at least (unless the MP3 ends). It loses frames if it only gets a
+# few bytes at a time, while waiting for all of the data it asks for would delay decoding until most of the reply
+# has been received.
+MIN_READ_BYTES = 4096
+
+
+def start_ffmpeg(ffmpeg_path, rate, channels):
+    """ Starts an ffmpeg process that decodes MP3 from stdin to raw PCM (16 bit) on stdout.
+
+    :param ffmpeg_path: path to ffmpeg
+    :param rate: sample rate of the decoded audio
+    :param channels: number of channels of the decoded audio
+    :return: subprocess.Popen object of the decoder
+    """
+    return subprocess.Popen([ffmpeg_path, '-i', 'pipe:0',
+                             '-f', 's16le', '-acodec', 'pcm_s16le',
+                             '-ac', str(channels), '-ar', str(rate), 'pipe:1'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+
+def stop_process(process):
+    """ Stops a decoder process that is no longer needed (e.g. an idle one).
+
+    :param process: subprocess.Popen object of the decoder
+    """
+    process.kill()
+    process.wait()
+    process.stdin.close()
+    process.stdout.close()
+
+
+def write_to_decoder(decoder, raw_audio):
+    """ Writes the encoded audio to the decoder's stdin, and then closes it so the decoder knows the audio ended.
+
+    :param decoder: subprocess.Popen object of the decoder
+    :param raw_audio: the raw audio as a binary string, or an iterable of binary strings (e.g. an AttachmentStream
+                      that is still being received)
+    """
+    try:
+        if isinstance(raw_audio, bytes):
+            decoder.stdin.write(raw_audio)
+        else:
+            # Hand each chunk to the decoder as soon as it is available
+            for chunk in raw_audio:
+                decoder.stdin.write(chunk)
+                decoder.stdin.flush()
+    except BrokenPipeError:
+        # The decoder stopped early (e.g. the audio could not be decoded)
+        pass
+    finally:
+        try:
+            decoder.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def read_from_decoder(decoder, raw_audio, chunk_bytes):
+    """ Decodes audio with a decoder process. The decoder is fed from a separate thread, so that neither pipe can fill
+        up and block.
+
+    :param decoder: subprocess.Popen object of the decoder (started, and not used yet)
+    :param raw_audio: the raw audio as a binary string, or an iterable of binary strings
+    :param chunk_bytes: number of bytes of decoded audio returned at a time (the last chunk can be shorter)
+    :return: generator of binary strings of decoded audio, which raises EOFError at the end if the decoder failed
+    """
+    writer_thread = threading.Thread(target=write_to_decoder, args=(decoder, raw_audio))
+    writer_thread.start()
+    is_finished = False
+    try:
+        data = decoder.stdout.read(chunk_bytes)
+        while len(data) > 0:
+            yield data
+            data = decoder.stdout.read(chunk_bytes)
+        is_finished = True
+    finally:
+        # If the caller stopped early, stop the decoder too (so the writer thread is not blocked)
+        if not is_finished:
+            decoder.kill()
+        writer_thread.join()
+        decoder.stdout.close()
+        return_code = decoder.wait()
+    if return_code != 0:
+        raise EOFError("Decoder failed (exit code %d)." % return_code)
+
+
+class FFmpegDecoder:
+    """ MP3 decoder backend that starts an ffmpeg process for each response (and pays its start-up time every time).
+
+        A decoder backend decodes any number of responses, possibly at the same time. decode returns the decoded audio
+        (16 bit PCM, in the backend's rate and channels) chunk by chunk, as soon as it comes out of the decoder, and
+        raises EOFError at the end if the audio could not be decoded. close is called when the backend is no longer
+        needed.
+
+        This decoder assumes ffmpeg is located in the current working directory (ffmpeg/bin/ffmpeg).
+    """
+    def __init__(self, rate=24000, channels=1, ffmpeg_path='ffmpeg/bin/ffmpeg'):
+        """ Initialize the FFmpegDecoder.
+
+        :param rate: (optional) sample rate of the decoded audio
+        :param channels: (optional) number of channels of the decoded audio
+        :param ffmpeg_path: (optional) path to ffmpeg
+        """
+        self.rate = rate
+        self.channels = channels
+        self.ffmpeg_path = ffmpeg_path
+
+    def start(self):
+        """ Nothing is started in advance.
+        """
+        pass
+
+    def decode(self, raw_audio, chunk_bytes=2048):
+        """ Decodes a response.
+
+        :param raw_audio: the MP3 as a binary string, or an iterable of binary strings (e.g. an AttachmentStream that
+                          is still being received)
+        :param chunk_bytes: (optional) number of bytes of decoded audio returned at a time
+        :return: iterator of binary strings of decoded audio
+        """
+        return read_from_decoder(start_ffmpeg(self.ffmpeg_path, self.rate, self.channels), raw_audio, chunk_bytes)
+
+    def close(self):
+        """ Nothing to close (each process ends with its response).
+        """
+        pass
+
+
+class WarmFFmpegDecoder(FFmpegDecoder):
+    """ MP3 decoder backend that keeps ffmpeg processes started in advance (warm), waiting for their input. A
+        response is given to a warm process, so its decoding starts right away, and a replacement is started in the
+        background. A process is only started on demand if none is warm (e.g. for the first response, if start was
+        not called, or when more responses than pool_size arrive at the same time).
+
+        This only hides the start-up time: every response is still decoded by its own ffmpeg process, which costs
+        the same CPU and memory as before. Each idle process also uses some memory, so one pool should be shared by
+        every device in a process (see get_shared_decoder), with pool_size covering the responses that are usually
+        decoded at the same time. MiniaudioDecoder has none of these costs.
+    """
+    def __init__(self, rate=24000, channels=1, ffmpeg_path='ffmpeg/bin/ffmpeg', pool_size=1):
+        """ Initialize the WarmFFmpegDecoder. No process is started until start or decode is called.
+
+        :param rate: (optional) sample rate of the decoded audio
+        :param channels: (optional) number of channels of the decoded audio
+        :param ffmpeg_path: (optional) path to ffmpeg
+        :param pool_size: (optional) number of processes kept warm
+        """
+        FFmpegDecoder.__init__(self, rate, channels, ffmpeg_path)
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        # Warm processes, and the number of processes being started
+        self.idle = collections.deque()
+        self.starting_count = 0
+        self.is_closed = False
+        # Statistics
+        self.warm_count = 0
+        self.cold_count = 0
+
+    def start(self):
+        """ Starts warming up processes in the background.
+        """
+        threading.Thread(target=self.fill).start()
+
+    def fill(self):
+        """ Starts processes until pool_size of them are warm (or being started).
+        """
+        while True:
+            with self.lock:
+                if self.is_closed or len(self.idle) + self.starting_count >= self.pool_size:
+                    return
+                self.starting_count += 1
+            try:
+                process = start_ffmpeg(self.ffmpeg_path, self.rate, self.channels)
+            except OSError as error:
+                print("Decoder not started (%s)." % error)
+                with self.lock:
+                    self.starting_count -= 1
+                return
+            with self.lock:
+                self.starting_count -= 1
+                if not self.is_closed:
+                    self.idle.append(process)
+                    continue
+            stop_process(process)
+            return
+
+    def take_process(self):
+        """ Takes a warm process (and starts a replacement), or starts one if none is warm.
+
+        :return: subprocess.Popen object of the decoder
+        """
+        exited = []
+        with self.lock:
+            process = None
+            # Skip any process that exited while it was idle
+            while self.idle and process is None:
+                process = self.idle.popleft()
+                if process.poll() is not None:
+                    exited.append(process)
+                    process = None
+            if process is not None:
+                self.warm_count += 1
+            else:
+                self.cold_count += 1
+        for exited_process in exited:
+            stop_process(exited_process)
+        self.start()
+        if process is None:
+            process = start_ffmpeg(self.ffmpeg_path, self.rate, self.channels)
+        return process
+
+    def decode(self, raw_audio, chunk_bytes=2048):
+        """ Decodes a response with a warm process.
+
+        :param raw_audio: the MP3 as a binary string, or an iterable of binary strings (e.g. an AttachmentStream that
+                          is still being received)
+        :param chunk_bytes: (optional) number of bytes of decoded audio returned at a time
+        :return: iterator of binary strings of decoded audio
+        """
+        return read_from_decoder(self.take_process(), raw_audio, chunk_bytes)
+
+    def get_stats(self):
+        """ Gets the pool statistics.
+
+        :return: dictionary with the number of responses decoded by a warm process and by a process started on
+                 demand, and the number of warm processes
+        """
+        with self.lock:
+            return {
+                'warm_count': self.warm_count,
+                'cold_count': self.cold_count,
+                'idle': len(self.idle)
+            }
+
+    def close(self):
+        """ Stops the warm processes (responses that are being decoded are not affected).
+        """
+        with self.lock:
+            self.is_closed = True
+            idle = list(self.idle)
+            self.idle.clear()
+        for process in idle:
+            stop_process(process)
+
+
+class AttachmentSource(miniaudio.StreamableSource if miniaudio is not None else object):
+    """ Source of MP3 data for miniaudio, which reads the MP3 chunk by chunk while it is received.
+    """
+    def __init__(self, raw_audio):
+        """ Initialize the AttachmentSource.
+
+        :param raw_audio: the MP3 as a binary string, or an iterable of binary strings (e.g. an AttachmentStream that
+                          is still being received)
+        """
+        self.chunks = iter([raw_audio] if isinstance(raw_audio, bytes) else raw_audio)
+        self.data = b''
+
+    def read(self, num_bytes):
+        """ Called by the decoder for more data. Only waits until MIN_READ_BYTES have been received (not all of the
+            data asked for), so decoding starts as soon as the first frames are available.
+
+        :param num_bytes: maximum number of bytes
+        :return: binary string (empty at the end of the MP3)
+        """
+        while len(self.data) < min(num_bytes, MIN_READ_BYTES):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.data += chunk
+        data = self.data[:num_bytes]
+        self.data = self.data[num_bytes:]
+        return data
+
+
+class MiniaudioDecoder:
+    """ MP3 decoder backend that decodes in the process (with the miniaudio package), so no process is started or
+        kept for any response. Responses are decoded chunk by chunk while they are received, each one with its own
+        decoder state, so any number can be decoded at the same time.
+    """
+    def __init__(self, rate=24000, channels=1):
+        """ Initialize the MiniaudioDecoder.
+
+        :param rate: (optional) sample rate of the decoded audio
+        :param channels: (optional) number of channels of the decoded audio
+        """
+        if miniaudio is None:
+            raise ImportError("The miniaudio package is needed to decode in the process.")
+        self.rate = rate
+        self.channels = channels
+
+    def start(self):
+        """ Nothing is started in advance.
+        """
+        pass
+
+    def decode(self, raw_audio, chunk_bytes=2048):
+        """ Decodes a response.
+
+        :param raw_audio: the MP3 as a binary string, or an iterable of binary strings (e.g. an AttachmentStream that
+                          is still being received)
+        :param chunk_bytes: (optional) number of bytes of decoded audio returned at a time
+        :return: generator of binary strings of decoded audio, which raises EOFError if the audio cannot be decoded
+        """
+        try:
+            stream = miniaudio.stream_any(AttachmentSource(raw_audio), miniaudio.FileFormat.MP3,
+                                          nchannels=self.channels, sample_rate=self.rate,
+                                          frames_to_read=max(1, chunk_bytes // (2 * self.channels)))
+            for samples in stream:
+                yield samples.tobytes()
+        except miniaudio.DecodeError as error:
+            raise EOFError("Decoder failed (%s)." % (error,))
+
+    def close(self):
+        """ Nothing to close.
+        """
+        pass
+
+
+# Decoder backends shared by every AlexaAudio object, by (rate, channels)
+shared_decoders = {}
+shared_decoders_lock = threading.Lock()
+
+
+def get_shared_decoder(rate=24000, channels=1):
+    """ Gets the decoder backend shared by every device in the process, which is created (and started) the first
+        time. It decodes in the process (MiniaudioDecoder) if the miniaudio package is installed. Otherwise it is a
+        WarmFFmpegDecoder, so the process keeps a single warm ffmpeg process (not one per device), but each response
+        is still decoded by its own ffmpeg process.
+
+    :param rate: (optional) sample rate of the decoded audio
+    :param channels: (optional) number of channels of the decoded audio
+    :return: decoder backend
+    """
+    with shared_decoders_lock:
+        decoder = shared_decoders.get((rate, channels))
+        if decoder is None:
+            if miniaudio is not None:
+                decoder = MiniaudioDecoder(rate, channels)
+            else:
+                decoder = WarmFFmpegDecoder(rate, channels)
+            decoder.start()
+            shared_decoders[(rate, channels)] = decoder
+        return decoder
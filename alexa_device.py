@@ -2,10 +2,12 @@
 import helper
 import time
 import threading
-import traceback
 
 import alexa_audio
 import alexa_communication
+import alexa_context
+import alexa_scheduler
+import alexa_timeline
 
 __author__ = "NJC"
 __license__ = "MIT"
@@ -13,17 +15,27 @@ __version__ = "0.2"
 
 
 class AlarmManager:
-    """ This object manages all alarms and timers sent via the Alerts interface.
+    """ This object manages all alarms and timers sent via the Alerts interface. Alerts are scheduled with an
+        AlertScheduler (one thread for all alerts), and the active alerts are kept in a separate index. The alert
+        dictionaries are only accessed with the lock acquired, since the directives and the alerts are processed by
+        different threads.
     """
-    def __init__(self, audio):
+    def __init__(self, audio, scheduler=None):
         """ Initializes the AlarmManager object. Requires an AlexaAudio object to sound alarms. The
             AlexaCommunication object must be specified in a separate function call.
 
         :param audio: AlexaAudio object instance
+        :param scheduler: (optional) alexa_scheduler.AlertScheduler shared with other devices (created if not
+                          specified)
         """
         self.alexa_device = None
         self.audio = audio
+        self.owns_scheduler = scheduler is None
+        self.scheduler = scheduler if scheduler is not None else alexa_scheduler.AlertScheduler()
+        self.lock = threading.Lock()
+        # All alerts (token: alert dictionary), and the tokens of the active alerts
         self.alerts = {}
+        self.active_alerts = set()
 
     def set_alexa_device(self, alexa_device):
         """ Set's the current AlexaDevice object.
@@ -32,8 +44,15 @@ class AlarmManager:
         """
         self.alexa_device = alexa_device
 
+    def invalidate_context(self):
+        """ Indicates to the AlexaDevice's context that the alerts changed. Must be called without the lock acquired.
+        """
+        if self.alexa_device is not None:
+            self.alexa_device.context_store.invalidate('Alerts')
+
     def set_alert(self, token, alert_type, scheduled_time):
-        """ Called when a new alarm is to be added (from SetAlert directive).
+        """ Called when a new alarm is to be added (from SetAlert directive). An existing alarm with the same token is
+            rescheduled.
 
         :param token: token for the alarm
         :param alert_type: alert type from the API
@@ -42,18 +61,16 @@ class AlarmManager:
         """
         try:
             s_time = helper.get_timestamp_from_iso(scheduled_time)
-            time_difference = s_time-time.time()
-            print(time_difference)
-            timer_thread = threading.Timer(time_difference, self.start_alert, args=(token,))
-            timer_thread.start()
-            stop_event = threading.Event()
-            self.alerts[token] = {
-                'type': alert_type,
-                'scheduled_time': scheduled_time,
-                'timer_thread': timer_thread,
-                'stop_event': stop_event,
-                'is_active': False
-            }
+            print(s_time - time.time())
+            with self.lock:
+                alert = self.alerts.get(token)
+                if alert is None:
+                    alert = self.alerts[token] = {'stop_event': threading.Event()}
+                alert['type'] = alert_type
+                alert['scheduled_time'] = scheduled_time
+            self.invalidate_context()
+            # The scheduler is keyed by token, so scheduling again replaces the previous time
+            self.scheduler.schedule((id(self), token), s_time, self.start_alert, token)
             print("Alarm set successfully.")
         except:
             print("Error setting alarm")
@@ -61,47 +78,48 @@ class AlarmManager:
         return True
 
     def delete_alert(self, token):
-        """ Called when an alarm is to be deleted (from DeleteAlert directive).
+        """ Called when an alarm is to be deleted (from DeleteAlert directive). Can be called from any thread, an alert
+            is only deleted once.
 
         :param token: token for the alarm
-        :param alert_type: alert type from the API
-        :param scheduled_time: scheduled time (UTC time as ISO string)
         :return: boolean indicating success or failure
         """
-        try:
-            self.alerts[token]['timer_thread'].cancel()
-            if self.alerts[token]['is_active']:
-                print("Stopping alarm")
-                self.alerts[token]['stop_event'].set()
-
-                stream_id = self.alexa_device.alexa.send_event_alert_name('AlertStopped', token)
-                # TODO combine get_and_process_reponse with alexa_send_event
-                self.alexa_device.alexa.get_and_process_response(stream_id)
-            del self.alerts[token]
-            print("Alarm deleted")
-            return True
-        except:
-            traceback.print_exc()
+        self.scheduler.cancel((id(self), token))
+        with self.lock:
+            alert = self.alerts.pop(token, None)
+            is_active = token in self.active_alerts
+            self.active_alerts.discard(token)
+        if alert is None:
             print("Error deleting alarm")
             return False
+        self.invalidate_context()
+
+        if is_active:
+            print("Stopping alarm")
+            alert['stop_event'].set()
+
+            stream_id = self.alexa_device.alexa.send_event_alert_name('AlertStopped', token)
+            self.alexa_device.alexa.process_response_async(stream_id)
+        print("Alarm deleted")
+        return True
 
     def get_alarm_context(self):
         """ Get the alert context dictionary.
 
         :return: dictionary containing alert context
         """
-        tokens = self.alerts.keys()
-        all_alerts = []
-        active_alerts = []
-        for token in tokens:
-            alert = {
-                'token': token,
-                'type': self.alerts[token]['type'],
-                'scheduledTime': self.alerts[token]['scheduled_time']
-            }
-            all_alerts.append(alert)
-            if self.alerts[token]['is_active']:
-                active_alerts.append(alert)
+        with self.lock:
+            all_alerts = []
+            active_alerts = []
+            for token, alert in self.alerts.items():
+                context_alert = {
+                    'token': token,
+                    'type': alert['type'],
+                    'scheduledTime': alert['scheduled_time']
+                }
+                all_alerts.append(context_alert)
+                if token in self.active_alerts:
+                    active_alerts.append(context_alert)
 
         context_alerts = {
             "header": {
@@ -115,52 +133,144 @@ class AlarmManager:
         }
         return context_alerts
 
+    def activate_alert(self, token):
+        """ Marks an alert as active.
+
+        :param token: token for the alarm
+        :return: the alert's stop event, or None if the alert was deleted in the meantime
+        """
+        with self.lock:
+            alert = self.alerts.get(token)
+            if alert is None:
+                return None
+            self.active_alerts.add(token)
+            stop_event = alert['stop_event']
+        self.invalidate_context()
+        return stop_event
+
     def start_alert(self, token):
-        """ Called as a thread when the alarm is started.
+        """ Called by the scheduler (in its own thread) when the alarm is started.
 
         :param token: token for active alarm
         """
+        # The alert may have been deleted after the scheduler started this function
+        stop_event = self.activate_alert(token)
+        if stop_event is None:
+            return
         print("Alarm started!")
-        # This function is called by the scheduler
-        # Be sure to delete the alert dictionary when done
 
-        self.alerts[token]['is_active'] = True
-
-        # Send alert started to alexa
+        # Send alert started to alexa (the alarm starts without waiting for the response)
         stream_id = self.alexa_device.alexa.send_event_alert_name('AlertStarted', token)
-        self.alexa_device.alexa.get_and_process_response(stream_id)
+        self.alexa_device.alexa.process_response_async(stream_id)
         # If foreground
         if True:
             # Play in foreground for 30 seconds, unless stopped
-            self.audio.play_wav('files/alarm.wav',
-                                timeout=30, stop_event=self.alerts[token]['stop_event'], repeat=True)
+            self.audio.play_wav('files/alarm.wav', timeout=30, stop_event=stop_event, repeat=True)
             # Send status to alexa
             stream_id = self.alexa_device.alexa.send_event_alert_name('AlertEnteredForeground', token)
-            self.alexa_device.alexa.get_and_process_response(stream_id)
+            self.alexa_device.alexa.process_response_async(stream_id)
         else:
             # Play quietly in background (or not at all
             # Send status to alexa
             stream_id = self.alexa_device.alexa.send_event_alert_name('AlertEnteredBackground', token)
-            self.alexa_device.alexa.get_and_process_response(stream_id)
+            self.alexa_device.alexa.process_response_async(stream_id)
 
         # If alert still exists (would exist if alarm is not cancelled)
-        if token in self.alerts:
+        if not stop_event.is_set():
             self.delete_alert(token)
 
+    def close(self):
+        """ Cancels all alerts, and stops the scheduler if it is not shared.
+        """
+        with self.lock:
+            tokens = list(self.alerts.keys())
+            for alert in self.alerts.values():
+                alert['stop_event'].set()
+            self.alerts = {}
+            self.active_alerts = set()
+        if self.owns_scheduler:
+            self.scheduler.stop()
+        else:
+            for token in tokens:
+                self.scheduler.cancel((id(self), token))
+
+
+def create_context_store(alarm_manager):
+    """ Creates the context store of a device, with the default AudioPlayer and Speaker state. The Alerts part is
+        built from the AlarmManager when it changes.
+
+    :param alarm_manager: AlarmManager object of the device
+    :return: alexa_context.ContextStore object
+    """
+    # TODO eventually make this dynamic and actually reflect the device's state
+    context_store = alexa_context.ContextStore()
+    context_store.set(alexa_context.get_playback_state_context())
+    context_store.register('Alerts', alarm_manager.get_alarm_context)
+    context_store.set(alexa_context.get_volume_state_context())
+    return context_store
+
+
+class DeviceContextMixin:
+    """ The context of a device, shared by AlexaDevice and AsyncAlexaDevice. The device must have a context_store
+        (see create_context_store).
+    """
+    def get_context(self):
+        """ Returns the current context of the device. The context is cached, only the parts that changed since
+            the last event are serialized again.
+
+        See https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/context for more
+        information.
+
+        :return: context serialized as a JSON array (binary string)
+        """
+        return self.context_store.get_serialized()
+
+    def set_playback_state(self, token, offset, player_activity):
+        """ Updates the AudioPlayer part of the context (e.g. when playback starts or stops).
+
+        :param token: token of the current audio stream
+        :param offset: offset of the current audio stream in milliseconds
+        :param player_activity: state of the audio player (e.g. IDLE, PLAYING, STOPPED)
+        """
+        self.context_store.set(alexa_context.get_playback_state_context(token, offset, player_activity))
+
+    def set_volume(self, volume, muted=False):
+        """ Updates the Speaker part of the context (e.g. when the volume changes).
+
+        :param volume: volume from 0 to 100
+        :param muted: (optional) flag that indicates if the speaker is muted
+        """
+        self.context_store.set(alexa_context.get_volume_state_context(volume, muted))
+
 
-class AlexaDevice:
+class AlexaDevice(DeviceContextMixin):
     """ This object is the AlexaDevice. It uses the AlexaCommunication and AlexaAudio object. The goal is to provide a
         highly abstract yet simple interface for Amazon's Alexa Voice Service (AVS).
 
     """
-    def __init__(self, alexa_config):
+    def __init__(self, alexa_config, timeline_sink=None, audio_encoder=None, capture_format=None):
         """ Initialize the AlexaDevice using the config dictionary. The config dictionary must containing the
             Client_ID, Client_Secret, and refresh_token.
 
         :param alexa_config: config dictionary specific to the device
+        :param timeline_sink: (optional) function that receives the latency timeline of each dialog (e.g.
+                              alexa_timeline.log_sink or an alexa_timeline.JSONLSink), no timelines are recorded if
+                              not specified
+        :param audio_encoder: (optional) function (e.g. alexa_encoder.OpusEncoder) that creates the encoder of each
+                              Recognize event's audio, by default the audio is sent as PCM
+        :param capture_format: (optional) (rate, channels, sample_width) tuple of the microphone's format, e.g.
+                               (48000, 2, 2), the audio is converted to 16 kHz mono (16 kHz, 1, 2 if not specified)
         """
-        self.alexa_audio_instance = alexa_audio.AlexaAudio()
+        self.timeline = alexa_timeline.TimelineRecorder(timeline_sink)
+        self.audio_encoder = audio_encoder
+        capture_rate, capture_channels, capture_sample_width = capture_format or (alexa_audio.AVS_RATE, 1, 2)
+        self.alexa_audio_instance = alexa_audio.AlexaAudio(timeline=self.timeline, capture_rate=capture_rate,
+                                                           capture_channels=capture_channels,
+                                                           capture_sample_width=capture_sample_width)
+        # Keep the microphone open, so capturing starts instantly (with audio from before the user pressed enter)
+        self.alexa_audio_instance.start_capture()
         self.alarm_manager = AlarmManager(self.alexa_audio_instance)
+        self.context_store = create_context_store(self.alarm_manager)
         self.config = alexa_config
         self.alexa = None
 
@@ -178,7 +288,8 @@ class AlexaDevice:
 
         # Start connection and save
         self.alexa = alexa_communication.AlexaConnection(self.config, context_handle=self.get_context,
-                                                         process_response_handle=self.process_response)
+                                                         process_response_handle=self.process_response,
+                                                         timeline=self.timeline, audio_encoder=self.audio_encoder)
         self.alarm_manager.set_alexa_device(self)
 
         # Connection loop
@@ -190,52 +301,52 @@ class AlexaDevice:
         # When complete (stop event is same as user_input_thread
         # Close the alexa connection and set stop event
         self.alexa.close()
+        self.alarm_manager.close()
         self.device_stop_event.set()
         print("Closing Thread")
         # TODO If anything went wrong, and stop event is not set, start new thread automatically
 
     def user_initiate_audio(self):
-        raw_audio = self.alexa_audio_instance.get_audio()
-        if raw_audio is None:
+        stream_id = self.stream_recognize()
+        if stream_id is None:
             return
+        dialog_request_id = self.alexa.dialog_streams.get(stream_id)
 
         # TODO make it so the response can be interrupted by user if desired (maybe start a thread)
-        stream_id = self.alexa.start_recognize_event(raw_audio)
-        self.alexa.get_and_process_response(stream_id)
-
-    def get_context(self):
-        """ Returns the current context of the AlexaDevice.
-
-        See https://developer.amazon.com/public/solutions/alexa/alexa-voice-service/reference/context for more
-        information.
-
-        :return: context dictionary
+        try:
+            self.alexa.get_and_process_response(stream_id)
+        finally:
+            # The timeline is sent to the sink once the SpeechStarted/Finished responses have been processed
+            self.timeline.finish(dialog_request_id)
+
+    def stream_recognize(self, timeout=None, dialog_request_id=None):
+        """ Captures audio from the microphone and streams it to AVS in a Recognize event while the user is talking.
+            The event is started as soon as speech is detected, and ended when the user stops talking. The response
+            is not read in this function.
+
+        :param timeout: (optional) timeout in seconds, when to give up if the user did not speak
+        :param dialog_request_id: (optional) previously used dialog_request_id
+        :return: the stream_id associated with the request, or None if the user did not speak
         """
-        # TODO eventually make this dynamic and actually reflect the device's state
-        # Get context for the device (basically a status)
-        context_audio = {
-            "header": {
-                "namespace": "AudioPlayer",
-                "name": "PlaybackState"
-            },
-            "payload": {
-                "token": "audio_token",
-                "offsetInMilliseconds": 0,
-                "playerActivity": "IDLE"
-            }
-        }
-        context_alerts = self.alarm_manager.get_alarm_context()
-        context_speaker = {
-            "header": {
-                "namespace": "Speaker",
-                "name": "VolumeState"
-            },
-            "payload": {
-                "volume": 100,
-                "muted": False
-            }
-        }
-        return [context_audio, context_alerts, context_speaker]
+        stream_ids = []
+
+        def send_audio(raw_audio):
+            # Start the event with the first chunk of audio
+            if not stream_ids:
+                stream_ids.append(self.alexa.start_recognize_stream(dialog_request_id=dialog_request_id))
+            self.alexa.send_recognize_audio(stream_ids[0], raw_audio)
+
+        self.alexa_audio_instance.stream_audio(send_audio, timeout)
+        if not stream_ids:
+            # Keep the capture stages only if they belong to a dialog that is already in progress
+            if dialog_request_id is None:
+                self.timeline.discard()
+            else:
+                self.timeline.start(dialog_request_id)
+            return None
+        # The event was started while capturing, move the remaining capture stages (e.g. capture_end) to its dialog
+        self.timeline.start(self.alexa.dialog_streams.get(stream_ids[0]))
+        return self.alexa.finish_recognize_stream(stream_ids[0])
 
     def process_response(self, message):
         """ Called when a message is received from Alexa (either on the downchannel or as a response). This
@@ -278,10 +389,11 @@ class AlexaDevice:
                 raise NameError("Namespace not recognized (%s)." % namespace)
 
     def process_directive_speech_synthesizer(self, content, attachment):
-        """ Process a directive that belongs to the SpeechSynthesizer namespace.
+        """ Process a directive that belongs to the SpeechSynthesizer namespace. The attachment may still be in the
+            process of being received (AttachmentStream), in which case playback starts with the data received so far.
 
         :param content: content dictionary (contains header and payload)
-        :param attachment: attachment included with the content
+        :param attachment: attachment included with the content (binary string or AttachmentStream)
         """
         header = content['directive']['header']
         payload = content['directive']['payload']
@@ -294,17 +406,21 @@ class AlexaDevice:
             # Get token for current TTS object
             token = payload['token']
             audio_response = attachment
+            # Speak directives that are not part of a dialog (e.g. from the downchannel) have no dialogRequestId
+            dialog_request_id = header.get('dialogRequestId')
 
             # Set SpeechSynthesizer context state to "playing"
             # TODO capture state so that it can be used in context
-            # Send SpeechStarted Event (with token)
+            # Send SpeechStarted Event (with token), playback does not wait for the response
             stream_id = self.alexa.send_event_speech_started(token)
-            self.alexa.get_and_process_response(stream_id)
+            future = self.alexa.process_response_async(stream_id)
+            self.timeline.track(dialog_request_id, future, 'speech_started_done')
             # Play the mp3 file
-            self.alexa_audio_instance.play_mp3(audio_response)
+            self.alexa_audio_instance.play_mp3(audio_response, dialog_request_id)
             # Send SpeechFinished Event (with token)
             stream_id = self.alexa.send_event_speech_finished(token)
-            self.alexa.get_and_process_response(stream_id)
+            future = self.alexa.process_response_async(stream_id)
+            self.timeline.track(dialog_request_id, future, 'speech_finished_done')
             # Set SpeechSynthesizer context state to "finished"
             # TODO capture state so that it can be used in context
         # Throw an error if the name is not recognized.
@@ -331,19 +447,19 @@ class AlexaDevice:
             dialog_request_id = header['dialogRequestId']
             timeout = payload['timeoutInMilliseconds']/1000
 
-            # Get audio, as requested by Alexa (using the specified timeout)
-            raw_audio = self.alexa_audio_instance.get_audio(timeout)
-            # If raw_audio is none, the user did not respond or speak
-            if raw_audio is None:
+            # Stream audio as it is captured, as requested by Alexa (using the specified timeout and the old
+            # dialog_request_id)
+            stream_id = self.stream_recognize(timeout, dialog_request_id=dialog_request_id)
+            # If stream_id is none, the user did not respond or speak
+            if stream_id is None:
                 # TODO add sounds to prompt the user to do something, rather than text
                 print("Speech timeout.")
                 # Send an event to let Alexa know that the user did not respond
                 stream_id = self.alexa.send_event_expect_speech_timed_out()
-                self.alexa.get_and_process_response(stream_id)
+                self.alexa.process_response_async(stream_id)
                 return
 
-            # Send audio captured (start_recognize_event) using old dialog_request_id and then process reponse
-            stream_id = self.alexa.start_recognize_event(raw_audio, dialog_request_id=dialog_request_id)
+            # Process the response to the audio that was sent
             self.alexa.get_and_process_response(stream_id)
         elif name == 'StopCapture':
             # TODO find out what this means, it is not in the API.
@@ -378,14 +494,14 @@ class AlexaDevice:
                 stream_id = self.alexa.send_event_alert_name('SetAlertSucceeded', token)
             else:
                 stream_id = self.alexa.send_event_alert_name('SetAlertFailed', token)
-            self.alexa.get_and_process_response(stream_id)
+            self.alexa.process_response_async(stream_id)
         elif name == 'DeleteAlert':
             is_deleted = self.alarm_manager.delete_alert(token)
             if is_deleted:
                 stream_id = self.alexa.send_event_alert_name('DeleteAlertSucceeded', token)
             else:
                 stream_id = self.alexa.send_event_alert_name('DeleteAlertFailed', token)
-            self.alexa.get_and_process_response(stream_id)
+            self.alexa.process_response_async(stream_id)
 
     def close(self):
         """ Closes the AlexaDevice. Should be called before the program terminates.
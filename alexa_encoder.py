@@ -0,0 +1,99 @@
+import subprocess
+import threading
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+class PCMEncoder:
+    """ Audio encoder that sends the captured audio as is (16 kHz, 16 bit, mono PCM).
+
+        An encoder is created for each Recognize event. Captured audio is passed to encode as it arrives, and finish
+        is called at the end of the audio. Both return the encoded audio that is ready to be sent. audio_format is the
+        format of the Recognize event's payload.
+    """
+    audio_format = "AUDIO_L16_RATE_16000_CHANNELS_1"
+
+    def encode(self, raw_audio):
+        """ Encodes the next chunk of audio.
+
+        :param raw_audio: raw binary audio string (PCM, 16 kHz, 16 bit, mono)
+        :return: binary string of the encoded audio that is ready (can be empty)
+        """
+        return raw_audio
+
+    def finish(self):
+        """ Ends the audio.
+
+        :return: binary string of the rest of the encoded audio
+        """
+        return b''
+
+
+class OpusEncoder:
+    """ Audio encoder that compresses the captured audio to Opus (16 kHz, 32 kbit/s CBR, 20 ms frames, the Opus format
+        AVS accepts), using ffmpeg. The audio is encoded while it streams, so most of it is ready to be sent by the time
+        the user stops talking.
+
+        This encoder assumes ffmpeg is located in the current working directory (ffmpeg/bin/ffmpeg), and was built with
+        libopus.
+    """
+    audio_format = "OPUS"
+
+    def __init__(self, bitrate=32000, ffmpeg_path='ffmpeg/bin/ffmpeg'):
+        """ Starts the encoder.
+
+        :param bitrate: (optional) bit rate of the encoded audio in bit/s
+        :param ffmpeg_path: (optional) path to ffmpeg
+        """
+        # The packets are written one after the other, without a container (they all have the same size)
+        self.encoder = subprocess.Popen([ffmpeg_path, '-f', 's16le', '-ar', '16000', '-ac', '1', '-i', 'pipe:0',
+                                         '-c:a', 'libopus', '-b:a', str(bitrate), '-vbr', 'off',
+                                         '-frame_duration', '20', '-application', 'voip', '-f', 'data', 'pipe:1'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.lock = threading.Lock()
+        self.output = []
+        # Read the encoded audio from a separate thread, so that neither pipe can fill up and block
+        self.reader_thread = threading.Thread(target=self.reader_thread_function)
+        self.reader_thread.start()
+
+    def reader_thread_function(self):
+        """ Collects the encoded audio as the encoder produces it.
+        """
+        while True:
+            data = self.encoder.stdout.read1(4096)
+            if len(data) == 0:
+                break
+            with self.lock:
+                self.output.append(data)
+
+    def take_output(self):
+        """ Takes the encoded audio collected so far.
+
+        :return: binary string of the encoded audio
+        """
+        with self.lock:
+            output = b''.join(self.output)
+            self.output = []
+        return output
+
+    def encode(self, raw_audio):
+        """ Encodes the next chunk of audio.
+
+        :param raw_audio: raw binary audio string (PCM, 16 kHz, 16 bit, mono)
+        :return: binary string of the encoded audio that is ready (can be empty)
+        """
+        self.encoder.stdin.write(raw_audio)
+        self.encoder.stdin.flush()
+        return self.take_output()
+
+    def finish(self):
+        """ Ends the audio, and waits for the encoder to finish.
+
+        :return: binary string of the rest of the encoded audio
+        """
+        self.encoder.stdin.close()
+        self.reader_thread.join()
+        self.encoder.stdout.close()
+        self.encoder.wait()
+        return self.take_output()
@@ -0,0 +1,202 @@
+import asyncio
+import concurrent.futures
+import sys
+import threading
+import tracemalloc
+
+import helper
+import alexa_async
+import alexa_audio
+import alexa_token
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+def get_memory_usage():
+    """ Gets the memory currently allocated by Python, if memory tracing is enabled (see tracemalloc).
+
+    :return: number of bytes, or None if memory is not traced
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[0]
+
+
+class AlexaFleet:
+    """ Hosts many device sessions (one AsyncAlexaDevice per AVS identity) in one process. The sessions share
+        one event loop (which also schedules their alerts), one TokenRefresher thread and HTTP session for their
+        tokens, and one pool of worker threads for audio and anything else that blocks. The number of threads
+        therefore does not grow with the number of sessions. Each session has its own audio session (its own voice
+        activity detector), and by default no microphone or speaker at all.
+    """
+    def __init__(self, configs, audio=None, worker_threads=8, token_refresher=None, start_concurrency=10,
+                 trace_memory=False, **connection_kwargs):
+        """ Initialize the AlexaFleet. No session is started until start is called.
+
+        :param configs: list of config dictionaries (one per device, each containing the Client_ID, Client_Secret,
+                        and refresh_token)
+        :param audio: (optional) audio shared by all sessions, each of which uses its own session of it (see
+                      AlexaAudio.create_session). The sessions have no microphone or speaker if not specified
+                      (alexa_audio.HeadlessAudio).
+        :param worker_threads: (optional) number of threads in the shared worker pool
+        :param token_refresher: (optional) alexa_token.TokenRefresher used for the tokens (created if not specified)
+        :param start_concurrency: (optional) number of sessions that are started at the same time
+        :param trace_memory: (optional) flag that indicates if memory should be traced (using tracemalloc), so the
+                             memory used by each session can be reported. Slows down the process.
+        :param connection_kwargs: any other keyword arguments for AsyncAlexaConnection (e.g. url)
+        """
+        self.configs = configs
+        self.audio = audio
+        self.worker_threads = worker_threads
+        self.token_refresher = token_refresher if token_refresher is not None else alexa_token.TokenRefresher()
+        self.start_concurrency = start_concurrency
+        self.trace_memory = trace_memory
+        self.connection_kwargs = connection_kwargs
+
+        # One dictionary per session (config, device, token_manager, task, average_memory and average_threads)
+        self.sessions = []
+        # One dictionary per session that could not be started (config and error)
+        self.failed_sessions = []
+        self.executor = None
+        self.stop_event = None
+
+    async def start(self):
+        """ Starts the shared resources and all of the sessions. Must be called from the event loop that runs the
+            fleet. A session that cannot be started is closed and added to failed_sessions, the other sessions keep
+            running.
+        """
+        self.stop_event = asyncio.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.worker_threads)
+        asyncio.get_event_loop().set_default_executor(self.executor)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.audio is None:
+            self.audio = alexa_audio.HeadlessAudio()
+        self.token_refresher.start()
+
+        # Start the sessions in groups. The memory and threads of each group are split between its sessions, so they
+        # are averages (unless start_concurrency is 1).
+        for group_start in range(0, len(self.configs), self.start_concurrency):
+            group = self.configs[group_start:group_start + self.start_concurrency]
+            memory_before = get_memory_usage()
+            threads_before = threading.active_count()
+            results = await asyncio.gather(*[self.start_session(config) for config in group], return_exceptions=True)
+            memory_after = get_memory_usage()
+            threads_after = threading.active_count()
+            sessions = []
+            for config, result in zip(group, results):
+                if isinstance(result, Exception):
+                    print("Session %s not started (%s)." % (config['Client_ID'], result))
+                    self.failed_sessions.append({'config': config, 'error': result})
+                else:
+                    sessions.append(result)
+            for session in sessions:
+                if memory_before is not None:
+                    session['average_memory'] = (memory_after - memory_before) / len(sessions)
+                session['average_threads'] = (threads_after - threads_before) / len(sessions)
+
+    async def start_session(self, config):
+        """ Starts a single session, and adds it to the fleet. If the session cannot be started, whatever was
+            already opened is closed again.
+
+        :param config: config dictionary specific to the device
+        :return: session dictionary
+        """
+        token_manager = self.token_refresher.create_token_manager(config['Client_ID'], config['Client_Secret'],
+                                                                  config['refresh_token'])
+        device = alexa_async.AsyncAlexaDevice(config, audio=self.audio.create_session(), token_manager=token_manager,
+                                              **self.connection_kwargs)
+        try:
+            await device.alexa.open()
+        except Exception:
+            await device.close()
+            self.token_refresher.remove(token_manager)
+            raise
+        session = {
+            'config': config,
+            'device': device,
+            'token_manager': token_manager,
+            'task': asyncio.ensure_future(device.process_directives()),
+            'average_memory': None,
+            'average_threads': 0
+        }
+        self.sessions.append(session)
+        return session
+
+    async def stop_session(self, session):
+        """ Stops a single session, and removes it from the fleet.
+
+        :param session: session dictionary
+        """
+        await session['device'].close()
+        await session['task']
+        self.token_refresher.remove(session['token_manager'])
+        self.sessions.remove(session)
+
+    async def stop(self):
+        """ Stops all of the sessions and the shared resources.
+        """
+        await asyncio.gather(*[self.stop_session(session) for session in list(self.sessions)])
+        self.token_refresher.stop()
+        self.executor.shutdown(wait=False)
+        self.stop_event.set()
+
+    async def wait_until_stopped(self):
+        """ Waits until stop is called.
+        """
+        await self.stop_event.wait()
+
+    def get_stats(self):
+        """ Gets the resource usage of the fleet, in total and per session. Memory is only reported if memory is
+            traced (trace_memory).
+
+        :return: dictionary with the totals (sessions, failed_sessions, threads, memory, tokens) and a list with the
+                 statistics of each session (average memory and threads used to start its group, and if it is
+                 connected)
+        """
+        session_count = len(self.sessions)
+        threads = threading.active_count()
+        memory = get_memory_usage()
+        return {
+            'sessions': session_count,
+            'failed_sessions': len(self.failed_sessions),
+            'threads': threads,
+            'threads_per_session': threads / session_count if session_count else None,
+            'memory': memory,
+            'memory_per_session': memory / session_count if session_count and memory is not None else None,
+            'tokens': self.token_refresher.get_stats(),
+            'session_stats': [
+                {
+                    'client_id': session['config']['Client_ID'],
+                    'average_memory': session['average_memory'],
+                    'average_threads': session['average_threads'],
+                    'is_connected': not session['device'].alexa.connection.is_closed
+                } for session in self.sessions
+            ]
+        }
+
+
+async def run_fleet(configs, report_interval=60):
+    """ Runs a fleet until the process is stopped, and prints its resource usage periodically.
+
+    :param configs: list of config dictionaries (one per device)
+    :param report_interval: (optional) seconds between reports
+    """
+    fleet = AlexaFleet(configs, trace_memory=True)
+    await fleet.start()
+    try:
+        while True:
+            stats = fleet.get_stats()
+            print("%d sessions (%d failed)   %d threads (%.2f avg per session)   %.1f kB (%.1f kB avg per session)" % (
+                stats['sessions'], stats['failed_sessions'], stats['threads'], stats['threads_per_session'] or 0,
+                (stats['memory'] or 0) / 1024, (stats['memory_per_session'] or 0) / 1024))
+            await asyncio.sleep(report_interval)
+    finally:
+        await fleet.stop()
+
+
+if __name__ == "__main__":
+    # Load the fleet's configuration file (a list of config dictionaries, in the same format as config.dict)
+    fleet_configs = helper.read_dict(sys.argv[1] if len(sys.argv) > 1 else 'fleet.dict')
+    asyncio.get_event_loop().run_until_complete(run_fleet(fleet_configs))
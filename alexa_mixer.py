@@ -0,0 +1,221 @@
+import collections
+import threading
+import time
+
+import numpy
+import pyaudio
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+def convert_samples(samples, rate, channels, to_rate, to_channels):
+    """ Converts 16-bit PCM samples to another rate and number of channels (linear interpolation, channels are averaged
+        when downmixing and repeated when upmixing).
+
+    :param samples: numpy int16 array of interleaved samples
+    :param rate: sample rate of the samples
+    :param channels: number of channels of the samples
+    :param to_rate: sample rate to convert to
+    :param to_channels: number of channels to convert to
+    :return: numpy int16 array of interleaved samples
+    """
+    frames = samples.reshape(-1, channels).astype(numpy.float32)
+    if channels != to_channels:
+        frames = frames.mean(axis=1, keepdims=True)
+        if to_channels > 1:
+            frames = numpy.repeat(frames, to_channels, axis=1)
+    if rate != to_rate and len(frames) > 0:
+        frame_count = int(len(frames) * to_rate / rate)
+        positions = numpy.arange(frame_count) * (rate / to_rate)
+        source_positions = numpy.arange(len(frames))
+        frames = numpy.stack([numpy.interp(positions, source_positions, frames[:, channel])
+                              for channel in range(frames.shape[1])], axis=1)
+    return numpy.round(frames).astype(numpy.int16).reshape(-1)
+
+
+class AudioMixer:
+    """ Long-lived output stream that mixes every sound being played (e.g. a Speak reply and an alarm). Sounds are
+        added as sources, which are mixed (with numpy) each time the stream needs the next buffer, so a new sound
+        starts playing within one buffer period instead of after opening a new stream.
+
+        Each source belongs to a channel (e.g. 'tts', 'alerts'). Every channel has a gain, and a channel can duck the
+        others, i.e. lower their gain while it is playing (e.g. the alarm is quieter while Alexa speaks).
+    """
+    def __init__(self, pyaudio_instance, rate=24000, channels=1, frames_per_buffer=1024):
+        """ Initialize the AudioMixer. The stream is opened when the first source is added.
+
+        :param pyaudio_instance: pyaudio.PyAudio object
+        :param rate: (optional) sample rate of the output stream
+        :param channels: (optional) number of channels of the output stream
+        :param frames_per_buffer: (optional) number of frames mixed at a time
+        """
+        self.pyaudio_instance = pyaudio_instance
+        self.rate = rate
+        self.channels = channels
+        self.frames_per_buffer = frames_per_buffer
+
+        self.lock = threading.Lock()
+        self.stream = None
+        self.sources = []
+        # Gain of each channel (channel: gain), 1 if not specified
+        self.gains = {}
+        # Gain applied to the other channels while a channel is playing (channel: gain)
+        self.ducking = {}
+
+    def start(self):
+        """ Opens the output stream, if it is not open yet.
+        """
+        with self.lock:
+            if self.stream is not None:
+                return
+            self.stream = self.pyaudio_instance.open(format=pyaudio.paInt16, channels=self.channels, rate=self.rate,
+                                                     output=True, frames_per_buffer=self.frames_per_buffer,
+                                                     stream_callback=self.stream_callback)
+
+    def add_source(self, channel, samples=None, loop=False, timeout=None, stop_event=None):
+        """ Adds a sound to the mix. It starts playing with the next buffer.
+
+        :param channel: name of the channel the sound belongs to (e.g. 'tts')
+        :param samples: (optional) numpy int16 array of interleaved samples (in the mixer's rate and channels). If
+                        not specified, the samples are added using write, and the source is ended using finish.
+        :param loop: (optional) flag that indicates if the samples should be played in a loop (until the timeout or
+                     the stop event)
+        :param timeout: (optional) maximum playback time in seconds
+        :param stop_event: (optional) threading.Event that stops the sound when set
+        :return: source dictionary, its 'done' event is set when the sound has been played (or stopped)
+        """
+        source = {
+            'channel': channel,
+            'chunks': collections.deque(),
+            'offset': 0,
+            'loop': samples if loop else None,
+            'is_finished': samples is not None,
+            'end_time': time.monotonic() + timeout if timeout is not None else None,
+            'stop_event': stop_event,
+            'done': threading.Event()
+        }
+        if samples is not None and len(samples) > 0:
+            source['chunks'].append(samples)
+        self.start()
+        with self.lock:
+            self.sources.append(source)
+        return source
+
+    def write(self, source, samples):
+        """ Adds samples to the end of a source.
+
+        :param source: source dictionary returned by add_source
+        :param samples: numpy int16 array of interleaved samples (in the mixer's rate and channels)
+        """
+        with self.lock:
+            if len(samples) > 0:
+                source['chunks'].append(samples)
+
+    def finish(self, source):
+        """ Indicates that no more samples will be added to a source. It is done once the remaining samples are played.
+
+        :param source: source dictionary returned by add_source
+        """
+        with self.lock:
+            source['is_finished'] = True
+
+    def set_gain(self, channel, gain):
+        """ Sets the gain of a channel.
+
+        :param channel: name of the channel
+        :param gain: gain (1 is unchanged, 0 is silent)
+        """
+        with self.lock:
+            self.gains[channel] = gain
+
+    def set_ducking(self, channel, gain):
+        """ Makes a channel duck the others: while the channel is playing, the other channels are multiplied by gain.
+
+        :param channel: name of the channel
+        :param gain: gain applied to the other channels, or None to stop ducking
+        """
+        with self.lock:
+            if gain is None:
+                self.ducking.pop(channel, None)
+            else:
+                self.ducking[channel] = gain
+
+    def read_source(self, source, sample_count):
+        """ Takes the next samples of a source. Must be called with the lock acquired.
+
+        :param source: source dictionary
+        :param sample_count: maximum number of samples
+        :return: list of numpy int16 arrays (fewer samples than requested if the source has no more for now)
+        """
+        parts = []
+        while sample_count > 0:
+            if not source['chunks']:
+                if source['loop'] is None or len(source['loop']) == 0:
+                    break
+                source['chunks'].append(source['loop'])
+            chunk = source['chunks'][0]
+            part = chunk[source['offset']:source['offset'] + sample_count]
+            parts.append(part)
+            sample_count -= len(part)
+            source['offset'] += len(part)
+            if source['offset'] >= len(chunk):
+                source['chunks'].popleft()
+                source['offset'] = 0
+        return parts
+
+    def mix(self, frame_count):
+        """ Mixes the next buffer of every source. Sources that are done are removed, and their 'done' event is set.
+
+        :param frame_count: number of frames to mix
+        :return: binary string of 16-bit PCM (interleaved)
+        """
+        sample_count = frame_count * self.channels
+        output = numpy.zeros(sample_count, dtype=numpy.float32)
+        now = time.monotonic()
+        done_sources = []
+        with self.lock:
+            playing_channels = {source['channel'] for source in self.sources}
+            for source in self.sources:
+                stop_event = source['stop_event']
+                if (stop_event is not None and stop_event.is_set()) or \
+                        (source['end_time'] is not None and now >= source['end_time']):
+                    done_sources.append(source)
+                    continue
+
+                gain = self.gains.get(source['channel'], 1)
+                for channel in playing_channels:
+                    if channel != source['channel'] and channel in self.ducking:
+                        gain *= self.ducking[channel]
+                position = 0
+                for part in self.read_source(source, sample_count):
+                    output[position:position + len(part)] += part * gain
+                    position += len(part)
+
+                if source['is_finished'] and not source['chunks'] and source['loop'] is None:
+                    done_sources.append(source)
+            for source in done_sources:
+                self.sources.remove(source)
+
+        for source in done_sources:
+            source['done'].set()
+        return numpy.clip(output, -32768, 32767).astype(numpy.int16).tobytes()
+
+    def stream_callback(self, in_data, frame_count, time_info, status):
+        """ Called by PyAudio each time the output stream needs the next buffer.
+        """
+        return self.mix(frame_count), pyaudio.paContinue
+
+    def close(self):
+        """ Stops every source and closes the output stream.
+        """
+        with self.lock:
+            stream = self.stream
+            self.stream = None
+            sources = self.sources
+            self.sources = []
+        for source in sources:
+            source['done'].set()
+        if stream is not None:
+            stream.stop_stream()
+            stream.close()
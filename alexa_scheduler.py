@@ -0,0 +1,136 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+class AlertScheduler:
+    """ Calls functions at scheduled times (e.g. alarms and timers) using a single thread and a priority queue (heap),
+        instead of one timer thread per alert. One scheduler can be shared by many AlarmManagers (devices).
+
+        Scheduling and cancelling are O(log n). A cancelled entry stays in the heap, marked as removed, and is
+        skipped when it reaches the top (the heap is rebuilt if most of it is removed entries). Rescheduling a key
+        cancels its previous entry.
+
+        The scheduler thread only waits for the next entry. Scheduled functions are run in a new thread (or the
+        executor, if specified), since they can take a long time (e.g. playing an alarm).
+    """
+    def __init__(self, executor=None):
+        """ Initialize the AlertScheduler. The thread is started the first time something is scheduled.
+
+        :param executor: (optional) concurrent.futures.Executor that runs the scheduled functions (a thread is
+                         started for each one if not specified)
+        """
+        self.executor = executor
+        self.condition = threading.Condition()
+        self.heap = []
+        # Scheduled entries (key: entry), an entry is [scheduled_time, sequence, key, function, is_removed]
+        self.entries = {}
+        self.removed_count = 0
+        self.sequence = itertools.count()
+        self.thread = None
+        self.is_stopped = False
+
+    def schedule(self, key, scheduled_time, function, *args):
+        """ Schedules a function to be called at a specific time. If the key is already scheduled, it is rescheduled.
+
+        :param key: unique key of the entry (e.g. the alert's token)
+        :param scheduled_time: time to call the function at (seconds since the epoch, see time.time)
+        :param function: function to call
+        :param args: arguments for the function
+        """
+        entry = [scheduled_time, next(self.sequence), key, (function, args), False]
+        with self.condition:
+            if self.is_stopped:
+                raise NameError("Scheduler is stopped.")
+            self.remove_entry(key)
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.scheduler_thread)
+                self.thread.start()
+            # Wake up the scheduler thread if this is the new next entry
+            elif self.heap[0] is entry:
+                self.condition.notify()
+
+    def cancel(self, key):
+        """ Cancels a scheduled entry.
+
+        :param key: unique key of the entry
+        :return: True if the entry was cancelled, False if it was not scheduled (or was already called)
+        """
+        with self.condition:
+            return self.remove_entry(key)
+
+    def remove_entry(self, key):
+        """ Marks an entry as removed. Must be called with the condition acquired.
+
+        :param key: unique key of the entry
+        :return: True if the entry was removed, False if it was not scheduled
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[4] = True
+        self.removed_count += 1
+        # Rebuild the heap once most of it is removed entries, so it does not grow with cancelled alerts
+        if self.removed_count > len(self.heap) // 2:
+            self.heap = [heap_entry for heap_entry in self.heap if not heap_entry[4]]
+            heapq.heapify(self.heap)
+            self.removed_count = 0
+        return True
+
+    def get_scheduled_time(self, key):
+        """ Gets the time an entry is scheduled at.
+
+        :param key: unique key of the entry
+        :return: scheduled time (seconds since the epoch), or None if it is not scheduled
+        """
+        with self.condition:
+            entry = self.entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def scheduler_thread(self):
+        """ Waits for the next entry, and starts its function when it is due.
+        """
+        with self.condition:
+            while not self.is_stopped:
+                # Skip removed entries
+                while self.heap and self.heap[0][4]:
+                    heapq.heappop(self.heap)
+                    self.removed_count -= 1
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                time_difference = self.heap[0][0] - time.time()
+                if time_difference > 0:
+                    self.condition.wait(time_difference)
+                    continue
+
+                entry = heapq.heappop(self.heap)
+                del self.entries[entry[2]]
+                function, args = entry[3]
+                try:
+                    if self.executor is not None:
+                        self.executor.submit(function, *args)
+                    else:
+                        threading.Thread(target=function, args=args).start()
+                except:
+                    traceback.print_exc()
+
+    def stop(self):
+        """ Stops the scheduler thread. Entries that were not called yet are dropped.
+        """
+        with self.condition:
+            self.is_stopped = True
+            self.heap = []
+            self.entries = {}
+            self.removed_count = 0
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
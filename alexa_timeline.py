@@ -0,0 +1,163 @@
+import json
+import logging
+import threading
+import time
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+
+def log_sink(timeline):
+    """ Timeline sink that writes a one line summary of each timeline to the log (logging module, INFO level).
+
+    :param timeline: finished timeline dictionary (see TimelineRecorder.finish)
+    """
+    stages = ", ".join("%s +%.1f ms" % (stage['stage'], stage['time'] * 1000) for stage in timeline['stages'])
+    logger.info("Dialog %s (%.1f ms): %s", timeline['dialogRequestId'], timeline['duration'] * 1000, stages)
+
+
+class JSONLSink:
+    """ Timeline sink that appends each timeline to a file as a single line of JSON.
+    """
+    def __init__(self, path):
+        """ Opens the file (timelines are appended to any existing ones).
+
+        :param path: complete path including file name of the JSONL file
+        """
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def __call__(self, timeline):
+        line = json.dumps(timeline) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        """ Closes the file.
+        """
+        with self.lock:
+            self.file.close()
+
+
+class TimelineRecorder:
+    """ Records a timeline of monotonic timestamps for each dialog (keyed by dialogRequestId), one mark per stage
+        (e.g. capture_start, request_sent, first_response_byte, playback_end). Finished timelines are handed to a
+        sink, which is any function that takes the timeline dictionary (e.g. log_sink, a JSONLSink or a callback).
+
+        Recording is disabled if there is no sink, in which case every call returns right away.
+    """
+    def __init__(self, sink=None):
+        """ Initialize the TimelineRecorder.
+
+        :param sink: (optional) function that receives each finished timeline, recording is disabled if None
+        """
+        self.sink = sink
+        self.lock = threading.Lock()
+        # Timelines that are being recorded (dialogRequestId: timeline). Marks made before the dialogRequestId is
+        # known (e.g. while capturing audio) are kept under None, until start is called.
+        self.timelines = {}
+
+    def mark(self, stage, dialog_request_id=None):
+        """ Records the current time for a stage of a dialog.
+
+        :param stage: name of the stage
+        :param dialog_request_id: (optional) dialogRequestId of the dialog, or None if it is not known yet (the mark
+                                  is added to the dialog that is started next)
+        """
+        if self.sink is None:
+            return
+        mark_time = time.monotonic()
+        with self.lock:
+            timeline = self.timelines.get(dialog_request_id)
+            if timeline is None:
+                timeline = self.timelines[dialog_request_id] = {'marks': [], 'pending': 0, 'is_finished': False}
+            timeline['marks'].append((stage, mark_time))
+
+    def start(self, dialog_request_id):
+        """ Called when the dialogRequestId of a dialog is known. Any marks that were made without a dialogRequestId
+            are moved to the dialog.
+
+        :param dialog_request_id: dialogRequestId of the dialog
+        """
+        if self.sink is None:
+            return
+        with self.lock:
+            pending = self.timelines.pop(None, None)
+            timeline = self.timelines.get(dialog_request_id)
+            if timeline is None:
+                timeline = self.timelines[dialog_request_id] = {'marks': [], 'pending': 0, 'is_finished': False}
+            if pending is not None:
+                timeline['marks'].extend(pending['marks'])
+
+    def discard(self, dialog_request_id=None):
+        """ Drops a timeline without sending it to the sink (e.g. marks made while the user did not speak).
+
+        :param dialog_request_id: (optional) dialogRequestId of the dialog, by default the marks that were made
+                                  without a dialogRequestId
+        """
+        if self.sink is None:
+            return
+        with self.lock:
+            self.timelines.pop(dialog_request_id, None)
+
+    def track(self, dialog_request_id, future, stage):
+        """ Marks a stage when a future is done (e.g. the response to SpeechFinished, which is processed in the
+            background). The timeline is not sent to the sink before all of its tracked futures are done.
+
+        :param dialog_request_id: dialogRequestId of the dialog
+        :param future: concurrent.futures.Future (or asyncio.Future)
+        :param stage: name of the stage marked when the future is done
+        """
+        if self.sink is None or dialog_request_id is None:
+            return
+        with self.lock:
+            timeline = self.timelines.get(dialog_request_id)
+            if timeline is None:
+                timeline = self.timelines[dialog_request_id] = {'marks': [], 'pending': 0, 'is_finished': False}
+            timeline['pending'] += 1
+
+        def done(_):
+            self.mark(stage, dialog_request_id)
+            with self.lock:
+                timeline['pending'] -= 1
+            self.emit_if_finished(dialog_request_id)
+
+        future.add_done_callback(done)
+
+    def finish(self, dialog_request_id):
+        """ Called when a dialog is finished. The timeline is sent to the sink, as soon as all of its tracked futures
+            are done.
+
+        :param dialog_request_id: dialogRequestId of the dialog
+        """
+        if self.sink is None:
+            return
+        with self.lock:
+            timeline = self.timelines.get(dialog_request_id)
+            if timeline is None:
+                return
+            timeline['is_finished'] = True
+        self.emit_if_finished(dialog_request_id)
+
+    def emit_if_finished(self, dialog_request_id):
+        """ Sends a timeline to the sink if it is finished and nothing is pending.
+
+        :param dialog_request_id: dialogRequestId of the dialog
+        """
+        with self.lock:
+            timeline = self.timelines.get(dialog_request_id)
+            if timeline is None or not timeline['is_finished'] or timeline['pending'] > 0:
+                return
+            del self.timelines[dialog_request_id]
+
+        marks = sorted(timeline['marks'], key=lambda stage_mark: stage_mark[1])
+        start_time = marks[0][1] if marks else 0
+        self.sink({
+            'dialogRequestId': dialog_request_id,
+            'start_time': start_time,
+            'duration': marks[-1][1] - start_time if marks else 0,
+            'stages': [{'stage': stage, 'time': mark_time - start_time} for stage, mark_time in marks]
+        })
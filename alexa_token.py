@@ -0,0 +1,315 @@
+import time
+import threading
+import requests
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+TOKEN_URL = "https://api.amazon.com/auth/o2/token"
+
+
+class TokenManager:
+    """ This object keeps an up to date access token for one device (refresh_token). Tokens are refreshed by a
+        background thread before they expire, so getting a token does not wait for the token endpoint unless no
+        valid token is available (e.g. the very first request). All token requests use one keep-alive HTTP session.
+    """
+    def __init__(self, client_id, client_secret, refresh_token, session=None, token_url=TOKEN_URL,
+                 refresh_margin=300, request_timeout=10):
+        """ Initialize the TokenManager. The background thread is not started until start is called.
+
+        :param client_id: Client_ID from the configuration
+        :param client_secret: Client_Secret from the configuration
+        :param refresh_token: refresh_token from the configuration
+        :param session: (optional) requests.Session used for token requests, which can be shared between
+                        TokenManager objects (a new session is created if not specified)
+        :param token_url: (optional) URL of the token endpoint
+        :param refresh_margin: (optional) seconds before the token expires that a new token is requested
+        :param request_timeout: (optional) seconds a token request may take to connect, and between bytes of the
+                                response, before it fails (and is retried)
+        """
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_token = refresh_token
+        self.session = session if session is not None else requests.Session()
+        self.token_url = token_url
+        self.refresh_margin = refresh_margin
+        self.request_timeout = request_timeout
+
+        # Current token, and the time (time.monotonic) when it expires
+        self.token = None
+        self.expire_time = None
+
+        # Only one refresh is done at a time, threads that need a token wait for the refresh in progress
+        self.condition = threading.Condition()
+        self.refresh_in_progress = False
+        # Incremented after each refresh attempt (successful or not)
+        self.refresh_generation = 0
+
+        # Statistics
+        self.refresh_count = 0
+        self.failure_count = 0
+        self.blocked_count = 0
+        self.total_refresh_time = 0
+        self.last_refresh_time = None
+
+        self.stop_event = threading.Event()
+        self.refresh_thread = None
+
+    def start(self):
+        """ Starts the background thread that refreshes the token before it expires.
+        """
+        self.refresh_thread = threading.Thread(target=self.refresh_thread_function)
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+
+    def stop(self):
+        """ Stops the background thread.
+        """
+        self.stop_event.set()
+
+    def get_token(self):
+        """ Gets a valid token. This only waits for the token endpoint if there is no valid token (the background
+            thread normally refreshes the token before it expires).
+
+        :return: a valid token
+        """
+        with self.condition:
+            if self.token is not None and time.monotonic() < self.expire_time:
+                return self.token
+            self.blocked_count += 1
+        return self.refresh(force=False)
+
+    def get_cached_token(self):
+        """ Gets the current token without ever waiting for the token endpoint (e.g. from an asyncio event loop).
+
+        :return: a valid token, or None if there is no valid token
+        """
+        with self.condition:
+            if self.token is not None and time.monotonic() < self.expire_time:
+                return self.token
+        return None
+
+    def refresh(self, force=True):
+        """ Requests a new token. If another thread is already refreshing the token, this waits for that refresh to
+            finish and uses its result instead of sending another request.
+
+        :param force: (optional, default=True) if False, no request is sent when the current token is still valid
+        :return: the new token
+        """
+        with self.condition:
+            if not force and self.token is not None and time.monotonic() < self.expire_time:
+                return self.token
+            if self.refresh_in_progress:
+                generation = self.refresh_generation
+                while self.refresh_generation == generation:
+                    self.condition.wait()
+                if self.token is None or time.monotonic() >= self.expire_time:
+                    raise NameError("Token refresh failed")
+                return self.token
+            self.refresh_in_progress = True
+
+        start_time = time.monotonic()
+        try:
+            token, expires_in = self.request_token()
+        except:
+            with self.condition:
+                self.failure_count += 1
+                self.refresh_in_progress = False
+                self.refresh_generation += 1
+                self.condition.notify_all()
+            raise
+        refresh_time = time.monotonic() - start_time
+
+        with self.condition:
+            self.token = token
+            self.expire_time = start_time + expires_in
+            self.refresh_count += 1
+            self.total_refresh_time += refresh_time
+            self.last_refresh_time = refresh_time
+            self.refresh_in_progress = False
+            self.refresh_generation += 1
+            self.condition.notify_all()
+        return token
+
+    def request_token(self):
+        """ Sends the actual request to the token endpoint using the refresh_token.
+
+        :return: (token, expires_in) the new token, and the number of seconds until it expires
+        """
+        payload = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "refresh_token": self.refresh_token,
+            "grant_type": "refresh_token",
+        }
+        # Every thread waiting for a token waits for this request, so it must not hang (requests.Timeout is raised)
+        r = self.session.post(self.token_url, data=payload, timeout=self.request_timeout)
+        if r.status_code != 200:
+            raise NameError("Bad token status (%s)" % r.status_code)
+        resp = r.json()
+        return resp['access_token'], resp.get('expires_in', 3600)
+
+    def get_refresh_delay(self):
+        """ Gets the number of seconds until the token should be refreshed.
+
+        :return: seconds until the next refresh (0 or less if a refresh is due)
+        """
+        with self.condition:
+            if self.token is None:
+                return 0
+            return self.expire_time - self.refresh_margin - time.monotonic()
+
+    def refresh_thread_function(self):
+        """ Background thread that refreshes the token before it expires. Failed refreshes are retried with an
+            increasing delay (up to a minute).
+        """
+        retry_delay = 1
+        while not self.stop_event.is_set():
+            refresh_delay = self.get_refresh_delay()
+            if refresh_delay > 0:
+                self.stop_event.wait(refresh_delay)
+                continue
+            try:
+                self.refresh()
+                retry_delay = 1
+            except:
+                print("Token refresh failed, retrying in %d seconds." % retry_delay)
+                self.stop_event.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+
+    def get_stats(self):
+        """ Gets the refresh statistics.
+
+        :return: dictionary with the number of refreshes, failed refreshes and token requests that had to wait for
+                 a refresh, and the last and mean refresh latency in seconds
+        """
+        with self.condition:
+            return {
+                'refresh_count': self.refresh_count,
+                'failure_count': self.failure_count,
+                'blocked_count': self.blocked_count,
+                'last_refresh_time': self.last_refresh_time,
+                'mean_refresh_time': self.total_refresh_time / self.refresh_count if self.refresh_count else None
+            }
+
+
+class TokenRefresher:
+    """ Refreshes the tokens of many TokenManager objects (e.g. one per device) from a single background thread,
+        instead of one thread per TokenManager. All of the TokenManager objects created by the refresher share one
+        keep-alive HTTP session.
+    """
+    def __init__(self, session=None):
+        """ Initialize the TokenRefresher. The background thread is not started until start is called.
+
+        :param session: (optional) requests.Session shared by the token managers (created if not specified)
+        """
+        self.session = session if session is not None else requests.Session()
+        self.token_managers = []
+        # Failed token managers are not retried before their retry time (token_manager: (retry_time, retry_delay))
+        self.retries = {}
+        self.condition = threading.Condition()
+        self.is_stopped = False
+        self.refresh_thread = None
+
+    def create_token_manager(self, client_id, client_secret, refresh_token, **kwargs):
+        """ Creates a TokenManager that uses the shared session, and adds it to the refresher. The TokenManager
+            must not be started (the refresher refreshes its token).
+
+        :param client_id: Client_ID from the configuration
+        :param client_secret: Client_Secret from the configuration
+        :param refresh_token: refresh_token from the configuration
+        :param kwargs: any other keyword arguments for TokenManager
+        :return: TokenManager object
+        """
+        token_manager = TokenManager(client_id, client_secret, refresh_token, session=self.session, **kwargs)
+        self.add(token_manager)
+        return token_manager
+
+    def add(self, token_manager):
+        """ Adds a TokenManager, whose token is refreshed from now on.
+
+        :param token_manager: TokenManager object (not started)
+        """
+        with self.condition:
+            self.token_managers.append(token_manager)
+            self.condition.notify_all()
+
+    def remove(self, token_manager):
+        """ Removes a TokenManager, whose token is no longer refreshed.
+
+        :param token_manager: TokenManager object
+        """
+        with self.condition:
+            if token_manager in self.token_managers:
+                self.token_managers.remove(token_manager)
+            self.retries.pop(token_manager, None)
+
+    def start(self):
+        """ Starts the background thread that refreshes the tokens.
+        """
+        self.refresh_thread = threading.Thread(target=self.refresh_thread_function)
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+
+    def stop(self):
+        """ Stops the background thread.
+        """
+        with self.condition:
+            self.is_stopped = True
+            self.condition.notify_all()
+
+    def get_next_refresh(self):
+        """ Finds the token manager that needs to be refreshed first. Must be called with the condition held.
+
+        :return: (token_manager, delay) the token manager (None if there are none), and the seconds until it should
+                 be refreshed (0 or less if a refresh is due)
+        """
+        now = time.monotonic()
+        next_token_manager = None
+        next_delay = None
+        for token_manager in self.token_managers:
+            delay = token_manager.get_refresh_delay()
+            if token_manager in self.retries:
+                delay = max(delay, self.retries[token_manager][0] - now)
+            if next_delay is None or delay < next_delay:
+                next_token_manager = token_manager
+                next_delay = delay
+        return next_token_manager, next_delay
+
+    def refresh_thread_function(self):
+        """ Background thread that refreshes each token before it expires. Failed refreshes are retried with an
+            increasing delay (up to a minute) per token manager, without delaying the other token managers.
+        """
+        while True:
+            with self.condition:
+                if self.is_stopped:
+                    break
+                token_manager, delay = self.get_next_refresh()
+                if token_manager is None or delay > 0:
+                    self.condition.wait(delay)
+                    continue
+            try:
+                token_manager.refresh()
+                with self.condition:
+                    self.retries.pop(token_manager, None)
+            except:
+                with self.condition:
+                    retry_delay = self.retries[token_manager][1] * 2 if token_manager in self.retries else 1
+                    retry_delay = min(retry_delay, 60)
+                    self.retries[token_manager] = (time.monotonic() + retry_delay, retry_delay)
+                print("Token refresh failed, retrying in %d seconds." % retry_delay)
+
+    def get_stats(self):
+        """ Gets the refresh statistics of all token managers combined.
+
+        :return: dictionary with the number of token managers, refreshes, failed refreshes and token requests that
+                 had to wait for a refresh
+        """
+        with self.condition:
+            token_managers = list(self.token_managers)
+        stats = {'token_managers': len(token_managers), 'refresh_count': 0, 'failure_count': 0, 'blocked_count': 0}
+        for token_manager in token_managers:
+            token_manager_stats = token_manager.get_stats()
+            for name in ['refresh_count', 'failure_count', 'blocked_count']:
+                stats[name] += token_manager_stats[name]
+        return stats
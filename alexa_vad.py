@@ -0,0 +1,138 @@
+import time
+
+import numpy
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+class VoiceActivityDetector:
+    """ Voice activity detection and endpointing for 16-bit mono PCM (16 kHz L16 by default). Audio is split into
+        short frames, and the energy (dB) and zero-crossing rate of every frame are computed at once with numpy. A
+        frame is speech if its energy is well above the noise floor, and it does not cross zero as often as noise
+        (hiss) does. The noise floor follows the energy of the frames that are not speech, dropping quickly and
+        rising slowly.
+
+        How the noise floor moves depends on the decision for each frame, which in turn depends on the noise floor,
+        so this part (and the endpointing) cannot be computed as one numpy operation (it is not a linear filter). It
+        is done frame by frame on Python floats, which costs about a microsecond per frame (see get_stats, and
+        benchmarks/vad.py), a small part of the total and well under 0.1% of the 20 ms a frame lasts.
+
+        Speech starts after speech_start_duration of speech, and ends after speech_end_duration of silence (see
+        is_speaking). A shorter end duration ends a request sooner, at the risk of cutting it off between words.
+    """
+    def __init__(self, rate=16000, frame_duration=0.02, threshold=10, min_energy=30, max_zero_crossing_rate=0.4,
+                 speech_start_duration=0.06, speech_end_duration=0.5):
+        """ Initialize the VoiceActivityDetector.
+
+        :param rate: (optional) sample rate of the audio
+        :param frame_duration: (optional) seconds per frame
+        :param threshold: (optional) dB above the noise floor for a frame to be speech
+        :param min_energy: (optional) minimum energy in dB (relative to one LSB) for a frame to be speech
+        :param max_zero_crossing_rate: (optional) maximum fraction of samples that cross zero for a frame to be speech
+        :param speech_start_duration: (optional) seconds of speech before speech starts
+        :param speech_end_duration: (optional) seconds of silence before speech ends
+        """
+        self.rate = rate
+        self.frame_samples = int(rate * frame_duration)
+        self.threshold = threshold
+        self.min_energy = min_energy
+        self.max_zero_crossing_rate = max_zero_crossing_rate
+        self.speech_start_frames = max(1, int(round(speech_start_duration / frame_duration)))
+        self.speech_end_frames = max(1, int(round(speech_end_duration / frame_duration)))
+
+        # Time spent processing, used for the statistics
+        self.frame_count = 0
+        self.speech_frame_count = 0
+        self.process_time = 0
+        self.tracking_time = 0
+        self.reset()
+
+    def reset(self):
+        """ Resets the detector's state (noise floor and endpointing) before a new capture. Statistics are kept.
+        """
+        self.remainder = b''
+        self.noise_floor = None
+        self.is_speaking = False
+        self.speech_run = 0
+        self.silence_run = 0
+
+    def get_features(self, samples):
+        """ Computes the features of each frame.
+
+        :param samples: numpy int16 array, a whole number of frames
+        :return: (energy, zero_crossing_rate) numpy arrays, one value per frame (energy in dB)
+        """
+        frames = samples.reshape(-1, self.frame_samples).astype(numpy.float32)
+        energy = 10 * numpy.log10(numpy.mean(frames * frames, axis=1) + 1)
+        signs = numpy.signbit(frames)
+        zero_crossing_rate = numpy.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / self.frame_samples
+        return energy, zero_crossing_rate
+
+    def process(self, raw_audio):
+        """ Processes audio, and updates is_speaking. Audio that does not fill a whole frame is kept for the next call.
+
+        :param raw_audio: raw binary audio string (PCM)
+        :return: numpy boolean array with the decision of each frame (True is speech)
+        """
+        start_time = time.perf_counter()
+        data = self.remainder + raw_audio
+        frame_bytes = self.frame_samples * 2
+        frame_count = len(data) // frame_bytes
+        self.remainder = data[frame_count * frame_bytes:]
+        if frame_count == 0:
+            return numpy.zeros(0, dtype=bool)
+
+        energy, zero_crossing_rate = self.get_features(
+            numpy.frombuffer(data, dtype=numpy.int16, count=frame_count * self.frame_samples))
+        if self.noise_floor is None:
+            self.noise_floor = float(energy[0])
+
+        is_voiced = (energy > self.min_energy) & (zero_crossing_rate <= self.max_zero_crossing_rate)
+        # The noise floor depends on the previous decisions, so this part is done frame by frame (on Python values,
+        # indexing numpy arrays one element at a time is slower)
+        tracking_start_time = time.perf_counter()
+        decisions = []
+        for frame_energy, is_frame_voiced in zip(energy.tolist(), is_voiced.tolist()):
+            is_speech = is_frame_voiced and frame_energy > self.noise_floor + self.threshold
+            decisions.append(is_speech)
+            if frame_energy < self.noise_floor:
+                self.noise_floor += 0.5 * (frame_energy - self.noise_floor)
+            elif not is_speech:
+                self.noise_floor += 0.05 * (frame_energy - self.noise_floor)
+            else:
+                # Rise very slowly during speech too, so a sudden constant noise does not count as speech forever
+                self.noise_floor += 0.002 * (frame_energy - self.noise_floor)
+
+            # Endpointing
+            if is_speech:
+                self.speech_run += 1
+                self.silence_run = 0
+            else:
+                self.silence_run += 1
+                self.speech_run = 0
+            if not self.is_speaking and self.speech_run >= self.speech_start_frames:
+                self.is_speaking = True
+            elif self.is_speaking and self.silence_run >= self.speech_end_frames:
+                self.is_speaking = False
+
+        decisions = numpy.array(decisions, dtype=bool)
+        end_time = time.perf_counter()
+        self.frame_count += frame_count
+        self.speech_frame_count += int(numpy.count_nonzero(decisions))
+        self.process_time += end_time - start_time
+        self.tracking_time += end_time - tracking_start_time
+        return decisions
+
+    def get_stats(self):
+        """ Gets the processing statistics.
+
+        :return: dictionary with the number of frames (and speech frames) processed, and the time per frame in
+                 microseconds (in total, and of the part that is done frame by frame)
+        """
+        return {
+            'frames': self.frame_count,
+            'speech_frames': self.speech_frame_count,
+            'time_per_frame_us': self.process_time / self.frame_count * 1e6 if self.frame_count else None,
+            'tracking_time_per_frame_us': self.tracking_time / self.frame_count * 1e6 if self.frame_count else None
+        }
@@ -0,0 +1,271 @@
+import argparse
+import collections
+import concurrent.futures
+import math
+import os
+import threading
+import time
+
+import helper
+import alexa_communication
+import alexa_context
+import alexa_token
+
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+def get_pcm_files(paths):
+    """ Gets the recordings to send. Directories are searched (recursively) for .pcm files.
+
+    :param paths: list of file and directory paths
+    :return: list of file paths (the files found in each directory are sorted)
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        found = []
+        for directory, _, names in os.walk(path):
+            found += [os.path.join(directory, name) for name in names if name.lower().endswith('.pcm')]
+        files += sorted(found)
+    return files
+
+
+def get_percentile(sorted_values, percent):
+    """ Gets a percentile of a sorted list (nearest rank).
+
+    :param sorted_values: sorted list of values (not empty)
+    :param percent: percentile to get (0 to 100)
+    :return: value at the percentile
+    """
+    # The smallest value that at least percent of the values are less than or equal to
+    index = max(0, math.ceil(len(sorted_values) * percent / 100) - 1)
+    return sorted_values[index]
+
+
+def get_default_context():
+    """ Gets the context sent with every Recognize event (the default AudioPlayer and Speaker state, like a device
+        that is not playing anything).
+
+    :return: function that supplies the context
+    """
+    context_store = alexa_context.ContextStore()
+    context_store.set(alexa_context.get_playback_state_context())
+    context_store.set(alexa_context.get_volume_state_context())
+    return context_store.get_context
+
+
+class BatchRecognizer:
+    """ Sends recorded utterances (raw PCM, 16 kHz, 16 bit, mono) as Recognize events without a microphone, and
+        collects the directives and the latency of each one. Several files are in flight at the same time, spread
+        over one or more connections (each connection is shared by the files assigned to it).
+
+        The responses are processed by the thread that sent the event (see
+        AlexaConnection.get_and_process_response), so each thread collects its own directives. Directives pushed on
+        the downchannel are counted separately.
+    """
+    def __init__(self, create_connection, connections=1, concurrency=4):
+        """ Initialize the BatchRecognizer and open its connections.
+
+        :param create_connection: function that takes a process_response_handle and returns an AlexaConnection
+        :param connections: (optional) number of connections
+        :param concurrency: (optional) number of files in flight at the same time
+        """
+        self.concurrency = concurrency
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.downchannel_directives = 0
+        self.connections = [create_connection(self.process_response) for _ in range(connections)]
+
+    def process_response(self, message):
+        """ Processes every message received by the connections. Attachments are read completely (like playback
+            would).
+
+        :param message: message received from AVS
+        """
+        receive_time = time.perf_counter()
+        attachment_bytes = sum(len(attachment if isinstance(attachment, bytes) else attachment.read())
+                               for attachment in message['attachment'])
+        messages = getattr(self.local, 'messages', None)
+        if messages is None:
+            # The downchannel (no Recognize event is waiting on this thread)
+            with self.lock:
+                self.downchannel_directives += len(message['content'])
+        else:
+            messages.append((receive_time, message, attachment_bytes))
+
+    def recognize_file(self, connection, path):
+        """ Sends one recording as a Recognize event, and processes its response.
+
+        :param connection: AlexaConnection to send the event with
+        :param path: path of the recording
+        :return: result dictionary (file, directives, attachment bytes, latencies in seconds, and the error if the
+                 event failed)
+        """
+        with open(path, 'rb') as file:
+            raw_audio = file.read()
+        result = {
+            'file': path,
+            'audio_seconds': len(raw_audio) / 2 / 16000,
+            'directives': [],
+            'attachment_bytes': 0,
+            'latency': None,
+            'first_directive_latency': None,
+            'error': None
+        }
+        self.local.messages = []
+        start_time = time.perf_counter()
+        try:
+            stream_id = connection.start_recognize_event(raw_audio)
+            connection.get_and_process_response(stream_id)
+            result['latency'] = time.perf_counter() - start_time
+        except (NameError, OSError, EOFError) as error:
+            result['error'] = "%s: %s" % (type(error).__name__, error)
+        finally:
+            messages = self.local.messages
+            self.local.messages = None
+
+        for receive_time, message, attachment_bytes in messages:
+            if result['first_directive_latency'] is None:
+                result['first_directive_latency'] = receive_time - start_time
+            result['directives'] += [content['directive'] for content in message['content']]
+            result['attachment_bytes'] += attachment_bytes
+        return result
+
+    def run(self, paths):
+        """ Sends every recording, with up to concurrency of them in flight. File i is sent on connection
+            i % connections.
+
+        :param paths: list of recording paths
+        :return: (results, elapsed) list of result dictionaries (in the order of paths), and the seconds it took
+        """
+        start_time = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self.recognize_file, self.connections[index % len(self.connections)], path)
+                       for index, path in enumerate(paths)]
+            results = [future.result() for future in futures]
+        return results, time.perf_counter() - start_time
+
+    def close(self):
+        """ Closes the connections.
+        """
+        for connection in self.connections:
+            connection.close()
+
+
+def get_summary(results, elapsed):
+    """ Summarizes the results of a batch.
+
+    :param results: list of result dictionaries (see BatchRecognizer.recognize_file)
+    :param elapsed: seconds the batch took
+    :return: summary dictionary (counts, throughput, latency percentiles in milliseconds and directive counts)
+    """
+    succeeded = [result for result in results if result['error'] is None]
+    summary = {
+        'files': len(results),
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'elapsed': elapsed,
+        'files_per_second': len(results) / elapsed if elapsed else None,
+        'audio_seconds': sum(result['audio_seconds'] for result in results),
+        'directives': dict(collections.Counter(
+            "%s.%s" % (directive['header']['namespace'], directive['header']['name'])
+            for result in succeeded for directive in result['directives']))
+    }
+    for key in ('latency', 'first_directive_latency'):
+        latencies = sorted(result[key] for result in succeeded if result[key] is not None)
+        summary[key + '_ms'] = {
+            'p50': get_percentile(latencies, 50) * 1000,
+            'p95': get_percentile(latencies, 95) * 1000,
+            'p99': get_percentile(latencies, 99) * 1000,
+            'max': latencies[-1] * 1000
+        } if latencies else None
+    return summary
+
+
+def print_summary(summary):
+    """ Prints a summary of a batch.
+
+    :param summary: summary dictionary (see get_summary)
+    """
+    print("%d files (%.1f s of audio), %d failed, %.1f s, %.2f files/s" % (
+        summary['files'], summary['audio_seconds'], summary['failed'], summary['elapsed'],
+        summary['files_per_second'] or 0))
+    for key, name in (('latency_ms', "latency"), ('first_directive_latency_ms', "first directive")):
+        latencies = summary[key]
+        if latencies is None:
+            print("%-16s no responses" % name)
+        else:
+            print("%-16s p50 %8.2f ms   p95 %8.2f ms   p99 %8.2f ms   max %8.2f ms" % (
+                name, latencies['p50'], latencies['p95'], latencies['p99'], latencies['max']))
+    for name, count in sorted(summary['directives'].items()):
+        print("%-40s %d" % (name, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sends recorded utterances (raw PCM, 16 kHz, 16 bit, mono) as "
+                                                 "Recognize events, and summarizes the directives and latencies.")
+    parser.add_argument('paths', nargs='+', help="recordings, or directories of .pcm recordings")
+    parser.add_argument('--connections', type=int, default=1, help="number of connections")
+    parser.add_argument('--concurrency', type=int, default=4, help="number of files in flight at the same time")
+    parser.add_argument('--repeat', type=int, default=1, help="number of times each file is sent")
+    parser.add_argument('--output', help="JSON file the summary and the result of every file are written to")
+    parser.add_argument('--config', default='config.dict', help="config dictionary (with a refresh_token)")
+    parser.add_argument('--stand-in', action='store_true',
+                        help="send the events to a local stand-in server (benchmarks.avs_server) instead of AVS")
+    parser.add_argument('--stand-in-latency', type=float, default=0.05,
+                        help="seconds the stand-in server takes to answer an event")
+    args = parser.parse_args()
+
+    paths = get_pcm_files(args.paths) * args.repeat
+    if not paths:
+        raise KeyError("No recordings found.")
+
+    server = None
+    token_manager = None
+    if args.stand_in:
+        from benchmarks import avs_server
+        server = avs_server.StandInServer(response_delay=args.stand_in_latency)
+        server.start()
+        token_manager = avs_server.StandInTokenManager()
+
+        def create_connection(process_response_handle):
+            return avs_server.connect(server, process_response_handle, context_handle=get_default_context(),
+                                      token_manager=token_manager)
+    else:
+        config = helper.read_dict(args.config)
+        # The connections share one token manager
+        token_manager = alexa_token.TokenManager(config['Client_ID'], config['Client_Secret'],
+                                                 config['refresh_token'])
+        token_manager.start()
+
+        def create_connection(process_response_handle):
+            return alexa_communication.AlexaConnection(config, context_handle=get_default_context(),
+                                                       process_response_handle=process_response_handle,
+                                                       token_manager=token_manager)
+
+    batch_recognizer = None
+    try:
+        batch_recognizer = BatchRecognizer(create_connection, args.connections, args.concurrency)
+        results, elapsed = batch_recognizer.run(paths)
+    finally:
+        if batch_recognizer is not None:
+            batch_recognizer.close()
+        token_manager.stop()
+        if server is not None:
+            server.stop()
+
+    summary = get_summary(results, elapsed)
+    print_summary(summary)
+    for result in results:
+        if result['error'] is not None:
+            print("%s failed (%s)" % (result['file'], result['error']))
+    if args.output is not None:
+        helper.write_dict(args.output, {'summary': summary, 'results': results})
+
+
+if __name__ == "__main__":
+    main()
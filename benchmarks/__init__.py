@@ -0,0 +1,9 @@
+"""
+Benchmarks for the Alexa Voice Service client. Each benchmark is run from the project's folder as a module, e.g.
+
+    python -m benchmarks.downchannel_latency
+
+"""
+
+__author__ = "NJC"
+__license__ = "MIT"
@@ -0,0 +1,79 @@
+"""
+Compares the audio encoders of alexa_encoder on files/example_get_time.pcm: the bytes uploaded for the Recognize
+event (and the bytes saved compared to PCM), and the CPU time spent encoding (including the encoder process). The
+audio is passed to the encoder in the same chunks as it is captured, like a streamed Recognize event.
+
+    python -m benchmarks.audio_encoding --bitrates 16000 24000 32000
+
+The Opus encoder needs ffmpeg (built with libopus), see --ffmpeg.
+"""
+
+import argparse
+import functools
+import os
+import time
+
+import alexa_encoder
+from benchmarks import avs_server
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+CHUNK_BYTES = 1024 * 2
+
+
+def measure_encoder(create_encoder, audio, repeat):
+    """ Encodes the audio chunk by chunk, and measures the time spent.
+
+    :param create_encoder: function that creates the encoder
+    :param audio: raw binary audio string (PCM, 16 kHz, 16 bit, mono)
+    :param repeat: number of times the audio is encoded
+    :return: (size, wall_time, cpu_time) bytes of encoded audio, and seconds per encoding
+    """
+    size = 0
+    times_before = os.times()
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        encoder = create_encoder()
+        size = 0
+        for offset in range(0, len(audio), CHUNK_BYTES):
+            size += len(encoder.encode(audio[offset:offset + CHUNK_BYTES]))
+        size += len(encoder.finish())
+    wall_time = time.perf_counter() - start_time
+    times_after = os.times()
+    # CPU time of this process and of the encoder processes
+    cpu_time = sum(times_after[index] - times_before[index] for index in range(4))
+    return size, wall_time / repeat, cpu_time / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the upload size and CPU cost of the audio encoders.")
+    parser.add_argument('--pcm', default=avs_server.DEFAULT_SPEAK_ATTACHMENT,
+                        help="recording to encode (raw PCM, 16 kHz, 16 bit, mono)")
+    parser.add_argument('--bitrates', type=int, nargs='+', default=[16000, 24000, 32000],
+                        help="Opus bit rates in bit/s")
+    parser.add_argument('--ffmpeg', default='ffmpeg/bin/ffmpeg', help="path to ffmpeg")
+    parser.add_argument('--repeat', type=int, default=5, help="number of times the recording is encoded")
+    args = parser.parse_args()
+
+    with open(args.pcm, 'rb') as file:
+        audio = file.read()
+    duration = len(audio) / 2 / 16000
+    print("%s: %.2f s, %d bytes of PCM" % (args.pcm, duration, len(audio)))
+
+    encoders = [('PCM', alexa_encoder.PCMEncoder)]
+    encoders += [('Opus %d bit/s' % bitrate, functools.partial(alexa_encoder.OpusEncoder, bitrate, args.ffmpeg))
+                 for bitrate in args.bitrates]
+    for name, create_encoder in encoders:
+        try:
+            size, wall_time, cpu_time = measure_encoder(create_encoder, audio, args.repeat)
+        except OSError as error:
+            print("%-20s not available (%s)" % (name, error))
+            continue
+        print("%-20s %8d bytes (%6.1f kbit/s, %5.1f%% saved)   %8.2f ms CPU   %8.2f ms wall   %6.2f ms CPU/s audio"
+              % (name, size, size * 8 / duration / 1000, 100 * (1 - size / len(audio)), cpu_time * 1000,
+                 wall_time * 1000, cpu_time * 1000 / duration))
+
+
+if __name__ == "__main__":
+    main()
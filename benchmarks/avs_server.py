@@ -0,0 +1,395 @@
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+import h2.config
+import h2.connection
+import h2.events
+
+import alexa_communication
+import alexa_token
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+# Default attachment of the canned Speak directive (the repository has no MP3 file, pass one as speak_attachment)
+DEFAULT_SPEAK_ATTACHMENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'files',
+                                        'example_get_time.pcm')
+
+
+def get_event_from_body(headers, body):
+    """ Gets the event (header and payload) from the metadata part of an event's body.
+
+    :param headers: dictionary of request headers (contains the boundary)
+    :param body: binary string of the request body
+    :return: event dictionary, or None if the body does not contain an event
+    """
+    boundary = headers.get('content-type', '').partition('boundary=')[2].encode()
+    metadata_start = body.find(b'\n\n')
+    if not boundary or metadata_start == -1:
+        return None
+    metadata_end = body.find(b'--' + boundary, metadata_start)
+    try:
+        return json.loads(body[metadata_start:metadata_end].decode())['event']
+    except (ValueError, KeyError):
+        return None
+
+
+def encode_part(boundary, content, content_type=b'application/json; charset=UTF-8'):
+    """ Encodes a single message part, the way AVS sends it. The part ends with the boundary, so it can be parsed
+        as soon as it is received.
+
+    :param boundary: boundary used in message
+    :param content: JSON serializable dictionary, or a binary string for octet stream parts
+    :param content_type: (optional) content type of the part
+    :return: binary string of the encoded part
+    """
+    if isinstance(content, dict):
+        content = json.dumps(content).encode()
+    return b'\r\nContent-Type: ' + content_type + b'\r\n\r\n' + content + b'\r\n--' + boundary
+
+
+class StandInConnection:
+    """ A single HTTP/2 client connection to the StandInServer. Each connection runs its own thread that reads
+        from the socket, and each request is answered from a separate thread.
+    """
+    def __init__(self, server, sock):
+        """ Initialize the connection and start the thread that reads from the socket.
+
+        :param server: StandInServer that accepted the connection
+        :param sock: socket of the accepted connection
+        """
+        self.server = server
+        self.sock = sock
+        # The HTTP/2 state machine and the socket writes are shared by the reader and responder threads
+        self.lock = threading.Lock()
+        self.window_updated = threading.Condition(self.lock)
+        config = h2.config.H2Configuration(client_side=False, header_encoding='utf-8')
+        self.h2_connection = h2.connection.H2Connection(config=config)
+        # Requests that have not ended yet (stream_id: (headers, body))
+        self.requests = {}
+        self.downstream_ids = []
+        self.is_closed = False
+
+        self.thread = threading.Thread(target=self.read_thread)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_thread(self):
+        """ Reads from the socket until the client closes the connection, and hands each finished request to
+            a responder thread.
+        """
+        with self.lock:
+            self.h2_connection.initiate_connection()
+            self.flush()
+        try:
+            while True:
+                data = self.sock.recv(65535)
+                if not data:
+                    break
+                with self.lock:
+                    for event in self.h2_connection.receive_data(data):
+                        self.handle_event(event)
+                    self.flush()
+        except OSError:
+            pass
+        self.close()
+
+    def handle_event(self, event):
+        """ Handles a single HTTP/2 event. Must be called with the lock held.
+
+        :param event: h2.events.Event object
+        """
+        if isinstance(event, h2.events.RequestReceived):
+            self.requests[event.stream_id] = (dict(event.headers), bytearray())
+        elif isinstance(event, h2.events.DataReceived):
+            self.requests[event.stream_id][1].extend(event.data)
+            self.h2_connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            headers, body = self.requests.pop(event.stream_id)
+            responder = threading.Thread(target=self.server.handle_request,
+                                         args=(self, event.stream_id, headers, bytes(body)))
+            responder.daemon = True
+            responder.start()
+        elif isinstance(event, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged)):
+            self.window_updated.notify_all()
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.is_closed = True
+            self.window_updated.notify_all()
+
+    def flush(self):
+        """ Writes any pending HTTP/2 data to the socket. Must be called with the lock held.
+        """
+        data = self.h2_connection.data_to_send()
+        if data and not self.is_closed:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.is_closed = True
+
+    def send_headers(self, stream_id, status, headers=None, end_stream=False):
+        """ Sends the response headers for a stream.
+
+        :param stream_id: stream_id of the request
+        :param status: HTTP status code
+        :param headers: (optional) list of additional (name, value) header tuples
+        :param end_stream: (optional) flag that indicates if the response has no body
+        """
+        with self.lock:
+            if self.is_closed:
+                return
+            self.h2_connection.send_headers(stream_id, [(':status', str(status))] + (headers or []),
+                                            end_stream=end_stream)
+            self.flush()
+
+    def send_data(self, stream_id, data, end_stream=False):
+        """ Sends data on a stream, waiting for the client to open the flow control window when needed.
+
+        :param stream_id: stream_id of the request
+        :param data: binary string to send
+        :param end_stream: (optional) flag that indicates if this is the last data of the response
+        """
+        data = memoryview(data)
+        with self.lock:
+            while not self.is_closed:
+                window = min(self.h2_connection.local_flow_control_window(stream_id),
+                             self.h2_connection.max_outbound_frame_size)
+                if window <= 0:
+                    self.window_updated.wait()
+                    continue
+                chunk = data[:window]
+                data = data[window:]
+                self.h2_connection.send_data(stream_id, chunk.tobytes(), end_stream=end_stream and not data)
+                self.flush()
+                if not data:
+                    break
+
+    def close(self):
+        """ Closes the connection (the client sees the socket close).
+        """
+        with self.lock:
+            self.is_closed = True
+            self.window_updated.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.server.remove_connection(self)
+
+
+class StandInServer:
+    """ A local stand-in for the Alexa Voice Service, which speaks plain text HTTP/2 (use secure=False when
+        connecting). It keeps each /v20160207/directives stream open so directives can be pushed to the client with
+        push_directive, answers /ping with 204 (no content), answers SpeechRecognizer.Recognize events with a canned
+        Speak directive and its attachment, and answers every other event with 204. Latency and failures can be
+        injected into the event responses.
+    """
+    def __init__(self, host='127.0.0.1', port=0, boundary=b'stand-in-boundary', response_delay=0, failure_rate=0,
+                 failure_status=503, speak_attachment=None, seed=None):
+        """ Initialize the StandInServer. The server is not started until start is called.
+
+        :param host: (optional) address to listen on
+        :param port: (optional) port to listen on, 0 picks a free port (see self.port after start)
+        :param boundary: (optional) boundary used for the downchannel and responses
+        :param response_delay: (optional) seconds each event waits before it is answered (simulates processing time)
+        :param failure_rate: (optional) fraction of events (0 to 1) that are answered with failure_status (except
+                             SynchronizeState)
+        :param failure_status: (optional) HTTP status of the failed events
+        :param speak_attachment: (optional) binary string attachment of the canned Speak directive (e.g. an MP3), by
+                                 default the PCM audio in files/example_get_time.pcm
+        :param seed: (optional) seed for the random failures
+        """
+        self.host = host
+        self.port = port
+        self.boundary = boundary
+        self.response_delay = response_delay
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        if speak_attachment is None:
+            with open(DEFAULT_SPEAK_ATTACHMENT, 'rb') as file:
+                speak_attachment = file.read()
+        self.speak_attachment = speak_attachment
+        self.random = random.Random(seed)
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.listen_socket = None
+
+    def start(self):
+        """ Starts listening, and starts the thread that accepts new connections.
+        """
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind((self.host, self.port))
+        self.listen_socket.listen(128)
+        self.port = self.listen_socket.getsockname()[1]
+
+        accept_thread = threading.Thread(target=self.accept_thread)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def accept_thread(self):
+        """ Accepts connections until the server is stopped.
+        """
+        while True:
+            try:
+                sock, _ = self.listen_socket.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.connections_lock:
+                self.connections.append(StandInConnection(self, sock))
+
+    def remove_connection(self, connection):
+        """ Called by a StandInConnection when it is closed.
+
+        :param connection: StandInConnection object
+        """
+        with self.connections_lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def stop(self):
+        """ Stops listening and closes all open connections.
+        """
+        self.listen_socket.close()
+        with self.connections_lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
+
+    def handle_request(self, connection, stream_id, headers, body):
+        """ Answers a single request. This is called from its own thread, so it may block.
+
+        :param connection: StandInConnection the request was received on
+        :param stream_id: stream_id of the request
+        :param headers: dictionary of request headers
+        :param body: binary string of the request body
+        """
+        path = headers[':path']
+        if path == '/v20160207/directives':
+            connection.send_headers(stream_id, 200, [
+                ('content-type', 'multipart/related; boundary=%s; type=application/json' % self.boundary.decode())
+            ])
+            connection.send_data(stream_id, b'--' + self.boundary)
+            with connection.lock:
+                connection.downstream_ids.append(stream_id)
+        elif path == '/ping':
+            connection.send_headers(stream_id, 204, end_stream=True)
+        elif path == '/v20160207/events':
+            if self.response_delay:
+                time.sleep(self.response_delay)
+            event = get_event_from_body(headers, body)
+            name = (event['header']['namespace'], event['header']['name']) if event is not None else None
+            # SynchronizeState never fails, so connections can always be opened
+            if self.failure_rate and name != ('System', 'SynchronizeState') \
+                    and self.random.random() < self.failure_rate:
+                self.send_failure(connection, stream_id)
+            elif name == ('SpeechRecognizer', 'Recognize'):
+                self.send_speak(connection, stream_id, event['header'].get('dialogRequestId'))
+            else:
+                connection.send_headers(stream_id, 204, end_stream=True)
+        else:
+            connection.send_headers(stream_id, 404, end_stream=True)
+
+    def send_speak(self, connection, stream_id, dialog_request_id):
+        """ Answers a Recognize event with the canned Speak directive and its attachment.
+
+        :param connection: StandInConnection the request was received on
+        :param stream_id: stream_id of the request
+        :param dialog_request_id: dialogRequestId of the Recognize event
+        """
+        directive = {
+            'header': {
+                'namespace': 'SpeechSynthesizer',
+                'name': 'Speak',
+                'messageId': 'stand-in-message-id',
+                'dialogRequestId': dialog_request_id
+            },
+            'payload': {
+                'url': 'cid:stand-in-speak',
+                'format': 'AUDIO_MPEG',
+                'token': 'stand-in-token-%d' % stream_id
+            }
+        }
+        connection.send_headers(stream_id, 200, [
+            ('content-type', 'multipart/related; boundary=%s; type=application/json' % self.boundary.decode())
+        ])
+        connection.send_data(stream_id, b'--' + self.boundary + encode_part(self.boundary, {'directive': directive}))
+        connection.send_data(stream_id, encode_part(self.boundary, self.speak_attachment, b'application/octet-stream'))
+        connection.send_data(stream_id, b'--\r\n', end_stream=True)
+
+    def send_failure(self, connection, stream_id):
+        """ Answers an event with failure_status and an exception message (an injected failure).
+
+        :param connection: StandInConnection the request was received on
+        :param stream_id: stream_id of the request
+        """
+        exception = {
+            'header': {'namespace': 'System', 'name': 'Exception'},
+            'payload': {'code': 'INTERNAL_SERVICE_EXCEPTION', 'description': 'Injected failure'}
+        }
+        connection.send_headers(stream_id, self.failure_status, [('content-type', 'application/json')])
+        connection.send_data(stream_id, json.dumps(exception).encode(), end_stream=True)
+
+    def push_directive(self, directive, attachment=None):
+        """ Pushes a directive to every open downchannel stream.
+
+        :param directive: directive dictionary (contains header and payload)
+        :param attachment: (optional) binary string attachment sent after the directive
+        :return: number of downchannel streams the directive was pushed to
+        """
+        data = encode_part(self.boundary, {'directive': directive})
+        if attachment is not None:
+            data += encode_part(self.boundary, attachment, b'application/octet-stream')
+
+        with self.connections_lock:
+            connections = list(self.connections)
+        pushed = 0
+        for connection in connections:
+            with connection.lock:
+                downstream_ids = list(connection.downstream_ids)
+            for stream_id in downstream_ids:
+                connection.send_data(stream_id, data)
+                pushed += 1
+        return pushed
+
+
+class StandInTokenManager(alexa_token.TokenManager):
+    """ TokenManager that does not contact the token endpoint (the StandInServer does not check tokens).
+    """
+    def __init__(self):
+        alexa_token.TokenManager.__init__(self, 'stand-in', 'stand-in', 'stand-in')
+
+    def request_token(self):
+        return 'stand-in-token', 3600
+
+
+class StandInTokenRefresher(alexa_token.TokenRefresher):
+    """ TokenRefresher whose token managers do not contact the token endpoint.
+    """
+    def create_token_manager(self, client_id, client_secret, refresh_token, **kwargs):
+        token_manager = StandInTokenManager()
+        self.add(token_manager)
+        return token_manager
+
+
+def connect(server, process_response_handle, context_handle=None, **kwargs):
+    """ Creates an AlexaConnection to a running StandInServer.
+
+    :param server: running StandInServer
+    :param process_response_handle: function that processes each message received
+    :param context_handle: (optional) function that supplies the device's context (empty if not specified)
+    :param kwargs: any other keyword arguments for AlexaConnection
+    :return: AlexaConnection object
+    """
+    if context_handle is None:
+        context_handle = list
+    config = {'Client_ID': 'stand-in', 'Client_Secret': 'stand-in', 'refresh_token': 'stand-in'}
+    kwargs.setdefault('token_manager', StandInTokenManager())
+    return alexa_communication.AlexaConnection(config, context_handle=context_handle,
+                                               process_response_handle=process_response_handle,
+                                               url=server.host, port=server.port, secure=False, **kwargs)
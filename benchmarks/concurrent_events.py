@@ -0,0 +1,82 @@
+"""
+Measures how well events sent from several threads share one connection. A local StandInServer answers each event
+after a fixed delay (the time AVS would spend processing it), and N threads each send events over the same
+AlexaConnection. If the streams are not serialized, the throughput should grow with N.
+
+    python -m benchmarks.concurrent_events --events 64 --delay 0.05
+
+"""
+
+import argparse
+import statistics
+import threading
+import time
+
+from benchmarks import avs_server
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+def measure_concurrency(connection, threads, events_per_thread):
+    """ Sends events from several threads at the same time, and measures the latency of each event.
+
+    :param connection: AlexaConnection connected to a StandInServer
+    :param threads: number of threads sending events in parallel
+    :param events_per_thread: number of events sent by each thread
+    :return: (elapsed, latencies) total time in seconds, and the list of latencies of every event in seconds
+    """
+    latencies = []
+    latencies_lock = threading.Lock()
+    start_barrier = threading.Barrier(threads + 1)
+
+    def send_events():
+        start_barrier.wait()
+        for _ in range(events_per_thread):
+            start_time = time.perf_counter()
+            stream_id = connection.send_event({'namespace': 'Benchmark', 'name': 'Event'})
+            response = connection.get_response(stream_id)
+            if response.status != 204:
+                raise NameError("Bad status (%s)" % response.status)
+            with latencies_lock:
+                latencies.append(time.perf_counter() - start_time)
+
+    senders = [threading.Thread(target=send_events) for _ in range(threads)]
+    for sender in senders:
+        sender.start()
+    start_barrier.wait()
+    start_time = time.perf_counter()
+    for sender in senders:
+        sender.join()
+    return time.perf_counter() - start_time, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent events benchmark (one connection, N threads).")
+    parser.add_argument('--events', type=int, default=64, help="total events sent for each number of threads")
+    parser.add_argument('--delay', type=float, default=0.05, help="seconds the server takes to answer each event")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                        help="numbers of parallel threads to measure")
+    args = parser.parse_args()
+
+    server = avs_server.StandInServer(response_delay=args.delay)
+    server.start()
+    connection = avs_server.connect(server, lambda message: None)
+    try:
+        for threads in args.threads:
+            events_per_thread = max(1, args.events // threads)
+            elapsed, latencies = measure_concurrency(connection, threads, events_per_thread)
+            latencies.sort()
+            print("%3d threads   %8.1f events/s   mean %8.2f ms   p50 %8.2f ms   max %8.2f ms" % (
+                threads,
+                len(latencies) / elapsed,
+                statistics.mean(latencies) * 1000,
+                latencies[len(latencies) // 2] * 1000,
+                latencies[-1] * 1000))
+    finally:
+        connection.close()
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
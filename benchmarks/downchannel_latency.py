@@ -0,0 +1,106 @@
+"""
+Measures the push-to-dispatch latency of the downchannel. A local StandInServer pushes directives at random
+intervals, and the time until each directive reaches process_response_handle is recorded. Both the polling and
+the blocking downchannel modes of AlexaConnection are measured.
+
+    python -m benchmarks.downchannel_latency --count 50
+
+"""
+
+import argparse
+import random
+import statistics
+import threading
+import time
+
+from benchmarks import avs_server
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+def measure_latency(server, blocking_downstream, count, max_interval, timeout):
+    """ Pushes count directives to a new connection, and measures the latency of each one.
+
+    :param server: running StandInServer
+    :param blocking_downstream: downchannel mode of the AlexaConnection
+    :param count: number of directives to push
+    :param max_interval: maximum time in seconds between pushes (each interval is random)
+    :param timeout: time in seconds to wait for a directive before giving up on it
+    :return: (latencies, missed) list of latencies in seconds, and number of directives that were not dispatched
+    """
+    dispatch_times = {}
+    dispatched = threading.Event()
+
+    def process_response(message):
+        dispatch_time = time.perf_counter()
+        for content in message['content']:
+            dispatch_times[content['directive']['payload']['sequence']] = dispatch_time
+        dispatched.set()
+
+    connection = avs_server.connect(server, process_response, blocking_downstream=blocking_downstream)
+
+    latencies = []
+    missed = 0
+    for sequence in range(count):
+        # Random spacing, so that pushes do not line up with any polling period
+        time.sleep(random.uniform(0, max_interval))
+        dispatched.clear()
+        push_time = time.perf_counter()
+        server.push_directive({
+            'header': {'namespace': 'Benchmark', 'name': 'Push'},
+            'payload': {'sequence': sequence}
+        })
+        deadline = push_time + timeout
+        while sequence not in dispatch_times and time.perf_counter() < deadline:
+            dispatched.wait(deadline - time.perf_counter())
+            dispatched.clear()
+        if sequence in dispatch_times:
+            latencies.append(dispatch_times[sequence] - push_time)
+        else:
+            missed += 1
+
+    connection.close()
+    return latencies, missed
+
+
+def print_results(name, latencies, missed):
+    """ Prints a summary of the measured latencies.
+
+    :param name: name of the measurement
+    :param latencies: list of latencies in seconds
+    :param missed: number of directives that were not dispatched in time
+    """
+    if not latencies:
+        print("%-10s no directives dispatched (%d missed)" % (name, missed))
+        return
+    latencies = sorted(latencies)
+    print("%-10s mean %8.2f ms   p50 %8.2f ms   p95 %8.2f ms   max %8.2f ms   (%d missed)" % (
+        name,
+        statistics.mean(latencies) * 1000,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        latencies[-1] * 1000,
+        missed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Downchannel push-to-dispatch latency benchmark.")
+    parser.add_argument('--count', type=int, default=20, help="directives pushed per mode")
+    parser.add_argument('--interval', type=float, default=0.2, help="maximum seconds between pushes")
+    parser.add_argument('--timeout', type=float, default=2.0, help="seconds to wait for each directive")
+    args = parser.parse_args()
+
+    server = avs_server.StandInServer()
+    server.start()
+    try:
+        for name, blocking_downstream in [('polling', False), ('blocking', True)]:
+            latencies, missed = measure_latency(server, blocking_downstream, args.count, args.interval,
+                                                args.timeout)
+            print_results(name, latencies, missed)
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Measures the threads and memory used per device session, for N threaded AlexaConnection objects compared to an
+AlexaFleet with N sessions (one event loop, shared token refresh and worker pool). All sessions connect to a
+local StandInServer, which runs in a separate process so that its threads and memory are not counted. The values
+per session are averages (totals divided by the number of sessions). For the fleet, the largest value of a single
+session is also reported, which is only exact if the sessions are started one at a time (--start-concurrency 1).
+
+    python -m benchmarks.fleet_density --sessions 100 --start-concurrency 1
+
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import threading
+import time
+import tracemalloc
+
+import alexa_fleet
+from benchmarks import avs_server
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+def get_configs(count):
+    """ Creates the config dictionaries for count devices (the StandInServer does not check them).
+
+    :param count: number of devices
+    :return: list of config dictionaries
+    """
+    return [{'Client_ID': 'stand-in-%d' % index, 'Client_Secret': 'stand-in', 'refresh_token': 'stand-in'}
+            for index in range(count)]
+
+
+def run_server(connection):
+    """ Runs a StandInServer until the benchmark closes the pipe (started as a separate process).
+
+    :param connection: multiprocessing pipe connection, which receives the port of the server
+    """
+    server = avs_server.StandInServer()
+    server.start()
+    connection.send(server.port)
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    server.stop()
+
+
+def measure_threaded(server, count):
+    """ Opens count threaded AlexaConnection objects, and measures the threads and memory they use.
+
+    :param server: running StandInServer
+    :param count: number of connections
+    :return: (threads, memory) added threads, and added memory in bytes
+    """
+    threads_before = threading.active_count()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    connections = [avs_server.connect(server, lambda message: None) for _ in range(count)]
+    threads = threading.active_count() - threads_before
+    memory = tracemalloc.get_traced_memory()[0] - memory_before
+    for connection in connections:
+        connection.close()
+    # Give the threads of the closed connections time to exit (the ping threads check every second)
+    time.sleep(1.5)
+    return threads, memory
+
+
+def measure_fleet(server, count, start_concurrency):
+    """ Starts an AlexaFleet with count sessions, and measures the threads and memory it uses.
+
+    :param server: running StandInServer
+    :param count: number of sessions
+    :param start_concurrency: number of sessions that are started at the same time
+    :return: (threads, memory, max_memory, failed) added threads, added memory in bytes, largest memory of a single
+             session in bytes (averaged over its start group), and number of sessions that were not started
+    """
+    async def run():
+        threads_before = threading.active_count()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        fleet = alexa_fleet.AlexaFleet(get_configs(count), token_refresher=avs_server.StandInTokenRefresher(),
+                                       start_concurrency=start_concurrency, trace_memory=True, url=server.host,
+                                       port=server.port, secure=False)
+        await fleet.start()
+        threads = threading.active_count() - threads_before
+        memory = tracemalloc.get_traced_memory()[0] - memory_before
+        max_memory = max([session['average_memory'] for session in fleet.sessions] or [0])
+        failed = len(fleet.failed_sessions)
+        await fleet.stop()
+        return threads, memory, max_memory, failed
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Threads and memory per device session.")
+    parser.add_argument('--sessions', type=int, default=100, help="number of device sessions")
+    parser.add_argument('--start-concurrency', type=int, default=10,
+                        help="number of fleet sessions started at the same time (1 for exact values per session)")
+    args = parser.parse_args()
+
+    parent_connection, child_connection = multiprocessing.Pipe()
+    server_process = multiprocessing.Process(target=run_server, args=(child_connection,))
+    server_process.daemon = True
+    server_process.start()
+    # Only the host and port of the server are used
+    server = avs_server.StandInServer(port=parent_connection.recv())
+
+    tracemalloc.start()
+    try:
+        threads, memory = measure_threaded(server, args.sessions)
+        print("%-10s %5d sessions   %5d threads (%.2f avg per session)   %9.1f kB (%.1f kB avg per session)" % (
+            'threaded', args.sessions, threads, threads / args.sessions, memory / 1024,
+            memory / 1024 / args.sessions))
+        threads, memory, max_memory, failed = measure_fleet(server, args.sessions, args.start_concurrency)
+        print("%-10s %5d sessions   %5d threads (%.2f avg per session)   %9.1f kB (%.1f kB avg per session, "
+              "%.1f kB max)   %d failed" % (
+                  'fleet', args.sessions, threads, threads / args.sessions, memory / 1024,
+                  memory / 1024 / args.sessions, max_memory / 1024, failed))
+    finally:
+        parent_connection.send(None)
+        server_process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+End-to-end load generator. N sessions (one AlexaConnection each) connect to a local StandInServer, and each session
+sends Recognize events (start_recognize_event with files/example_get_time.pcm) one after the other, reading the
+canned Speak directive and its attachment in each response. At the same time, directives are pushed on every
+downchannel. Reports the Recognize requests per second and latencies (p50/p95/p99), failures, and the downchannel
+latencies.
+
+    python -m benchmarks.load_generator --sessions 8 --duration 10 --latency 0.05 --failure-rate 0.01
+
+"""
+
+import argparse
+import math
+import threading
+import time
+
+from benchmarks import avs_server
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+def get_percentile(sorted_values, percent):
+    """ Gets a percentile of a sorted list (nearest rank).
+
+    :param sorted_values: sorted list of values (not empty)
+    :param percent: percentile to get (0 to 100)
+    :return: value at the percentile
+    """
+    # The smallest value that at least percent of the values are less than or equal to
+    index = max(0, math.ceil(len(sorted_values) * percent / 100) - 1)
+    return sorted_values[index]
+
+
+def format_latencies(latencies):
+    """ Formats the p50/p95/p99 and max of a list of latencies.
+
+    :param latencies: list of latencies in seconds
+    :return: string with the latencies in milliseconds
+    """
+    if not latencies:
+        return "no requests"
+    latencies = sorted(latencies)
+    return "p50 %8.2f ms   p95 %8.2f ms   p99 %8.2f ms   max %8.2f ms" % (
+        get_percentile(latencies, 50) * 1000,
+        get_percentile(latencies, 95) * 1000,
+        get_percentile(latencies, 99) * 1000,
+        latencies[-1] * 1000)
+
+
+class LoadGenerator:
+    """ Drives sessions against a StandInServer and collects the results.
+    """
+    def __init__(self, server, sessions, audio):
+        """ Initialize the LoadGenerator.
+
+        :param server: running StandInServer
+        :param sessions: number of sessions (connections)
+        :param audio: raw binary string audio (PCM) sent with each Recognize event
+        """
+        self.server = server
+        self.session_count = sessions
+        self.audio = audio
+
+        self.lock = threading.Lock()
+        self.recognize_latencies = []
+        self.failures = 0
+        # Number of failures of each error type, and number of sessions that ended early (connection closed)
+        self.errors = {}
+        self.ended_sessions = 0
+        self.downchannel_latencies = []
+        self.stop_event = threading.Event()
+
+    def process_response(self, message):
+        """ Processes every message received by the sessions. Downchannel directives record their latency, and
+            attachments are read completely (like playback would).
+
+        :param message: message received from the StandInServer
+        """
+        receive_time = time.perf_counter()
+        for content in message['content']:
+            payload = content['directive']['payload']
+            if 'push_time' in payload:
+                with self.lock:
+                    self.downchannel_latencies.append(receive_time - payload['push_time'])
+        for attachment in message['attachment']:
+            if not isinstance(attachment, bytes):
+                attachment.read()
+
+    def session_thread(self, connection):
+        """ Sends Recognize events one after the other until the load generator is stopped. Every error is counted as
+            a failure. The session keeps running, unless its connection was closed.
+
+        :param connection: AlexaConnection of the session
+        """
+        while not self.stop_event.is_set():
+            start_time = time.perf_counter()
+            try:
+                stream_id = connection.start_recognize_event(self.audio)
+                connection.get_and_process_response(stream_id)
+            except Exception as e:
+                error = type(e).__name__
+                with self.lock:
+                    self.failures += 1
+                    self.errors[error] = self.errors.get(error, 0) + 1
+                if connection.connection.is_closed:
+                    print("Session ended, connection closed (%s: %s)." % (error, e))
+                    with self.lock:
+                        self.ended_sessions += 1
+                    return
+                continue
+            with self.lock:
+                self.recognize_latencies.append(time.perf_counter() - start_time)
+
+    def push_thread(self, push_interval):
+        """ Pushes a directive on every downchannel at a fixed interval until the load generator is stopped.
+
+        :param push_interval: seconds between pushes
+        """
+        while not self.stop_event.wait(push_interval):
+            self.server.push_directive({
+                'header': {'namespace': 'LoadGenerator', 'name': 'Push'},
+                'payload': {'push_time': time.perf_counter()}
+            })
+
+    def run(self, duration, push_interval):
+        """ Runs the sessions for the specified duration.
+
+        :param duration: seconds to run
+        :param push_interval: seconds between downchannel pushes
+        :return: elapsed time in seconds
+        """
+        connections = [avs_server.connect(self.server, self.process_response) for _ in range(self.session_count)]
+        threads = [threading.Thread(target=self.session_thread, args=(connection,)) for connection in connections]
+        threads.append(threading.Thread(target=self.push_thread, args=(push_interval,)))
+
+        start_time = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        self.stop_event.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start_time
+
+        for connection in connections:
+            connection.close()
+        return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load generator against a local stand-in AVS server.")
+    parser.add_argument('--sessions', type=int, default=8, help="number of concurrent sessions")
+    parser.add_argument('--duration', type=float, default=10, help="seconds to run")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds the server takes to answer an event")
+    parser.add_argument('--failure-rate', type=float, default=0, help="fraction of events that fail (0 to 1)")
+    parser.add_argument('--push-interval', type=float, default=0.5, help="seconds between downchannel pushes")
+    parser.add_argument('--attachment', help="file used as the Speak attachment (e.g. an MP3)")
+    parser.add_argument('--seed', type=int, help="seed for the injected failures")
+    args = parser.parse_args()
+
+    speak_attachment = None
+    if args.attachment is not None:
+        with open(args.attachment, 'rb') as file:
+            speak_attachment = file.read()
+    with open(avs_server.DEFAULT_SPEAK_ATTACHMENT, 'rb') as file:
+        audio = file.read()
+
+    server = avs_server.StandInServer(response_delay=args.latency, failure_rate=args.failure_rate,
+                                      speak_attachment=speak_attachment, seed=args.seed)
+    server.start()
+    try:
+        load_generator = LoadGenerator(server, args.sessions, audio)
+        elapsed = load_generator.run(args.duration, args.push_interval)
+    finally:
+        server.stop()
+
+    requests = len(load_generator.recognize_latencies)
+    print("%d sessions (%d ended early), %.1f s, %d Recognize requests (%d failed)" % (
+        args.sessions, load_generator.ended_sessions, elapsed, requests + load_generator.failures,
+        load_generator.failures))
+    if load_generator.errors:
+        print("errors        %s" % ", ".join("%s %d" % (error, count)
+                                             for error, count in sorted(load_generator.errors.items())))
+    print("recognize     %8.1f req/s   %s" % (requests / elapsed, format_latencies(load_generator.recognize_latencies)))
+    print("downchannel   %8d msgs    %s" % (len(load_generator.downchannel_latencies),
+                                          format_latencies(load_generator.downchannel_latencies)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Compares the MP3 decoder backends of alexa_decoder: a new ffmpeg process for each response (cold, FFmpegDecoder),
+ffmpeg processes started in advance (warm, WarmFFmpegDecoder) and decoding in the process (MiniaudioDecoder, if the
+miniaudio package is installed). For each backend, responses are decoded one at a
+time with a pause in between (like the replies of a conversation), and the time until the first decoded audio and
+until the whole response was decoded are reported. The throughput (responses per second) is then measured by
+decoding responses back to back, several at a time.
+
+    python -m benchmarks.mp3_decoding --repeat 20 --concurrency 4
+
+By default the response is files/example_get_time.pcm encoded to MP3 with ffmpeg, see --mp3 and --ffmpeg.
+"""
+
+import argparse
+import concurrent.futures
+import subprocess
+import time
+
+import alexa_decoder
+from benchmarks import avs_server
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+RATE = 24000
+CHANNELS = 1
+
+
+def encode_mp3(pcm_file, ffmpeg_path):
+    """ Encodes a recording to MP3 (like a Speak attachment).
+
+    :param pcm_file: recording (raw PCM, 16 kHz, 16 bit, mono)
+    :param ffmpeg_path: path to ffmpeg
+    :return: binary string of the MP3
+    """
+    with open(pcm_file, 'rb') as file:
+        raw_audio = file.read()
+    return subprocess.run([ffmpeg_path, '-f', 's16le', '-ar', '16000', '-ac', '1', '-i', 'pipe:0',
+                           '-f', 'mp3', 'pipe:1'],
+                          input=raw_audio, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+
+def decode(decoder, mp3):
+    """ Decodes one response.
+
+    :param decoder: decoder backend
+    :param mp3: binary string of the MP3
+    :return: (first_chunk_time, decode_time, decoded_bytes) seconds until the first decoded audio and until the end
+    """
+    start_time = time.perf_counter()
+    first_chunk_time = None
+    decoded_bytes = 0
+    for data in decoder.decode(mp3):
+        if first_chunk_time is None:
+            first_chunk_time = time.perf_counter() - start_time
+        decoded_bytes += len(data)
+    return first_chunk_time, time.perf_counter() - start_time, decoded_bytes
+
+
+def measure_latency(decoder, mp3, repeat, interval):
+    """ Decodes responses one at a time, with a pause in between (not measured).
+
+    :param decoder: decoder backend
+    :param mp3: binary string of the MP3
+    :param repeat: number of responses
+    :param interval: seconds between responses
+    :return: (first_chunk_times, decode_times, decoded_bytes) lists of seconds, and the bytes of one decoded response
+    """
+    first_chunk_times = []
+    decode_times = []
+    decoded_bytes = 0
+    for _ in range(repeat):
+        time.sleep(interval)
+        first_chunk_time, decode_time, decoded_bytes = decode(decoder, mp3)
+        first_chunk_times.append(first_chunk_time)
+        decode_times.append(decode_time)
+    return first_chunk_times, decode_times, decoded_bytes
+
+
+def measure_throughput(decoder, mp3, repeat, concurrency):
+    """ Decodes responses back to back, concurrency of them at a time.
+
+    :param decoder: decoder backend
+    :param mp3: binary string of the MP3
+    :param repeat: number of responses
+    :param concurrency: number of responses decoded at the same time
+    :return: responses per second
+    """
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(decode, decoder, mp3) for _ in range(repeat)]:
+            future.result()
+    return repeat / (time.perf_counter() - start_time)
+
+
+def format_times(times):
+    """ Formats the median and max of a list of times.
+
+    :param times: list of seconds (not empty)
+    :return: string with the times in milliseconds
+    """
+    times = sorted(times)
+    return "p50 %8.2f ms   max %8.2f ms" % (times[len(times) // 2] * 1000, times[-1] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares cold (one ffmpeg per response) and warm MP3 decoding.")
+    parser.add_argument('--mp3', help="response to decode (files/example_get_time.pcm encoded to MP3 if not "
+                                      "specified)")
+    parser.add_argument('--ffmpeg', default='ffmpeg/bin/ffmpeg', help="path to ffmpeg")
+    parser.add_argument('--repeat', type=int, default=20, help="number of responses decoded per measurement")
+    parser.add_argument('--interval', type=float, default=0.2,
+                        help="seconds between responses for the latency measurement")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="responses decoded at the same time for the throughput measurement")
+    args = parser.parse_args()
+
+    try:
+        if args.mp3 is not None:
+            with open(args.mp3, 'rb') as file:
+                mp3 = file.read()
+        else:
+            mp3 = encode_mp3(avs_server.DEFAULT_SPEAK_ATTACHMENT, args.ffmpeg)
+    except (OSError, subprocess.CalledProcessError) as error:
+        print("No MP3 to decode (%s)." % error)
+        return
+
+    decoders = [
+        ('cold', alexa_decoder.FFmpegDecoder(RATE, CHANNELS, args.ffmpeg)),
+        ('warm', alexa_decoder.WarmFFmpegDecoder(RATE, CHANNELS, args.ffmpeg, pool_size=args.concurrency))
+    ]
+    if alexa_decoder.miniaudio is not None:
+        decoders.append(('in-process', alexa_decoder.MiniaudioDecoder(RATE, CHANNELS)))
+    for name, decoder in decoders:
+        decoder.start()
+        try:
+            first_chunk_times, decode_times, decoded_bytes = measure_latency(decoder, mp3, args.repeat,
+                                                                             args.interval)
+            throughput = measure_throughput(decoder, mp3, args.repeat, args.concurrency)
+        except (OSError, EOFError) as error:
+            print("%-10s not available (%s)" % (name, error))
+            continue
+        finally:
+            decoder.close()
+        duration = decoded_bytes / 2 / CHANNELS / RATE
+        print("%-10s first audio %s   decoded %s   %7.1f responses/s (%.0f s of audio/s)" % (
+            name, format_times(first_chunk_times), format_times(decode_times), throughput, throughput * duration))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Micro-benchmarks for the multipart parsing functions in alexa_communication (parse_data, split_message,
+get_boundary_from_response, read_from_downstream and MultipartParser.feed). Synthetic bodies are generated with
+a varying number of parts, attachment sizes (up to several MB, built from files/example_get_time.pcm) and chunk
+fragmentation. The chunks end at the part delimiters (like the frames AVS sends), so every part is found. Each case is
+checked to parse the expected number of parts before it is timed. The time per call and the memory peak
+(tracemalloc) of each case are reported.
+
+Results can be saved, and compared against a saved baseline:
+
+    python -m benchmarks.multipart_parsing --save baseline.json
+    python -m benchmarks.multipart_parsing --baseline baseline.json
+
+"""
+
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+import alexa_communication
+from benchmarks import avs_server
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+BOUNDARY = b'benchmark-boundary'
+
+
+class StandInResponse:
+    """ Only the headers of a response, as used by get_boundary_from_response.
+    """
+    def __init__(self, boundary):
+        self.headers = {
+            'content-type': [b'multipart/related; boundary=' + boundary + b'; type="application/json"']
+        }
+
+
+def get_attachment(size):
+    """ Gets an attachment of the specified size, built by repeating the example PCM audio.
+
+    :param size: size in bytes
+    :return: binary string attachment
+    """
+    with open(avs_server.DEFAULT_SPEAK_ATTACHMENT, 'rb') as file:
+        audio = file.read()
+    return (audio * (size // len(audio) + 1))[:size]
+
+
+def get_body(part_count, attachment_size):
+    """ Generates a multipart body, the way AVS sends it. Every other part is an attachment if attachment_size is
+        not 0 (otherwise all parts are directives).
+
+    :param part_count: number of parts
+    :param attachment_size: size of each attachment in bytes
+    :return: binary string body
+    """
+    attachment = get_attachment(attachment_size)
+    body = b'--' + BOUNDARY
+    for index in range(part_count):
+        if attachment_size and index % 2 == 1:
+            body += avs_server.encode_part(BOUNDARY, attachment, b'application/octet-stream')
+        else:
+            directive = {
+                'header': {'namespace': 'SpeechSynthesizer', 'name': 'Speak', 'messageId': 'message-%d' % index},
+                'payload': {'url': 'cid:attachment-%d' % index, 'format': 'AUDIO_MPEG', 'token': 'token-%d' % index}
+            }
+            body += avs_server.encode_part(BOUNDARY, {'directive': directive})
+    return body + b'--\r\n'
+
+
+def get_chunks(data, chunk_size):
+    """ Splits data into chunks, the way it would be received from the stream. Each part ends a chunk (at its
+        delimiter), and parts larger than chunk_size are split into several chunks.
+
+    :param data: binary string
+    :param chunk_size: maximum size of each chunk in bytes
+    :return: list of binary strings
+    """
+    delimiter = b'--' + BOUNDARY
+    chunks = []
+    part_start = 0
+    while part_start < len(data):
+        part_end = data.find(delimiter, part_start)
+        part_end = len(data) if part_end == -1 else part_end + len(delimiter)
+        chunks.extend(data[index:min(index + chunk_size, part_end)]
+                      for index in range(part_start, part_end, chunk_size))
+        part_start = part_end
+    return chunks
+
+
+def feed_parser(chunks):
+    """ Parses a fragmented body with MultipartParser (the parser used for the downchannel).
+
+    :param chunks: list of binary strings
+    :return: list of (header, content) parts
+    """
+    parser = alexa_communication.MultipartParser(BOUNDARY)
+    parts = []
+    for chunk in chunks:
+        parts.extend(parser.feed(chunk))
+    return parts
+
+
+def count_parts(result):
+    """ Counts the parts found by one of the benchmarked functions.
+
+    :param result: list of parts (split_message, MultipartParser.feed), message dictionary (parse_data), or
+                   (new_data, data) tuple (read_from_downstream, new_data is split into parts)
+    :return: number of parts
+    """
+    if isinstance(result, dict):
+        return len(result['content']) + len(result['attachment'])
+    if isinstance(result, tuple):
+        return len(alexa_communication.split_message(result[0], BOUNDARY))
+    return len(result)
+
+
+def get_cases(quick=False):
+    """ Gets the benchmark cases.
+
+    :param quick: (optional) flag that indicates if only small bodies should be used
+    :return: list of (name, function, arguments, size, parts) tuples, size is the number of bytes parsed per call
+             and parts is the number of parts each call must find (None if it does not parse parts)
+    """
+    part_counts = [2, 10, 50]
+    attachment_sizes = [0, 64*1024] if quick else [0, 64*1024, 4*1024*1024]
+    chunk_sizes = [1024, 16*1024, 64*1024]
+
+    cases = [('get_boundary_from_response', lambda: alexa_communication.get_boundary_from_response(
+        StandInResponse(BOUNDARY)), (), 0, None)]
+    for attachment_size in attachment_sizes:
+        for part_count in part_counts:
+            # Large attachments are only tested with a few parts, to keep memory reasonable
+            if attachment_size > 1024*1024 and part_count > 2:
+                continue
+            body = get_body(part_count, attachment_size)
+            suffix = "[parts=%d, attachment=%d]" % (part_count, attachment_size)
+            cases.append(('split_message' + suffix, alexa_communication.split_message, (body, BOUNDARY), len(body),
+                          part_count))
+            cases.append(('parse_data' + suffix, alexa_communication.parse_data, (body, BOUNDARY), len(body),
+                          part_count))
+            for chunk_size in chunk_sizes:
+                chunks = get_chunks(body, chunk_size)
+                chunk_suffix = "[parts=%d, attachment=%d, chunk=%d]" % (part_count, attachment_size, chunk_size)
+                cases.append(('read_from_downstream' + chunk_suffix, alexa_communication.read_from_downstream,
+                              (BOUNDARY, chunks), len(body), part_count))
+                cases.append(('MultipartParser.feed' + chunk_suffix, feed_parser, (chunks,), len(body), part_count))
+    return cases
+
+
+def measure(function, arguments, min_time, repeat):
+    """ Measures the time per call of a function. The function is called in a loop for at least min_time, and the
+        best of repeat loops is used.
+
+    :param function: function to call
+    :param arguments: tuple of arguments
+    :param min_time: minimum seconds per loop
+    :param repeat: number of loops
+    :return: (time, peak) best time per call in seconds, and the memory peak of a single call in bytes
+    """
+    best_time = None
+    for _ in range(repeat):
+        calls = 0
+        start_time = time.perf_counter()
+        while True:
+            function(*arguments)
+            calls += 1
+            elapsed = time.perf_counter() - start_time
+            if elapsed >= min_time:
+                break
+        if best_time is None or elapsed / calls < best_time:
+            best_time = elapsed / calls
+
+    # Memory is measured separately, since tracing slows down the calls
+    tracemalloc.start()
+    function(*arguments)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best_time, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the multipart parsing functions.")
+    parser.add_argument('--quick', action='store_true', help="skip the multi-MB attachments")
+    parser.add_argument('--min-time', type=float, default=0.2, help="minimum seconds per measurement loop")
+    parser.add_argument('--repeat', type=int, default=3, help="number of measurement loops per case")
+    parser.add_argument('--filter', help="only run cases whose name contains this text")
+    parser.add_argument('--save', help="file the results are saved to (JSON)")
+    parser.add_argument('--baseline', help="saved results to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+
+    results = {}
+    for name, function, arguments, size, parts in get_cases(args.quick):
+        if args.filter is not None and args.filter not in name:
+            continue
+        if parts is not None:
+            parsed = count_parts(function(*arguments))
+            assert parsed == parts, "%s parsed %d parts, expected %d" % (name, parsed, parts)
+        call_time, peak = measure(function, arguments, args.min_time, args.repeat)
+        results[name] = {'time': call_time, 'peak': peak, 'size': size}
+
+        line = "%-75s %12.2f us   %10.1f MB/s   peak %10.1f kB" % (
+            name, call_time * 1e6, size / call_time / 1e6 if size else 0, peak / 1024)
+        if baseline is not None and name in baseline:
+            line += "   %6.2fx time   %6.2fx peak" % (call_time / baseline[name]['time'],
+                                                     peak / baseline[name]['peak'] if baseline[name]['peak'] else 0)
+        print(line)
+
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump({'python': platform.python_version(), 'results': results}, file, indent=2)
+        print("Results saved to %s" % args.save)
+
+
+if __name__ == "__main__":
+    main()
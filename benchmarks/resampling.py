@@ -0,0 +1,154 @@
+"""
+Throughput benchmark of the capture format converter (alexa_audio.AudioConverter), which converts the microphone's
+audio to the format AVS expects (16 kHz, 16 bit, mono). Synthetic audio (a tone and noise) is converted in the same
+chunks as the capture engine reads, for a few common microphone formats. The throughput is reported in input samples
+(per channel) per second, and as a multiple of realtime.
+
+The filter quality is measured with test tones at each rate. The passband level is the lowest level of a tone up to
+3/4 of the lower Nyquist frequency. The stopband rejection is the highest level of anything that should not be in the
+output: tones from 9/8 of the output Nyquist frequency up (aliasing), and everything but the tone itself for tones in
+the passband (images when upsampling). Tones in between (the transition band) are not counted.
+
+    python -m benchmarks.resampling --duration 10
+
+"""
+
+import argparse
+import time
+
+import numpy
+
+import alexa_audio
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+# (rate, channels, sample width) of the microphones
+FORMATS = [(44100, 2, 2), (48000, 2, 2), (48000, 1, 3), (8000, 1, 2), (16000, 2, 2)]
+CHUNK = 1024
+# Passband and stopband edges, as fractions of the Nyquist frequency (see measure_rejection)
+PASSBAND = 0.75
+STOPBAND = 1.125
+# Spacing of the test tones in Hz, and seconds per tone
+TONE_STEP = 250
+TONE_DURATION = 0.5
+
+
+def get_test_audio(rate, channels, sample_width, duration, seed=None):
+    """ Creates a tone with some noise in the given format.
+
+    :param rate: sample rate
+    :param channels: number of channels
+    :param sample_width: bytes per sample (2 to 4)
+    :param duration: seconds of audio
+    :param seed: (optional) seed for the noise
+    :return: raw binary audio string
+    """
+    random_state = numpy.random.RandomState(seed)
+    t = numpy.arange(int(rate * duration)) / rate
+    samples = 0.3 * numpy.sin(2 * numpy.pi * 440 * t) + random_state.normal(0, 0.05, len(t))
+    samples = numpy.clip(samples, -1, 1) * (2 ** (8 * sample_width - 1) - 1)
+    frames = numpy.repeat(samples, channels).astype('<i4')
+    if sample_width == 4:
+        return frames.tobytes()
+    # Keep the low bytes of each little-endian 32-bit sample
+    return frames.view(numpy.uint8).reshape(-1, 4)[:, :sample_width].tobytes()
+
+
+def measure_converter(rate, channels, sample_width, audio, repeat):
+    """ Converts the audio chunk by chunk, and measures the time spent.
+
+    :param rate: sample rate
+    :param channels: number of channels
+    :param sample_width: bytes per sample
+    :param audio: raw binary audio string
+    :param repeat: number of times the audio is converted
+    :return: (output_bytes, time) bytes of converted audio, and seconds per conversion
+    """
+    chunk_bytes = CHUNK * rate // alexa_audio.AVS_RATE * channels * sample_width
+    output_bytes = 0
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        converter = alexa_audio.AudioConverter(rate, channels, sample_width)
+        output_bytes = 0
+        for offset in range(0, len(audio), chunk_bytes):
+            output_bytes += len(converter.convert(audio[offset:offset + chunk_bytes]))
+        output_bytes += len(converter.flush())
+    return output_bytes, (time.perf_counter() - start_time) / repeat
+
+
+def get_tone_level(rate, frequency, is_wanted):
+    """ Converts a full scale tone, and measures the level of the output (16-bit mono input, which is enough to
+        measure the filter).
+
+    :param rate: sample rate
+    :param frequency: frequency of the tone in Hz
+    :param is_wanted: flag that indicates if the tone should be in the output. If it is, the level of the tone and
+                      the level of everything else are measured separately.
+    :return: (tone, other) levels in dB relative to the input tone
+    """
+    amplitude = 2 ** 15 - 1
+    t = numpy.arange(int(rate * TONE_DURATION)) / rate
+    audio = numpy.round(amplitude * numpy.sin(2 * numpy.pi * frequency * t)).astype(numpy.int16).tobytes()
+    converter = alexa_audio.AudioConverter(rate)
+    output = numpy.frombuffer(converter.convert(audio) + converter.flush(), dtype=numpy.int16).astype(numpy.float64)
+    # Skip the start and end, where the filter is still filling or emptying
+    margin = len(output) // 10
+    output = output[margin:len(output) - margin]
+
+    def get_level(samples):
+        return 10 * numpy.log10(max(numpy.mean(samples ** 2), 1e-12) / (amplitude ** 2 / 2))
+
+    if not is_wanted:
+        return None, get_level(output)
+    # Fit the tone (any phase), what is left over is everything else
+    t = (numpy.arange(len(output)) + margin) / alexa_audio.AVS_RATE
+    basis = numpy.stack((numpy.sin(2 * numpy.pi * frequency * t), numpy.cos(2 * numpy.pi * frequency * t)), axis=1)
+    tone = basis.dot(numpy.linalg.lstsq(basis, output, rcond=None)[0])
+    return get_level(tone), get_level(output - tone)
+
+
+def measure_rejection(rate):
+    """ Measures the passband level and the stopband rejection of the converter for a sample rate (see the top of
+        the file).
+
+    :param rate: sample rate
+    :return: (passband, stopband) lowest level in the passband in dB, and stopband rejection in dB (positive)
+    """
+    nyquist = min(rate, alexa_audio.AVS_RATE) / 2
+    passband = 0
+    stopband = None
+    for frequency in range(TONE_STEP, int(rate / 2 * 0.95), TONE_STEP):
+        if frequency <= nyquist * PASSBAND:
+            tone, other = get_tone_level(rate, frequency, True)
+            passband = min(passband, tone)
+        elif frequency >= alexa_audio.AVS_RATE / 2 * STOPBAND:
+            tone, other = get_tone_level(rate, frequency, False)
+        else:
+            continue
+        stopband = -other if stopband is None else min(stopband, -other)
+    return passband, stopband
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmark of the capture format converter.")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of audio converted")
+    parser.add_argument('--repeat', type=int, default=5, help="number of times the audio is converted")
+    args = parser.parse_args()
+
+    rejections = {}
+    for rate, channels, sample_width in FORMATS:
+        audio = get_test_audio(rate, channels, sample_width, args.duration, seed=0)
+        output_bytes, conversion_time = measure_converter(rate, channels, sample_width, audio, args.repeat)
+        samples = len(audio) // (channels * sample_width)
+        if rate not in rejections:
+            rejections[rate] = measure_rejection(rate)
+        passband, stopband = rejections[rate]
+        print("%6d Hz %d ch %2d bit   %10.0f samples/s   %7.1fx realtime   %8.2f ms   %d output samples   "
+              "passband %5.1f dB   stopband rejection %5.1f dB"
+              % (rate, channels, sample_width * 8, samples / conversion_time, args.duration / conversion_time,
+                 conversion_time * 1000, output_bytes // 2, passband, stopband))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Checks and measures the decoded response cache (alexa_audio.DecodedAudioCache) on the path Speak replies take. The
+first reply is an AttachmentStream that is still being received when play_mp3 is called (the directive is handled
+as soon as the attachment's header arrives), so it is decoded and played while it arrives, and cached once it ends.
+The same reply is then played several times (like a repeated confirmation), each one received completely before it
+is played, and these must be played from the cache without calling the decoder. Both are checked before anything is
+reported. The time from play_mp3 until playback starts is reported for the decoded reply and for the cached replies,
+and how long before the end of the attachment the streamed reply started playing.
+
+    python -m benchmarks.tts_cache --repeat 5
+
+By default the reply is files/example_get_time.pcm encoded to MP3 with ffmpeg, see --mp3 and --ffmpeg. The replies
+are played on the default output device.
+"""
+
+import argparse
+import subprocess
+import threading
+import time
+
+import alexa_audio
+import alexa_communication
+import alexa_decoder
+from benchmarks import avs_server, mp3_decoding
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+
+class CountingDecoder:
+    """ Decoder backend that passes everything on to another backend, and counts the responses it decodes.
+    """
+    def __init__(self, decoder):
+        """ Initialize the CountingDecoder.
+
+        :param decoder: decoder backend that does the decoding
+        """
+        self.decoder = decoder
+        self.decode_count = 0
+
+    def start(self):
+        """ Starts the backend.
+        """
+        self.decoder.start()
+
+    def decode(self, raw_audio, chunk_bytes=2048):
+        """ Decodes a response with the backend, and counts it.
+
+        :param raw_audio: MP3 binary string, or an iterable of binary strings
+        :param chunk_bytes: (optional) bytes per decoded chunk
+        :return: generator of decoded chunks
+        """
+        self.decode_count += 1
+        return self.decoder.decode(raw_audio, chunk_bytes=chunk_bytes)
+
+    def close(self):
+        """ Closes the backend.
+        """
+        self.decoder.close()
+
+
+class StageTimes:
+    """ Records when each stage of a reply was reached (used instead of a TimelineRecorder).
+    """
+    def __init__(self):
+        """ Initialize the StageTimes.
+        """
+        # Time of each stage, per dialogRequestId
+        self.times = {}
+
+    def mark(self, stage, dialog_request_id=None):
+        """ Records the time a stage was reached.
+
+        :param stage: name of the stage
+        :param dialog_request_id: (optional) dialogRequestId of the reply
+        """
+        self.times.setdefault(dialog_request_id, {})[stage] = time.perf_counter()
+
+
+def stream_attachment(mp3, chunk_size, interval, times):
+    """ Creates an AttachmentStream that is received in the background, one chunk at a time.
+
+    :param mp3: binary string of the MP3
+    :param chunk_size: bytes per chunk
+    :param interval: seconds between chunks
+    :param times: dictionary the time the attachment was complete is added to ('attachment_end')
+    :return: AttachmentStream
+    """
+    attachment = alexa_communication.AttachmentStream()
+
+    def receive():
+        for offset in range(0, len(mp3), chunk_size):
+            time.sleep(interval)
+            attachment.write(mp3[offset:offset + chunk_size])
+        times['attachment_end'] = time.perf_counter()
+        attachment.close()
+
+    threading.Thread(target=receive, daemon=True).start()
+    return attachment
+
+
+def receive_attachment(mp3):
+    """ Creates an AttachmentStream that has already been received completely.
+
+    :param mp3: binary string of the MP3
+    :return: AttachmentStream
+    """
+    attachment = alexa_communication.AttachmentStream()
+    attachment.write(mp3)
+    attachment.close()
+    return attachment
+
+
+def measure_replies(audio, mp3, repeat, chunk_size, interval):
+    """ Plays the same reply repeat times. The first one is streamed while it is played, the others have been
+        received completely.
+
+    :param audio: AlexaAudio object
+    :param mp3: binary string of the MP3
+    :param repeat: number of replies
+    :param chunk_size: bytes per received chunk
+    :param interval: seconds between received chunks
+    :return: (start_times, lead_time) list of seconds from play_mp3 until playback started (one per reply), and
+             seconds from the start of playback of the streamed reply until its attachment was complete
+    """
+    start_times = []
+    stream_times = {}
+    for index in range(repeat):
+        dialog_request_id = 'reply-%d' % index
+        start_time = time.perf_counter()
+        if index == 0:
+            audio.play_mp3(stream_attachment(mp3, chunk_size, interval, stream_times), dialog_request_id)
+        else:
+            audio.play_mp3(receive_attachment(mp3), dialog_request_id)
+        start_times.append(audio.timeline.times[dialog_request_id]['playback_start'] - start_time)
+    lead_time = stream_times['attachment_end'] - audio.timeline.times['reply-0']['playback_start']
+    return start_times, lead_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks and measures the decoded response cache.")
+    parser.add_argument('--mp3', help="reply to play (files/example_get_time.pcm encoded to MP3 if not specified)")
+    parser.add_argument('--ffmpeg', default='ffmpeg/bin/ffmpeg', help="path to ffmpeg")
+    parser.add_argument('--repeat', type=int, default=3, help="number of identical replies")
+    parser.add_argument('--chunk-size', type=int, default=4096, help="bytes per received chunk of the attachment")
+    parser.add_argument('--interval', type=float, default=0.005, help="seconds between received chunks")
+    args = parser.parse_args()
+
+    try:
+        if args.mp3 is not None:
+            with open(args.mp3, 'rb') as file:
+                mp3 = file.read()
+        else:
+            mp3 = mp3_decoding.encode_mp3(avs_server.DEFAULT_SPEAK_ATTACHMENT, args.ffmpeg)
+    except (OSError, subprocess.CalledProcessError) as error:
+        print("No MP3 to play (%s)." % error)
+        return
+
+    # The same kind of backend the devices use by default (see alexa_decoder.get_shared_decoder)
+    if alexa_decoder.miniaudio is not None:
+        backend = alexa_decoder.MiniaudioDecoder(alexa_audio.MP3_DECODE_RATE, alexa_audio.MP3_DECODE_CHANNELS)
+    else:
+        backend = alexa_decoder.WarmFFmpegDecoder(alexa_audio.MP3_DECODE_RATE, alexa_audio.MP3_DECODE_CHANNELS,
+                                                  args.ffmpeg)
+    decoder = CountingDecoder(backend)
+    cache = alexa_audio.DecodedAudioCache()
+    audio = alexa_audio.AlexaAudio(timeline=StageTimes(), tts_cache=cache, decoder=decoder)
+    try:
+        start_times, lead_time = measure_replies(audio, mp3, args.repeat, args.chunk_size, args.interval)
+    finally:
+        audio.close()
+        decoder.close()
+
+    stats = cache.get_stats()
+    assert decoder.decode_count == 1, "%d replies decoded, expected 1" % decoder.decode_count
+    assert stats['hit_count'] == args.repeat - 1, "%d cache hits, expected %d" % (stats['hit_count'],
+                                                                                 args.repeat - 1)
+    print("decoded   %8.2f ms until playback   %8.2f ms before the attachment was complete" % (
+        start_times[0] * 1000, lead_time * 1000))
+    if len(start_times) > 1:
+        print("cached    %8.2f ms until playback (max of %d)" % (max(start_times[1:]) * 1000, len(start_times) - 1))
+    print("%d replies, %d decoded, %d cache hits" % (args.repeat, decoder.decode_count, stats['hit_count']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Offline benchmark of the voice activity detector (alexa_vad.VoiceActivityDetector) on recorded PCM (16 kHz L16).
+The recording (files/example_get_time.pcm by default) is placed between stretches of background noise, and fed to
+the detector in the same chunks as the capture engine produces. For each end-of-speech duration, the time speech was
+detected, the time the end of speech was reported (and how long after the last speech frame that was), and the
+processing time per frame are reported, in total and for the noise floor and endpointing, which are computed frame by
+frame in Python (the rest is computed for all frames of a chunk at once).
+
+    python -m benchmarks.vad --end-durations 0.2 0.3 0.5 0.8
+
+"""
+
+import argparse
+
+import numpy
+
+import alexa_vad
+from benchmarks import avs_server
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+RATE = 16000
+CHUNK = 1024
+
+
+def get_test_audio(speech, leading_silence, trailing_silence, noise_level, seed=None):
+    """ Places speech between stretches of background noise (the noise is also added to the speech).
+
+    :param speech: numpy int16 array of the speech
+    :param leading_silence: seconds of noise before the speech
+    :param trailing_silence: seconds of noise after the speech
+    :param noise_level: standard deviation of the noise
+    :param seed: (optional) seed for the noise
+    :return: numpy int16 array
+    """
+    random_state = numpy.random.RandomState(seed)
+    leading = int(leading_silence * RATE)
+    audio = numpy.zeros(leading + len(speech) + int(trailing_silence * RATE), dtype=numpy.float32)
+    audio[leading:leading + len(speech)] = speech
+    audio += random_state.normal(0, noise_level, len(audio))
+    return numpy.clip(audio, -32768, 32767).astype(numpy.int16)
+
+
+def run_detector(detector, audio):
+    """ Feeds audio to a detector chunk by chunk, and records when speech starts and ends.
+
+    :param detector: VoiceActivityDetector
+    :param audio: numpy int16 array
+    :return: (start, end, last_speech) seconds into the audio (None if it was not detected), last_speech is the end
+             of the last frame that was speech before the end was detected
+    """
+    detector.reset()
+    start = end = last_speech = None
+    frame_duration = detector.frame_samples / RATE
+    frame_count = 0
+    raw_audio = audio.tobytes()
+    chunk_bytes = CHUNK * 2
+    for offset in range(0, len(raw_audio), chunk_bytes):
+        was_speaking = detector.is_speaking
+        decisions = detector.process(raw_audio[offset:offset + chunk_bytes])
+        if end is None and decisions.any():
+            last_speech = (frame_count + numpy.flatnonzero(decisions)[-1] + 1) * frame_duration
+        frame_count += len(decisions)
+        chunk_end = (offset + chunk_bytes) / 2 / RATE
+        if not was_speaking and detector.is_speaking and start is None:
+            start = chunk_end
+        elif was_speaking and not detector.is_speaking and end is None:
+            end = chunk_end
+    return start, end, last_speech
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the voice activity detector.")
+    parser.add_argument('--pcm', default=avs_server.DEFAULT_SPEAK_ATTACHMENT,
+                        help="recording to use (raw PCM, 16 kHz, 16 bit, mono)")
+    parser.add_argument('--end-durations', type=float, nargs='+', default=[0.2, 0.3, 0.5, 0.8],
+                        help="seconds of silence that end speech")
+    parser.add_argument('--noise-level', type=float, default=30, help="standard deviation of the background noise")
+    parser.add_argument('--repeat', type=int, default=20, help="number of times each case is run (for the timing)")
+    args = parser.parse_args()
+
+    speech = numpy.fromfile(args.pcm, dtype=numpy.int16)
+    leading_silence = 1
+    audio = get_test_audio(speech, leading_silence, 3, args.noise_level, seed=0)
+    print("%s: %.2f s of speech, %.1f s of audio" % (args.pcm, len(speech) / RATE, len(audio) / RATE))
+
+    for end_duration in args.end_durations:
+        detector = alexa_vad.VoiceActivityDetector(rate=RATE, speech_end_duration=end_duration)
+        for _ in range(args.repeat):
+            start, end, last_speech = run_detector(detector, audio)
+        stats = detector.get_stats()
+        print("end duration %.2f s   speech detected at %s   endpoint %s   %6.2f us/frame (%.2f frame by frame)" % (
+            end_duration,
+            "%.2f s" % start if start is not None else "never",
+            "%.2f s (%.2f s after the last speech)" % (end, end - last_speech) if end is not None else "never",
+            stats['time_per_frame_us'], stats['tracking_time_per_frame_us']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,767 @@
+import asyncio
+import collections
+import select
+import socket
+import ssl
+import threading
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+
+__author__ = "NJC"
+__license__ = "MIT"
+
+# Maximum number of bytes waiting to be written to the socket before senders wait (the I/O thread writes them)
+MAX_OUTGOING_BYTES = 1024 * 1024
+
+
+def get_buffers(data):
+    """ Gets the buffers of a body, as byte memoryviews. Nothing is copied.
+
+    :param data: bytes-like object, or a list (or any iterable) of bytes-like objects
+    :return: deque of non-empty memoryviews (format 'B')
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = [data]
+    buffers = collections.deque()
+    for buffer in data:
+        view = memoryview(buffer)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        if len(view) > 0:
+            buffers.append(view)
+    return buffers
+
+
+def get_next_chunk(buffers, size):
+    """ Removes the next chunk of data from the buffers. The chunk is not larger than size, and never spans two
+        buffers (so it is never copied).
+
+    :param buffers: deque of memoryviews (see get_buffers), the chunk is removed from it
+    :param size: maximum size of the chunk in bytes
+    :return: memoryview chunk (empty if there are no buffers)
+    """
+    if not buffers:
+        return memoryview(b'')
+    buffer = buffers.popleft()
+    if len(buffer) > size:
+        buffers.appendleft(buffer[size:])
+        buffer = buffer[:size]
+    return buffer
+
+
+class HTTP2Stream:
+    """ The state of a single HTTP/2 stream (request and response). Only used by HTTP2Connection and HTTP2Response.
+    """
+    def __init__(self, stream_id, lock):
+        """ Initialize the stream.
+
+        :param stream_id: HTTP/2 stream_id
+        :param lock: lock of the HTTP2Connection (the stream's condition uses the same lock)
+        """
+        self.stream_id = stream_id
+        self.condition = threading.Condition(lock)
+        self.headers = None
+        # Received data chunks, as (data, flow_controlled_length) tuples
+        self.data = collections.deque()
+        self.is_ended = False
+        self.is_reset = False
+        self.response_taken = False
+
+
+class HTTP2Response:
+    """ The response to a request sent with HTTP2Connection.request. The status and headers are available as soon as
+        the response is returned by get_response, the body can be read all at once (read), as it arrives
+        (read_chunked), or by checking for data that has already arrived (read_available).
+    """
+    def __init__(self, connection, stream):
+        """ Initialize the response, once the headers have been received.
+
+        :param connection: HTTP2Connection the response belongs to
+        :param stream: HTTP2Stream of the response
+        """
+        self.connection = connection
+        self.stream = stream
+        # Headers as a dictionary of lists of binary values (duplicate header names are allowed)
+        self.headers = {}
+        for name, value in stream.headers:
+            self.headers.setdefault(name.decode().lower(), []).append(value)
+        self.status = int(self.headers[':status'][0])
+
+    def read_chunked(self, decode_content=False):
+        """ Returns a generator, which returns each chunk of the body as soon as it has been received. The generator
+            ends when the response is complete (or the stream is reset, or the connection is closed).
+
+        :param decode_content: (ignored) kept for compatibility with hyper's HTTP20Response
+        """
+        while True:
+            with self.stream.condition:
+                while not self.stream.data and not self.stream.is_ended and not self.stream.is_reset \
+                        and not self.connection.is_closed:
+                    self.stream.condition.wait()
+                if not self.stream.data:
+                    return
+                data, flow_controlled_length = self.stream.data.popleft()
+                self.connection.acknowledge_data(self.stream.stream_id, flow_controlled_length)
+            yield data
+
+    def read_available(self):
+        """ Returns all of the data that has been received so far, without waiting for more.
+
+        :return: list of binary string chunks (empty if no data is available)
+        """
+        chunks = []
+        with self.stream.condition:
+            while self.stream.data:
+                data, flow_controlled_length = self.stream.data.popleft()
+                self.connection.acknowledge_data(self.stream.stream_id, flow_controlled_length)
+                chunks.append(data)
+        return chunks
+
+    def read(self):
+        """ Waits until the response is complete and returns the body (or whatever part of it was not read yet).
+
+        :return: binary string of the body
+        """
+        return b''.join(self.read_chunked())
+
+    @property
+    def is_complete(self):
+        """ True once the server has ended the response (or reset the stream) and all data has been read.
+        """
+        with self.stream.condition:
+            return (self.stream.is_ended or self.stream.is_reset or self.connection.is_closed) \
+                and not self.stream.data
+
+
+class HTTP2Connection:
+    """ A single HTTP/2 client connection, which is safe to use from many threads at the same time. One I/O thread
+        owns the socket: it reads every frame and hands the data to the stream it belongs to, and it writes the data
+        the other threads queue (a TLS socket must not be read and written by two threads at once). Threads waiting
+        for a response (or for flow control) wait on a condition and never use the socket themselves, so a slow
+        response on one stream never blocks requests and responses on the other streams.
+    """
+    def __init__(self, host, port=443, secure=True):
+        """ Opens the connection, and starts the I/O thread.
+
+        :param host: host name of the server
+        :param port: (optional) port of the server
+        :param secure: (optional) flag that indicates if TLS should be used (HTTP/2 is negotiated using ALPN), if
+                       False HTTP/2 is used directly over TCP
+        """
+        self.host = host
+        self.port = port
+        self.secure = secure
+
+        # One lock protects the HTTP/2 state and the data waiting to be written. It is never held while waiting for
+        # the socket.
+        self.lock = threading.Lock()
+        # Used to wait until a flow control window is opened, until a stream is closed (so a new one can be opened),
+        # or until queued data has been written
+        self.window_updated = threading.Condition(self.lock)
+        self.streams = {}
+        self.is_closed = False
+        # Data waiting to be written by the I/O thread
+        self.outgoing = bytearray()
+        self.io_thread = None
+        # Written to wake up the I/O thread when data is queued (or the connection is closed)
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if secure:
+            context = ssl.create_default_context()
+            context.set_alpn_protocols(['h2'])
+            sock = context.wrap_socket(sock, server_hostname=host)
+            if sock.selected_alpn_protocol() != 'h2':
+                sock.close()
+                raise NameError("Server did not negotiate HTTP/2 (%s)" % sock.selected_alpn_protocol())
+        # Only the I/O thread uses the socket, and it waits for the socket with select
+        sock.setblocking(False)
+        self.sock = sock
+
+        config = h2.config.H2Configuration(client_side=True, header_encoding=None)
+        self.h2_connection = h2.connection.H2Connection(config=config)
+        with self.lock:
+            self.h2_connection.initiate_connection()
+            self.flush()
+
+        self.io_thread = threading.Thread(target=self.io_thread_function)
+        self.io_thread.daemon = True
+        self.io_thread.start()
+
+    def io_thread_function(self):
+        """ Reads from the socket and writes the queued data until the connection is closed (and everything queued
+            before that has been written). Each event read is handed to its stream.
+        """
+        try:
+            while True:
+                with self.lock:
+                    if self.is_closed and not self.outgoing:
+                        break
+                    want_write = len(self.outgoing) > 0
+                readable, writable, _ = select.select([self.sock, self.wakeup_receiver],
+                                                      [self.sock] if want_write else [], [])
+                if self.wakeup_receiver in readable:
+                    self.clear_wakeup()
+                if writable:
+                    self.write_outgoing()
+                if self.sock in readable and not self.read_incoming():
+                    break
+        except (OSError, ValueError, h2.exceptions.ProtocolError):
+            pass
+        self.mark_closed()
+
+    def read_incoming(self):
+        """ Reads what is available on the socket (called by the I/O thread), and hands each event to its stream.
+
+        :return: False if the server closed the connection
+        """
+        while True:
+            try:
+                data = self.sock.recv(65535)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                return True
+            if not data:
+                return False
+            with self.lock:
+                for event in self.h2_connection.receive_data(data):
+                    self.handle_event(event)
+                self.flush()
+            # Data that TLS has already decrypted is not reported by select
+            if not self.secure or self.sock.pending() == 0:
+                return True
+
+    def write_outgoing(self):
+        """ Writes as much of the queued data as the socket accepts (called by the I/O thread).
+        """
+        with self.lock:
+            data = bytes(self.outgoing[:MAX_OUTGOING_BYTES])
+        try:
+            sent = self.sock.send(data)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+            return
+        with self.lock:
+            del self.outgoing[:sent]
+            # Senders may be waiting for the queue to shrink
+            self.window_updated.notify_all()
+
+    def wake_io_thread(self):
+        """ Wakes up the I/O thread (e.g. because data was queued).
+        """
+        try:
+            self.wakeup_sender.send(b'\0')
+        except (BlockingIOError, OSError):
+            # Already woken up (or closed)
+            pass
+
+    def clear_wakeup(self):
+        """ Discards the wake up signals received by the I/O thread.
+        """
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def handle_event(self, event):
+        """ Handles a single HTTP/2 event. Must be called with the lock held.
+
+        :param event: h2.events.Event object
+        """
+        if isinstance(event, h2.events.ResponseReceived):
+            stream = self.streams.get(event.stream_id)
+            if stream is not None:
+                stream.headers = event.headers
+                stream.condition.notify_all()
+        elif isinstance(event, h2.events.DataReceived):
+            stream = self.streams.get(event.stream_id)
+            if stream is not None:
+                stream.data.append((event.data, event.flow_controlled_length))
+                stream.condition.notify_all()
+            else:
+                self.h2_connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, (h2.events.StreamEnded, h2.events.StreamReset)):
+            stream = self.streams.get(event.stream_id)
+            if stream is not None:
+                if isinstance(event, h2.events.StreamEnded):
+                    stream.is_ended = True
+                else:
+                    stream.is_reset = True
+                self.window_updated.notify_all()
+                # A reset stream has no response left to read (a caller waiting for it still has the stream)
+                if stream.response_taken or stream.is_reset:
+                    del self.streams[event.stream_id]
+                stream.condition.notify_all()
+        elif isinstance(event, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged)):
+            self.window_updated.notify_all()
+        elif isinstance(event, h2.events.PushedStreamReceived):
+            # Pushes are not used, refuse them
+            self.h2_connection.reset_stream(event.pushed_stream_id, error_code=7)
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.is_closed = True
+            self.notify_all()
+
+    def flush(self):
+        """ Queues any pending HTTP/2 data for the I/O thread to write. Must be called with the lock held, so that the
+            data is written in the same order it was produced.
+        """
+        data = self.h2_connection.data_to_send()
+        if data and not self.is_closed:
+            was_empty = not self.outgoing
+            self.outgoing += data
+            if was_empty and threading.current_thread() is not self.io_thread:
+                self.wake_io_thread()
+
+    def notify_all(self):
+        """ Wakes up every thread waiting on the connection. Must be called with the lock held.
+        """
+        self.window_updated.notify_all()
+        for stream in self.streams.values():
+            stream.condition.notify_all()
+
+    def mark_closed(self):
+        """ Marks the connection as closed, and wakes up every waiting thread. The streams are released (threads
+            reading a response keep their stream).
+        """
+        with self.lock:
+            self.is_closed = True
+            self.notify_all()
+            self.streams = {}
+
+    def request(self, method, path, headers=None, body=None, final=True):
+        """ Sends a request. The stream is ended after the body, unless final is False, in which case the rest of the
+            body is sent using send.
+
+        :param method: string HTTP/2 method (e.g. 'GET')
+        :param path: string of the full path
+        :param headers: (optional) dictionary of additional headers
+        :param body: (optional) binary string with the (start of the) body, or a list of binary strings (see send)
+        :param final: (optional, default=True) flag that indicates if the request is complete
+        :return: stream_id for the request
+        """
+        request_headers = [
+            (':method', method),
+            (':scheme', 'https' if self.secure else 'http'),
+            (':authority', self.host),
+            (':path', path)
+        ]
+        if headers is not None:
+            request_headers += list(headers.items())
+
+        with self.lock:
+            # Wait until the server allows another stream to be opened
+            while not self.is_closed and self.h2_connection.open_outbound_streams >= \
+                    self.h2_connection.remote_settings.max_concurrent_streams:
+                self.window_updated.wait()
+            if self.is_closed:
+                raise ConnectionError("Connection is closed")
+            stream_id = self.h2_connection.get_next_available_stream_id()
+            self.streams[stream_id] = HTTP2Stream(stream_id, self.lock)
+            self.h2_connection.send_headers(stream_id, request_headers, end_stream=final and not body)
+            self.flush()
+
+        if body:
+            self.send(stream_id, body, final=final)
+        return stream_id
+
+    def send(self, stream_id, data, final=False):
+        """ Sends (more of) the body of a request. Waits for the server to open the flow control window if needed,
+            without blocking other streams while waiting.
+
+        :param stream_id: stream_id for the request
+        :param data: binary string (or any bytes-like object) to send, or a list of them (sent one after the other,
+                     without joining them)
+        :param final: (optional, default=False) flag that indicates if this is the end of the body
+        """
+        buffers = get_buffers(data)
+        with self.lock:
+            while True:
+                stream = self.streams.get(stream_id)
+                if self.is_closed or stream is None or stream.is_reset:
+                    raise ConnectionError("Stream %d is closed" % stream_id)
+                window = min(self.h2_connection.local_flow_control_window(stream_id),
+                             self.h2_connection.max_outbound_frame_size)
+                # Wait for the flow control window, or for the I/O thread to catch up with the queued data
+                if (window <= 0 and buffers) or len(self.outgoing) >= MAX_OUTGOING_BYTES:
+                    self.window_updated.wait()
+                    continue
+                chunk = get_next_chunk(buffers, window)
+                self.h2_connection.send_data(stream_id, chunk, end_stream=final and not buffers)
+                self.flush()
+                if not buffers:
+                    break
+
+    def get_response(self, stream_id):
+        """ Waits for the response headers of a request.
+
+        :param stream_id: stream_id for the request
+        :return: HTTP2Response object
+        """
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                # Streams are released once they are reset, or the connection is closed
+                if self.is_closed or stream_id <= self.h2_connection.highest_outbound_stream_id:
+                    raise ConnectionError("Stream %d is closed" % stream_id)
+                raise KeyError("Unknown stream (%d)" % stream_id)
+            while stream.headers is None:
+                if self.is_closed or stream.is_reset:
+                    raise ConnectionError("Stream %d closed before the response was received" % stream_id)
+                stream.condition.wait()
+            stream.response_taken = True
+            if stream.is_ended or stream.is_reset:
+                del self.streams[stream_id]
+        return HTTP2Response(self, stream)
+
+    def acknowledge_data(self, stream_id, flow_controlled_length):
+        """ Lets the server know that received data has been consumed, so that it can send more. Must be called
+            with the lock held.
+
+        :param stream_id: stream_id the data was received on
+        :param flow_controlled_length: flow controlled length of the received data
+        """
+        if self.is_closed:
+            return
+        self.h2_connection.acknowledge_received_data(flow_controlled_length, stream_id)
+        self.flush()
+
+    def close(self, timeout=5):
+        """ Closes the connection. Any thread waiting on the connection is woken up.
+
+        :param timeout: (optional) seconds to wait for the I/O thread to write the data that is still queued
+        """
+        with self.lock:
+            if not self.is_closed:
+                try:
+                    self.h2_connection.close_connection()
+                    self.flush()
+                except h2.exceptions.ProtocolError:
+                    pass
+            self.is_closed = True
+            self.notify_all()
+            self.streams = {}
+        # The I/O thread stops once the queued data (e.g. GOAWAY) has been written
+        self.wake_io_thread()
+        if self.io_thread is not threading.current_thread():
+            self.io_thread.join(timeout)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.wakeup_sender.close()
+        self.wakeup_receiver.close()
+
+
+class AsyncHTTP2Stream:
+    """ The state of a single HTTP/2 stream of an AsyncHTTP2Connection. Only used by AsyncHTTP2Connection and
+        AsyncHTTP2Response.
+    """
+    def __init__(self, stream_id):
+        """ Initialize the stream.
+
+        :param stream_id: HTTP/2 stream_id
+        """
+        self.stream_id = stream_id
+        # Set whenever the state of the stream changes (cleared by whoever waits for it)
+        self.changed = asyncio.Event()
+        self.headers = None
+        # Received data chunks, as (data, flow_controlled_length) tuples
+        self.data = collections.deque()
+        self.is_ended = False
+        self.is_reset = False
+        self.response_taken = False
+
+
+class AsyncHTTP2Response:
+    """ The response to a request sent with AsyncHTTP2Connection.request. Same as HTTP2Response, except the body
+        is read with coroutines (read) or an async generator (read_chunked).
+    """
+    def __init__(self, connection, stream):
+        """ Initialize the response, once the headers have been received.
+
+        :param connection: AsyncHTTP2Connection the response belongs to
+        :param stream: AsyncHTTP2Stream of the response
+        """
+        self.connection = connection
+        self.stream = stream
+        # Headers as a dictionary of lists of binary values (duplicate header names are allowed)
+        self.headers = {}
+        for name, value in stream.headers:
+            self.headers.setdefault(name.decode().lower(), []).append(value)
+        self.status = int(self.headers[':status'][0])
+
+    async def read_chunked(self):
+        """ Async generator, which returns each chunk of the body as soon as it has been received. The generator
+            ends when the response is complete (or the stream is reset, or the connection is closed).
+        """
+        stream = self.stream
+        while True:
+            while not stream.data and not stream.is_ended and not stream.is_reset and not self.connection.is_closed:
+                stream.changed.clear()
+                await stream.changed.wait()
+            if not stream.data:
+                return
+            data, flow_controlled_length = stream.data.popleft()
+            self.connection.acknowledge_data(stream.stream_id, flow_controlled_length)
+            yield data
+
+    async def read(self):
+        """ Waits until the response is complete and returns the body (or whatever part of it was not read yet).
+
+        :return: binary string of the body
+        """
+        chunks = []
+        async for chunk in self.read_chunked():
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+class AsyncHTTP2Connection:
+    """ A single HTTP/2 client connection for asyncio. A task owned by the connection reads every frame and hands
+        the data to the stream it belongs to, and coroutines waiting for a response (or for flow control) wait on
+        their own stream. Everything runs on the event loop, so no locks are needed. Call connect before use.
+    """
+    def __init__(self, host, port=443, secure=True):
+        """ Initialize the connection. The connection is not opened until connect is called.
+
+        :param host: host name of the server
+        :param port: (optional) port of the server
+        :param secure: (optional) flag that indicates if TLS should be used (HTTP/2 is negotiated using ALPN), if
+                       False HTTP/2 is used directly over TCP
+        """
+        self.host = host
+        self.port = port
+        self.secure = secure
+
+        self.streams = {}
+        self.is_closed = False
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        # Set when a flow control window is opened, or a stream is closed (cleared by whoever waits for it)
+        self.window_updated = None
+        self.h2_connection = None
+
+    async def connect(self):
+        """ Opens the connection, and starts the task that reads from it.
+        """
+        ssl_context = None
+        if self.secure:
+            ssl_context = ssl.create_default_context()
+            ssl_context.set_alpn_protocols(['h2'])
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=ssl_context)
+        if self.secure:
+            protocol = self.writer.get_extra_info('ssl_object').selected_alpn_protocol()
+            if protocol != 'h2':
+                self.writer.close()
+                raise NameError("Server did not negotiate HTTP/2 (%s)" % protocol)
+        sock = self.writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.window_updated = asyncio.Event()
+        config = h2.config.H2Configuration(client_side=True, header_encoding=None)
+        self.h2_connection = h2.connection.H2Connection(config=config)
+        self.h2_connection.initiate_connection()
+        self.flush()
+
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        """ Reads from the connection until it is closed, and hands each event to its stream.
+        """
+        try:
+            while True:
+                data = await self.reader.read(65535)
+                if not data:
+                    break
+                for event in self.h2_connection.receive_data(data):
+                    self.handle_event(event)
+                self.flush()
+        except (OSError, ValueError, h2.exceptions.ProtocolError):
+            pass
+        self.mark_closed()
+
+    def handle_event(self, event):
+        """ Handles a single HTTP/2 event.
+
+        :param event: h2.events.Event object
+        """
+        if isinstance(event, h2.events.ResponseReceived):
+            stream = self.streams.get(event.stream_id)
+            if stream is not None:
+                stream.headers = event.headers
+                stream.changed.set()
+        elif isinstance(event, h2.events.DataReceived):
+            stream = self.streams.get(event.stream_id)
+            if stream is not None:
+                stream.data.append((event.data, event.flow_controlled_length))
+                stream.changed.set()
+            else:
+                self.h2_connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, (h2.events.StreamEnded, h2.events.StreamReset)):
+            stream = self.streams.get(event.stream_id)
+            if stream is not None:
+                if isinstance(event, h2.events.StreamEnded):
+                    stream.is_ended = True
+                else:
+                    stream.is_reset = True
+                self.window_updated.set()
+                # A reset stream has no response left to read (a coroutine waiting for it still has the stream)
+                if stream.response_taken or stream.is_reset:
+                    del self.streams[event.stream_id]
+                stream.changed.set()
+        elif isinstance(event, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged)):
+            self.window_updated.set()
+        elif isinstance(event, h2.events.PushedStreamReceived):
+            # Pushes are not used, refuse them
+            self.h2_connection.reset_stream(event.pushed_stream_id, error_code=7)
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.mark_closed()
+
+    def flush(self):
+        """ Writes any pending HTTP/2 data to the connection (without waiting for it to be sent).
+        """
+        data = self.h2_connection.data_to_send()
+        if data and not self.is_closed:
+            self.writer.write(data)
+
+    def mark_closed(self):
+        """ Marks the connection as closed, and wakes up every waiting coroutine.
+        """
+        self.is_closed = True
+        if self.window_updated is not None:
+            self.window_updated.set()
+        for stream in self.streams.values():
+            stream.changed.set()
+        # Coroutines reading a response keep their stream
+        self.streams = {}
+
+    async def drain(self):
+        """ Waits until the data written so far has been handed to the operating system.
+        """
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self.mark_closed()
+            raise
+
+    async def request(self, method, path, headers=None, body=None, final=True):
+        """ Sends a request. Same as HTTP2Connection.request.
+
+        :param method: string HTTP/2 method (e.g. 'GET')
+        :param path: string of the full path
+        :param headers: (optional) dictionary of additional headers
+        :param body: (optional) binary string with the (start of the) body, or a list of binary strings (see send)
+        :param final: (optional, default=True) flag that indicates if the request is complete
+        :return: stream_id for the request
+        """
+        request_headers = [
+            (':method', method),
+            (':scheme', 'https' if self.secure else 'http'),
+            (':authority', self.host),
+            (':path', path)
+        ]
+        if headers is not None:
+            request_headers += list(headers.items())
+
+        # Wait until the server allows another stream to be opened
+        while not self.is_closed and self.h2_connection.open_outbound_streams >= \
+                self.h2_connection.remote_settings.max_concurrent_streams:
+            self.window_updated.clear()
+            await self.window_updated.wait()
+        if self.is_closed:
+            raise ConnectionError("Connection is closed")
+        stream_id = self.h2_connection.get_next_available_stream_id()
+        self.streams[stream_id] = AsyncHTTP2Stream(stream_id)
+        self.h2_connection.send_headers(stream_id, request_headers, end_stream=final and not body)
+        self.flush()
+
+        if body:
+            await self.send(stream_id, body, final=final)
+        else:
+            await self.drain()
+        return stream_id
+
+    async def send(self, stream_id, data, final=False):
+        """ Sends (more of) the body of a request. Waits for the server to open the flow control window if needed,
+            without blocking other streams while waiting.
+
+        :param stream_id: stream_id for the request
+        :param data: binary string (or any bytes-like object) to send, or a list of them (sent one after the other,
+                     without joining them)
+        :param final: (optional, default=False) flag that indicates if this is the end of the body
+        """
+        buffers = get_buffers(data)
+        while True:
+            stream = self.streams.get(stream_id)
+            if self.is_closed or stream is None or stream.is_reset:
+                raise ConnectionError("Stream %d is closed" % stream_id)
+            window = min(self.h2_connection.local_flow_control_window(stream_id),
+                         self.h2_connection.max_outbound_frame_size)
+            if window <= 0 and buffers:
+                self.window_updated.clear()
+                await self.window_updated.wait()
+                continue
+            chunk = get_next_chunk(buffers, window)
+            self.h2_connection.send_data(stream_id, chunk, end_stream=final and not buffers)
+            self.flush()
+            await self.drain()
+            if not buffers:
+                break
+
+    async def get_response(self, stream_id):
+        """ Waits for the response headers of a request.
+
+        :param stream_id: stream_id for the request
+        :return: AsyncHTTP2Response object
+        """
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            # Streams are released once they are reset, or the connection is closed
+            if self.is_closed or stream_id <= self.h2_connection.highest_outbound_stream_id:
+                raise ConnectionError("Stream %d is closed" % stream_id)
+            raise KeyError("Unknown stream (%d)" % stream_id)
+        while stream.headers is None:
+            if self.is_closed or stream.is_reset:
+                raise ConnectionError("Stream %d closed before the response was received" % stream_id)
+            stream.changed.clear()
+            await stream.changed.wait()
+        stream.response_taken = True
+        if stream.is_ended or stream.is_reset:
+            del self.streams[stream_id]
+        return AsyncHTTP2Response(self, stream)
+
+    def acknowledge_data(self, stream_id, flow_controlled_length):
+        """ Lets the server know that received data has been consumed, so that it can send more.
+
+        :param stream_id: stream_id the data was received on
+        :param flow_controlled_length: flow controlled length of the received data
+        """
+        if self.is_closed:
+            return
+        self.h2_connection.acknowledge_received_data(flow_controlled_length, stream_id)
+        self.flush()
+
+    async def close(self):
+        """ Closes the connection. Any coroutine waiting on the connection is woken up.
+        """
+        if not self.is_closed:
+            try:
+                self.h2_connection.close_connection()
+                self.flush()
+            except h2.exceptions.ProtocolError:
+                pass
+        self.mark_closed()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, ConnectionError):
+            pass
+        await self.read_task